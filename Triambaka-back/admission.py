@@ -0,0 +1,299 @@
+"""
+Admission control for the API.
+
+Each kind of work goes through its own CostGate: watermarking by estimated
+cost (megapixels times the full-frame passes the endpoint is expected to make),
+blockchain and IPFS calls by plain concurrency. A request that does not fit
+waits in a bounded FIFO queue for at most max_wait seconds; when the queue is
+full, or the wait runs out, it is rejected with Overloaded (429 + Retry-After),
+so a burst degrades into fast rejections instead of piling up in memory.
+Gates are per process and usable from threads and from asyncio.
+"""
+import asyncio
+import math
+import os
+import threading
+import time
+import wave
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+
+from PIL import Image
+
+CPU_COUNT = os.cpu_count() or 1
+# Megapixel-passes of watermark work allowed in flight at once
+ADMISSION_CPU_BUDGET = float(os.getenv("ADMISSION_CPU_BUDGET", str(50 * CPU_COUNT)))
+ADMISSION_QUEUE_MAX = int(os.getenv("ADMISSION_QUEUE_MAX", "16"))
+ADMISSION_MAX_WAIT_S = float(os.getenv("ADMISSION_MAX_WAIT_S", "30"))
+# Concurrent blockchain and IPFS requests
+ADMISSION_CHAIN_CONCURRENCY = int(os.getenv("ADMISSION_CHAIN_CONCURRENCY", "32"))
+ADMISSION_IPFS_CONCURRENCY = int(os.getenv("ADMISSION_IPFS_CONCURRENCY", "8"))
+# Delta steps an embed usually needs, including the first attempt
+EMBED_EXPECTED_ITERATIONS = float(os.getenv("EMBED_EXPECTED_ITERATIONS", "2"))
+
+# Full-frame passes (block DCT + QIM) per request: an embed attempt is an embed
+# and an extract; check_image reuses one DCT for every delta but embeds originals.
+EXPECTED_PASSES = {
+    "embed": 2 * EMBED_EXPECTED_ITERATIONS,
+    "check_image": 3,
+    "verify": 1,
+    "detect_keys": 2,
+    "resync": 8,
+    # A 1/8 decode for JPEGs, one grayscale decode otherwise; escalations pay "verify"
+    "triage": 0.25,
+    # Per megasample of audio (all channels), a 1-D DCT pass costs about half a megapixel one;
+    # detection usually stops after a few seconds however long the track is
+    "audio_embed": 0.5,
+    "audio_detect": 0.05,
+}
+# Cost of an image whose header cannot be read (charged as 12 MP)
+UNKNOWN_MEGAPIXELS = 12.0
+RETRY_AFTER_MAX_S = 60
+
+
+class Overloaded(Exception):
+    """Raised when a request is shed; retry_after is a hint in seconds."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def image_megapixels(source):
+    """
+    Megapixels of an image file (path or binary file object) from its header,
+    without decoding it. File objects are rewound.
+    """
+    position = source.tell() if hasattr(source, 'tell') else None
+    try:
+        with Image.open(source) as img:
+            width, height = img.size
+        return width * height / 1e6
+    except Exception:
+        return UNKNOWN_MEGAPIXELS
+    finally:
+        if position is not None:
+            source.seek(position)
+
+
+def image_cost(source, endpoint):
+    return max(image_megapixels(source), 0.01) * EXPECTED_PASSES[endpoint]
+
+
+def audio_megasamples(source):
+    """
+    Megasamples (all channels) of a WAV file from its header. File objects are rewound.
+    """
+    position = source.tell() if hasattr(source, 'tell') else None
+    try:
+        with wave.open(source, 'rb') as reader:
+            return reader.getnframes() * reader.getnchannels() / 1e6
+    except Exception:
+        return UNKNOWN_MEGAPIXELS
+    finally:
+        if position is not None:
+            source.seek(position)
+
+
+def audio_cost(source, endpoint):
+    return max(audio_megasamples(source), 0.01) * EXPECTED_PASSES[endpoint]
+
+
+class _Ticket:
+    def __init__(self, cost, wake):
+        self.cost = cost
+        self.wake = wake
+        self.granted = False
+
+
+class CostGate:
+    """
+    Admits work while the cost in flight stays within capacity; the rest waits
+    in FIFO order (so a large request is not starved by small ones). A single
+    request costlier than the whole capacity is charged the capacity and runs alone.
+    """
+
+    def __init__(self, name, capacity, max_queue, max_wait):
+        self.name = name
+        self.capacity = capacity
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._in_use = 0.0
+        self._running = 0
+        self._waiting = deque()
+        self._seconds = None  # moving average of admitted request durations
+        self._counters = {"admitted": 0, "queued": 0, "rejected_queue_full": 0, "rejected_timeout": 0,
+                          "peak_waiting": 0}
+
+    def _retry_after(self):
+        """
+        Seconds until the work in flight and queued has likely drained. Caller holds the lock.
+        """
+        outstanding = self._in_use + sum(ticket.cost for ticket in self._waiting)
+        seconds = (self._seconds or 1.0) * outstanding / self.capacity
+        return int(min(max(math.ceil(seconds), 1), RETRY_AFTER_MAX_S))
+
+    def _reject(self, counter, message):
+        self._counters[counter] += 1
+        return Overloaded(f"Server busy ({self.name}): {message}", self._retry_after())
+
+    def _grant(self, cost):
+        self._in_use += cost
+        self._running += 1
+        self._counters["admitted"] += 1
+
+    def _grant_waiters(self):
+        while self._waiting and self._in_use + self._waiting[0].cost <= self.capacity:
+            ticket = self._waiting.popleft()
+            self._grant(ticket.cost)
+            ticket.granted = True
+            ticket.wake()
+
+    def _enqueue(self, cost, wake):
+        """
+        Admits cost right away (returns None) or queues a ticket for it. Caller holds the lock.
+        """
+        if not self._waiting and self._in_use + cost <= self.capacity:
+            self._grant(cost)
+            return None
+        if len(self._waiting) >= self.max_queue:
+            raise self._reject("rejected_queue_full", "queue is full")
+        ticket = _Ticket(cost, wake)
+        self._waiting.append(ticket)
+        self._counters["queued"] += 1
+        self._counters["peak_waiting"] = max(self._counters["peak_waiting"], len(self._waiting))
+        return ticket
+
+    def _give_up(self, ticket):
+        """
+        Called when a queued ticket stops waiting. Returns True if it was granted
+        meanwhile (the caller then owns the slot). Caller holds the lock.
+        """
+        if ticket.granted:
+            return True
+        self._waiting.remove(ticket)
+        self._grant_waiters()  # the head of the queue may have been blocking smaller requests
+        return False
+
+    def check(self):
+        """
+        Rejects early, before an upload is read, when the queue is already full.
+        """
+        with self._lock:
+            if len(self._waiting) >= self.max_queue:
+                raise self._reject("rejected_queue_full", "queue is full")
+
+    def acquire(self, cost=1):
+        """
+        Blocks until cost is admitted; returns the cost charged (pass it to release).
+        """
+        cost = min(cost, self.capacity)
+        event = threading.Event()
+        with self._lock:
+            ticket = self._enqueue(cost, event.set)
+        if ticket is not None and not event.wait(self.max_wait):
+            with self._lock:
+                if not self._give_up(ticket):
+                    raise self._reject("rejected_timeout", f"no capacity within {self.max_wait:g}s")
+        return cost
+
+    async def acquire_async(self, cost=1):
+        """
+        Async counterpart of acquire.
+        """
+        cost = min(cost, self.capacity)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        with self._lock:
+            ticket = self._enqueue(cost, wake)
+        if ticket is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+            except asyncio.TimeoutError:
+                with self._lock:
+                    if not self._give_up(ticket):
+                        raise self._reject("rejected_timeout", f"no capacity within {self.max_wait:g}s")
+            except asyncio.CancelledError:
+                with self._lock:
+                    if self._give_up(ticket):
+                        self._release(cost)
+                raise
+        return cost
+
+    def _release(self, cost, seconds=None):
+        self._in_use = max(self._in_use - cost, 0.0)
+        self._running -= 1
+        if seconds is not None:
+            self._seconds = seconds if self._seconds is None else 0.8 * self._seconds + 0.2 * seconds
+        self._grant_waiters()
+
+    def release(self, cost, seconds=None):
+        """
+        Returns cost to the gate; seconds (the request's duration) feeds the Retry-After estimate.
+        """
+        with self._lock:
+            self._release(cost, seconds)
+
+    @contextmanager
+    def admit(self, cost=1):
+        cost = self.acquire(cost)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(cost, time.monotonic() - start)
+
+    @asynccontextmanager
+    async def admit_async(self, cost=1):
+        cost = await self.acquire_async(cost)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(cost, time.monotonic() - start)
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "capacity": self.capacity,
+                "in_use": self._in_use,
+                "running": self._running,
+                "waiting": len(self._waiting),
+                "avg_seconds": self._seconds,
+                **self._counters,
+            }
+
+
+cpu = CostGate("watermark", ADMISSION_CPU_BUDGET, ADMISSION_QUEUE_MAX, ADMISSION_MAX_WAIT_S)
+chain = CostGate("blockchain", ADMISSION_CHAIN_CONCURRENCY, 4 * ADMISSION_CHAIN_CONCURRENCY, 5)
+ipfs = CostGate("ipfs", ADMISSION_IPFS_CONCURRENCY, 4 * ADMISSION_IPFS_CONCURRENCY, 10)
+
+
+def metrics():
+    return {gate.name: gate.metrics() for gate in (cpu, chain, ipfs)}
+
+
+def limit_blueprint(blueprint, gate):
+    """
+    Admits every request to a Flask blueprint through gate, at cost 1.
+    """
+    from flask import g, jsonify
+
+    @blueprint.before_request
+    def _admit():
+        try:
+            gate.acquire(1)
+        except Overloaded as e:
+            return jsonify({"error": str(e)}), 429, {"Retry-After": str(e.retry_after)}
+        g.admitted = (gate, time.monotonic())
+
+    @blueprint.teardown_request
+    def _release(exc):
+        admitted = g.pop('admitted', None)
+        if admitted is not None:
+            admitted[0].release(1, time.monotonic() - admitted[1])
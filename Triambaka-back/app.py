@@ -4,10 +4,15 @@ from routes.watermark import watermark_bp
 from routes.verify import verify_bp
 from routes.ipfs_routes import ipfs_bp
 from routes.blockchain_routes import blockchain_bp
+from routes.metrics_routes import metrics_bp
+from database import init_db
 
 app = Flask(__name__)
 app.config.from_object("config.Config")
 
+# Set up the local embed registry
+init_db(app)
+
 # Enable CORS
 CORS(app)
 
@@ -16,6 +21,7 @@ app.register_blueprint(watermark_bp, url_prefix="/api/watermark")
 app.register_blueprint(verify_bp, url_prefix="/api/watermark")
 app.register_blueprint(ipfs_bp, url_prefix="/api/ipfs")
 app.register_blueprint(blockchain_bp, url_prefix="/api/blockchain")
+app.register_blueprint(metrics_bp, url_prefix="/api/metrics")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,848 @@
+"""
+Asyncio serving mode for the Triambaka API, built on aiohttp.
+
+    python async_app.py
+    python -m aiohttp.web -H 0.0.0.0 -P 5000 async_app:create_app
+
+Serves the routes of the watermark, verify, IPFS and blockchain blueprints with
+the same URLs and JSON as app.py. Node RPCs are awaited through AsyncWeb3,
+Pinata uploads through an aiohttp client session, and the watermark work runs
+in a process pool, so one server process can hold many in-flight I/O-bound
+requests without a thread per request.
+"""
+import asyncio
+import logging
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import aiohttp
+from aiohttp import web
+from web3 import AsyncWeb3, AsyncHTTPProvider
+from web3.exceptions import ContractLogicError
+
+import admission
+import ipfs_cache
+import scratch
+import singleflight
+from admission import Overloaded
+from ipfs_cache import ContentNotFound, GatewayError, InvalidCid
+from scratch import ScratchQuotaExceeded
+from routes.blockchain_routes import (GANACHE_URL, abi, contract_address, format_content, format_contents, parse_page,
+                                      MAX_PAGE_SIZE, IMMUTABLE_CACHE_CONTROL, BLOCK_CACHE_CONTROL, body_etag,
+                                      block_etag, etag_matches, content_filter, build_batch)
+from routes.ipfs_routes import PINATA_API_KEY, PINATA_API_SECRET, PINATA_BASE_URL
+from routes.verify import verify_upload, DeltaRequired
+from routes.watermark import (check_upload, embed_upload, embed_headers, output_format, triage_upload,
+                              escalate_upload, detect_keys_upload, resync_upload, sweep_deltas,
+                              payload_record_matches, DEFAULT_KEY, TENANT_KEYS)
+from models import key_fingerprint, recorded_dimensions
+from watermark_engine import DETECT_VERSIONS, FORMAT_VERSIONS, MemoryBudgetExceeded, audio, calculate_image_hash, encoders
+
+logger = logging.getLogger(__name__)
+
+# Worker processes for process_frame work
+CPU_WORKERS = int(os.getenv("ASYNC_CPU_WORKERS", os.cpu_count() or 1))
+
+async_web3 = AsyncWeb3(AsyncHTTPProvider(GANACHE_URL))
+async_contract = async_web3.eth.contract(address=contract_address, abi=abi)
+
+cpu_pool_key = web.AppKey("cpu_pool", ProcessPoolExecutor)
+http_session_key = web.AppKey("http_session", aiohttp.ClientSession)
+
+
+def _init_worker():
+    """
+    Runs once in each pool process: the registry needs a Flask app context.
+    """
+    from app import app as flask_app
+    flask_app.app_context().push()
+
+
+def _json_error(message, status):
+    return web.json_response({"error": message}, status=status)
+
+
+def _overloaded(e):
+    return web.json_response({"error": str(e)}, status=429, headers={"Retry-After": str(e.retry_after)})
+
+
+async def _run_cpu(request, func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(request.app[cpu_pool_key], func, *args)
+
+
+async def _save_upload(request, field, scratch_files, suffix='.png'):
+    """
+    Reads the multipart form and copies the named file field to a scratch file
+    of scratch_files. Returns (path or None, form).
+    """
+    form = await request.post()
+    upload = form.get(field)
+    if upload is None or not isinstance(upload, web.FileField):
+        return None, form
+    if upload.filename == '':
+        return '', form
+
+    size = upload.file.seek(0, os.SEEK_END)
+    upload.file.seek(0)
+    path = await asyncio.get_running_loop().run_in_executor(
+        None, scratch_files.save_upload, upload.file, suffix, size
+    )
+    return path, form
+
+
+async def _read_file(path):
+    def read():
+        with open(path, 'rb') as f:
+            return f.read()
+
+    return await asyncio.get_running_loop().run_in_executor(None, read)
+
+
+# --- Blockchain ---
+
+def _batch_leaves(image_hash):
+    """
+    Runs in a pool process (which has the registry's app context).
+    """
+    from models import find_batch_leaves
+    return [leaf.to_dict() for leaf in find_batch_leaves(image_hash)]
+
+
+async def batch_leaves_on_chain(app, image_hash, block_identifier='latest'):
+    """
+    Async counterpart of blockchain_routes.batch_leaves_on_chain; leaves are dicts.
+    """
+    loop = asyncio.get_running_loop()
+    leaves = [(await async_contract.functions.rootToBatchId(bytes.fromhex(leaf["merkle_root"][2:])).call(
+        block_identifier=block_identifier
+    ), leaf) for leaf in await loop.run_in_executor(app[cpu_pool_key], _batch_leaves, image_hash)]
+    return sorted(leaves, key=lambda item: (item[0] == 0, item[0]))
+
+
+async def verify_leaf(batch_id, leaf, block_identifier='latest'):
+    """
+    Async counterpart of blockchain_routes.verify_leaf.
+    """
+    proof = [bytes.fromhex(node[2:]) for node in leaf["proof"]]
+    return batch_id != 0 and await async_contract.functions.verifyBatchContent(
+        batch_id, leaf["sha256_hash"], leaf["ipfs_hash"], leaf["delta"], proof
+    ).call(block_identifier=block_identifier)
+
+
+async def batch_inclusion(app, image_hash, block_identifier='latest'):
+    """
+    Async counterpart of blockchain_routes.batch_inclusion.
+    """
+    batch_id = await async_contract.functions.hashToBatchId(image_hash).call(block_identifier=block_identifier)
+    if batch_id == 0:
+        return None
+    owner, merkle_root, _, manifest_ipfs_hash, timestamp = await async_contract.functions.batches(batch_id).call(
+        block_identifier=block_identifier
+    )
+    merkle_root = "0x" + bytes(merkle_root).hex()
+    leaves = await asyncio.get_running_loop().run_in_executor(app[cpu_pool_key], _batch_leaves, image_hash)
+    leaf = None
+    for candidate in leaves:
+        if candidate["merkle_root"] == merkle_root and await verify_leaf(batch_id, candidate, block_identifier):
+            leaf = candidate
+            break
+    return {"exists": True, "content_id": None, "batch_id": batch_id, "owner": owner,
+            "ipfs_hash": leaf["ipfs_hash"] if leaf else None, "sha256_hash": image_hash, "timestamp": timestamp,
+            "delta": leaf["delta"] if leaf else None, "merkle_root": merkle_root,
+            "manifest_ipfs_hash": manifest_ipfs_hash, "proof": leaf["proof"] if leaf else None}
+
+
+async def lookup_image_hash(app, image_hash, block_identifier='latest'):
+    """
+    Async counterpart of blockchain_routes.lookup_image_hash.
+    """
+    return await singleflight.chain_reads.do_async(("image_hash", image_hash, block_identifier), _lookup_image_hash,
+                                                   app, image_hash, block_identifier)
+
+
+async def _lookup_image_hash(app, image_hash, block_identifier):
+    try:
+        if content_filter.definitely_absent(image_hash, block_identifier):
+            return {"exists": False, "message": "Image hash not found on blockchain."}, 200
+        content_id, *content = await async_contract.functions.getContentByHash(image_hash).call(
+            block_identifier=block_identifier
+        )
+        if content_id == 0:
+            batch_data = await batch_inclusion(app, image_hash, block_identifier)
+            if batch_data is not None:
+                return batch_data, 200
+            return {"exists": False, "message": "Image hash not found on blockchain."}, 200
+
+        return format_content(content, content_id), 200
+    except Exception as e:
+        return {"error": str(e)}, 500
+
+
+async def call_get_content(content_id, block_identifier='latest'):
+    """
+    Async counterpart of blockchain_routes.call_get_content.
+    """
+    return await singleflight.chain_reads.do_async(
+        ("content", content_id, block_identifier),
+        lambda: async_contract.functions.getContent(content_id).call(block_identifier=block_identifier)
+    )
+
+
+async def lookup_content_id(content_id, block_identifier='latest'):
+    """
+    Async counterpart of blockchain_routes.lookup_content_id.
+    """
+    try:
+        content = await call_get_content(content_id, block_identifier)
+        return format_content(content, content_id), 200
+    except ContractLogicError:
+        return {"exists": False, "message": "Content ID not found on blockchain."}, 200
+    except Exception as e:
+        return {"error": str(e)}, 500
+
+
+def _immutable_response(request, payload):
+    """
+    Async counterpart of blockchain_routes.immutable_response.
+    """
+    response = web.json_response(payload)
+    etag = body_etag(response.body)
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        response = web.Response(status=304)
+    response.etag = etag
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
+
+
+async def _block_cached_response(request, build):
+    """
+    Async counterpart of blockchain_routes.block_cached_response; build is a coroutine function.
+    """
+    try:
+        block = await async_web3.eth.get_block('latest')
+    except Exception as e:
+        return _json_error(str(e), 500)
+
+    etag = block_etag(block)
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        response = web.Response(status=304)
+    else:
+        payload, status = await build(block['number'])
+        response = web.json_response(payload, status=status)
+        if status != 200:
+            return response
+    response.etag = etag
+    response.headers['Cache-Control'] = BLOCK_CACHE_CONTROL
+    return response
+
+
+async def check_image_hash(request):
+    image_hash = request.query.get('image_hash')
+    if not image_hash:
+        return _json_error("Image hash required", 400)
+    return await _block_cached_response(
+        request, lambda block_number: lookup_image_hash(request.app, image_hash, block_number)
+    )
+
+
+async def store_metadata(request):
+    try:
+        data = await request.json()
+        signed_tx = data.get("signed_tx")
+        if not signed_tx:
+            return _json_error("Signed transaction required", 400)
+        if not signed_tx.startswith("0x"):
+            return _json_error("Invalid signed transaction format", 400)
+
+        tx_hash = await async_web3.eth.send_raw_transaction(bytes.fromhex(signed_tx[2:]))
+        content_filter.invalidate()  # the transaction may register a hash
+        return web.json_response({"transaction_hash": tx_hash.hex()})
+    except Exception as e:
+        return _json_error(str(e), 500)
+
+
+async def get_content(request):
+    content_id = request.query.get('content_id')
+    if not content_id:
+        return _json_error("Content ID required", 400)
+    try:
+        content = await call_get_content(int(content_id))
+        return _immutable_response(request, format_content(content))
+    except Exception as e:
+        return _json_error(str(e), 500)
+
+
+async def get_user_content(request):
+    user_address = request.query.get('user_address')
+    if not user_address:
+        return _json_error("User address required", 400)
+    details = request.query.get('details', '').lower() in ('1', 'true')
+
+    async def build(block_number):
+        try:
+            content_ids = await async_contract.functions.getUserContents(
+                AsyncWeb3.to_checksum_address(user_address)
+            ).call(block_identifier=block_number)
+            response = {"content_ids": content_ids}
+            if details:
+                response["contents"] = []
+                for k in range(0, len(content_ids), MAX_PAGE_SIZE):
+                    ids = content_ids[k:k + MAX_PAGE_SIZE]
+                    contents = await async_contract.functions.getContents(ids).call(block_identifier=block_number)
+                    response["contents"] += format_contents(contents, ids)
+            return response, 200
+        except Exception as e:
+            return {"error": str(e)}, 500
+
+    return await _block_cached_response(request, build)
+
+
+async def get_contents(request):
+    try:
+        ids = [int(i) for i in request.query.get('ids', '').split(',') if i.strip()]
+        if len(ids) > MAX_PAGE_SIZE:
+            return _json_error(f"At most {MAX_PAGE_SIZE} IDs per request", 400)
+        start, count = parse_page(request.query)
+    except ValueError as e:
+        return _json_error(f"Invalid parameter: {str(e)}", 400)
+
+    try:
+        if ids:
+            contents = await async_contract.functions.getContents(ids).call()
+            return _immutable_response(request, {"contents": format_contents(contents, ids)})
+
+        contents = await async_contract.functions.getContentsRange(start, count).call()
+        payload = {
+            "contents": format_contents(contents, range(start, start + len(contents))),
+            "next_start": start + len(contents) if len(contents) == count else None
+        }
+        if len(contents) == count:
+            return _immutable_response(request, payload)
+        return web.json_response(payload)
+    except Exception as e:
+        return _json_error(str(e), 500)
+
+
+
+async def prepare_batch(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    items = data.get("items") if isinstance(data, dict) else None
+    if not items:
+        return _json_error("items required", 400)
+    try:
+        return web.json_response(await _run_cpu(request, build_batch, items))
+    except ValueError as e:
+        return _json_error(str(e), 400)
+    except Exception as e:
+        return _json_error(str(e), 500)
+
+
+async def batch_proof(request):
+    image_hash = request.query.get('image_hash')
+    if not image_hash:
+        return _json_error("Image hash required", 400)
+    try:
+        leaves = await batch_leaves_on_chain(request.app, image_hash)
+        if not leaves:
+            return _json_error("Image hash is not part of any batch.", 404)
+
+        found = None
+        for batch_id, leaf in leaves:
+            if await verify_leaf(batch_id, leaf):
+                found = (batch_id, leaf)
+                break
+        batch_id, leaf = found or leaves[0]
+        return web.json_response(dict(leaf, batch_id=batch_id or None, registered=batch_id != 0,
+                                      verified=found is not None))
+    except Exception as e:
+        return _json_error(str(e), 500)
+
+# --- IPFS ---
+
+async def upload_file_ipfs(request):
+    form = await request.post()
+    upload = form.get('file')
+    if upload is None or not isinstance(upload, web.FileField):
+        return _json_error("No file provided", 400)
+
+    headers = {
+        'pinata_api_key': PINATA_API_KEY,
+        'pinata_secret_api_key': PINATA_API_SECRET
+    }
+    body = aiohttp.FormData()
+    body.add_field('file', upload.file, filename=upload.filename, content_type=upload.content_type)
+    try:
+        async with request.app[http_session_key].post(PINATA_BASE_URL, headers=headers, data=body) as response:
+            if response.status != 200:
+                raise Exception(f"Failed to upload to Pinata: {await response.text()}")
+            return web.json_response({"ipfs_hash": (await response.json()).get('IpfsHash')})
+    except Exception as e:
+        return _json_error(str(e), 500)
+
+
+class CidFileResponse(web.FileResponse):
+    """
+    FileResponse tagged with the CID of its content, like the Flask route's
+    send_file(etag=cid), instead of aiohttp's mtime-size ETag.
+    """
+
+    def __init__(self, path, cid, **kwargs):
+        super().__init__(path, **kwargs)
+        self._cid = cid
+
+    @property
+    def etag(self):
+        return web.FileResponse.etag.fget(self)
+
+    @etag.setter
+    def etag(self, value):
+        web.FileResponse.etag.fset(self, self._cid)
+
+
+async def get_ipfs_content(request):
+    cid = request.match_info['cid']
+    # A CID names its content, so it can be cached forever
+    headers = {'Cache-Control': 'public, max-age=31536000, immutable'}
+    try:
+        ipfs_cache.parse_cid(cid)
+        if etag_matches(request.headers.get('If-None-Match'), cid):
+            response = web.Response(status=304, headers=headers)
+            response.etag = cid
+            return response
+        # Downloads block a thread of the default executor; concurrent misses share one download
+        path = await asyncio.get_running_loop().run_in_executor(None, ipfs_cache.cache.get, cid)
+        return CidFileResponse(path, cid, headers=dict(headers, **{
+            'Content-Type': 'application/octet-stream',
+            'Content-Disposition': f'inline; filename={cid}'
+        }))
+    except InvalidCid as e:
+        return _json_error(str(e), 400)
+    except ContentNotFound as e:
+        return _json_error(str(e), 404)
+    except GatewayError as e:
+        return _json_error(str(e), 502)
+    except Exception as e:
+        return _json_error(str(e), 500)
+
+
+# --- Watermarking ---
+
+async def check_image(request):
+    scratch_files = scratch.scope()
+    try:
+        admission.cpu.check()  # shed before the upload is read
+        temp_input, form = await _save_upload(request, 'image', scratch_files)
+        if temp_input is None:
+            return _json_error("No image file provided", 400)
+        if temp_input == '':
+            return _json_error("No selected image file", 400)
+
+        # Without a key, the tenant key the image carries (see check_key)
+        try:
+            key = int(form['key']) if form.get('key') else None
+        except ValueError as e:
+            return _json_error(f"Invalid parameter: {str(e)}", 400)
+        localize = form.get('localize', '').lower() in ('1', 'true')
+
+        upload_hash = await asyncio.get_running_loop().run_in_executor(None, calculate_image_hash, temp_input)
+
+        async def run_check():
+            async with admission.cpu.admit_async(admission.image_cost(temp_input, "check_image")):
+                return await _run_cpu(request, check_upload, temp_input, key, 7.25, 0.3, localize, upload_hash)
+
+        response_data = await singleflight.uploads.do_async(("check_image", upload_hash, key, localize), run_check)
+
+        content_id, image_hash = response_data["content_id"], response_data["image_hash"]
+        verified = None
+        if content_id is not None:
+            bc_json, bc_status = await lookup_content_id(content_id)
+            verified = bc_status == 200 and bc_json.get("exists", False) and await _run_cpu(
+                request, payload_record_matches, bc_json, content_id, image_hash)
+        if not verified:
+            # No payload, or its ID belongs to another registration: look the hash up instead
+            bc_json, bc_status = await lookup_image_hash(request.app, image_hash)
+        response_data["content_id_verified"] = verified
+        if bc_status == 200 and bc_json.get("exists", False):
+            blockchain_data = bc_json
+        elif bc_status != 200:
+            return _json_error(f"Blockchain lookup failed: {bc_json}", 500)
+        else:
+            blockchain_data = None
+
+        response_data["blockchain_data"] = blockchain_data
+        return web.json_response(response_data)
+    except MemoryBudgetExceeded as e:
+        return _json_error(str(e), 413)
+    except ScratchQuotaExceeded as e:
+        return _json_error(str(e), 507)
+    except Overloaded as e:
+        return _overloaded(e)
+    except Exception as e:
+        logger.exception("Error in /check_image route")
+        return _json_error(f"An error occurred: {str(e)}", 500)
+    finally:
+        scratch_files.close()
+
+
+async def embed(request):
+    scratch_files = scratch.scope()
+    try:
+        admission.cpu.check()
+        input_path, form = await _save_upload(request, 'image', scratch_files)
+        if input_path is None:
+            return _json_error("No image file provided", 400)
+        if input_path == '':
+            return _json_error("No selected image file", 400)
+
+        key = int(form.get('key', DEFAULT_KEY))
+        content_id = int(form['content_id']) if form.get('content_id') else None
+        profile = form.get('profile') or None
+        output_path = scratch_files.path(output_format(input_path, profile)[0], os.path.getsize(input_path))
+        async with admission.cpu.admit_async(admission.image_cost(input_path, "embed")):
+            result = await _run_cpu(request, partial(embed_upload, output_path=output_path, content_id=content_id,
+                                                     profile=profile), input_path, key)
+        scratch_files.written(output_path)
+        if result["encode_seconds"] is not None:
+            # Encoded in a worker process, whose counters this process cannot see
+            encoders.record(result["profile"], result["encode_seconds"], result["output_bytes"],
+                            result["width"] * result["height"] / 1e6)
+
+        body = await _read_file(result["output_path"])
+        headers = embed_headers(result)
+        headers['Content-Disposition'] = f'attachment; filename=watermarked{result["suffix"]}'
+        return web.Response(body=body, content_type=result["mimetype"], headers=headers)
+    except ValueError as e:
+        return _json_error(f"Invalid parameter: {str(e)}", 400)
+    except MemoryBudgetExceeded as e:
+        return _json_error(str(e), 413)
+    except ScratchQuotaExceeded as e:
+        return _json_error(str(e), 507)
+    except Overloaded as e:
+        return _overloaded(e)
+    except Exception as e:
+        return _json_error(f"An error occurred: {str(e)}", 500)
+    finally:
+        scratch_files.close()
+
+
+async def verify(request):
+    scratch_files = scratch.scope()
+    try:
+        admission.cpu.check()
+        input_path, form = await _save_upload(request, 'image', scratch_files)
+        if input_path is None:
+            return _json_error("No image file provided", 400)
+        if input_path == '':
+            return _json_error("No selected image file", 400)
+
+        key, delta = form.get('key'), form.get('delta')
+        if key is None:
+            return _json_error("'key' is required", 400)
+        try:
+            key = int(key)
+            delta = float(delta) if delta is not None else None
+        except ValueError as e:
+            return _json_error(f"Invalid parameter: {str(e)}", 400)
+        localize = form.get('localize', '').lower() in ('1', 'true')
+
+        upload_hash = await asyncio.get_running_loop().run_in_executor(None, calculate_image_hash, input_path)
+
+        async def run_verify():
+            async with admission.cpu.admit_async(admission.image_cost(input_path, "verify")):
+                return await _run_cpu(request, verify_upload, input_path, key, delta, localize, upload_hash)
+
+        return web.json_response(await singleflight.uploads.do_async(
+            ("verify", upload_hash, key, delta, localize), run_verify
+        ))
+    except DeltaRequired as e:
+        return _json_error(str(e), 400)
+    except MemoryBudgetExceeded as e:
+        return _json_error(str(e), 413)
+    except ScratchQuotaExceeded as e:
+        return _json_error(str(e), 507)
+    except Overloaded as e:
+        return _overloaded(e)
+    except Exception as e:
+        return _json_error(f"An error occurred: {str(e)}", 500)
+    finally:
+        scratch_files.close()
+
+
+async def triage(request):
+    scratch_files = scratch.scope()
+    try:
+        admission.cpu.check()
+        input_path, form = await _save_upload(request, 'image', scratch_files)
+        if input_path is None:
+            return _json_error("No image file provided", 400)
+        if input_path == '':
+            return _json_error("No selected image file", 400)
+
+        key = int(form.get('key', DEFAULT_KEY))
+        async with admission.cpu.admit_async(admission.image_cost(input_path, "triage")):
+            result = await _run_cpu(request, triage_upload, input_path, key)
+        if result["escalated"]:
+            async with admission.cpu.admit_async(admission.image_cost(input_path, "verify")):
+                result.update(await _run_cpu(request, escalate_upload, input_path, key))
+        return web.json_response(result)
+    except ValueError as e:
+        return _json_error(f"Invalid parameter: {str(e)}", 400)
+    except MemoryBudgetExceeded as e:
+        return _json_error(str(e), 413)
+    except ScratchQuotaExceeded as e:
+        return _json_error(str(e), 507)
+    except Overloaded as e:
+        return _overloaded(e)
+    except Exception as e:
+        return _json_error(f"An error occurred: {str(e)}", 500)
+    finally:
+        scratch_files.close()
+
+
+
+def _deltas(form):
+    """The request's delta, or the range /check_image sweeps."""
+    if form.get('delta'):
+        return [float(form['delta'])]
+    return sweep_deltas()
+
+
+async def detect_keys_route(request):
+    scratch_files = scratch.scope()
+    try:
+        admission.cpu.check()
+        input_path, form = await _save_upload(request, 'image', scratch_files)
+        if input_path is None:
+            return _json_error("No image file provided", 400)
+        if input_path == '':
+            return _json_error("No selected image file", 400)
+
+        keys = [int(k) for k in form.get('keys', '').split(',') if k.strip()] or TENANT_KEYS
+        if not keys:
+            return _json_error("No candidate keys provided", 400)
+        deltas = _deltas(form)
+        versions = FORMAT_VERSIONS if form.get('legacy') == '1' else DETECT_VERSIONS
+        async with admission.cpu.admit_async(admission.image_cost(input_path, "detect_keys")):
+            result = await _run_cpu(request, detect_keys_upload, input_path, keys, deltas, versions, 0.3)
+        return web.json_response(result)
+    except ValueError as e:
+        return _json_error(f"Invalid parameter: {str(e)}", 400)
+    except ScratchQuotaExceeded as e:
+        return _json_error(str(e), 507)
+    except Overloaded as e:
+        return _overloaded(e)
+    except Exception as e:
+        logger.exception("Error in /detect_keys route")
+        return _json_error(f"An error occurred: {str(e)}", 500)
+    finally:
+        scratch_files.close()
+
+
+async def resync(request):
+    scratch_files = scratch.scope()
+    try:
+        admission.cpu.check()
+        input_path, form = await _save_upload(request, 'image', scratch_files)
+        if input_path is None:
+            return _json_error("No image file provided", 400)
+        if input_path == '':
+            return _json_error("No selected image file", 400)
+
+        key = int(form.get('key', DEFAULT_KEY))
+        max_origin = int(form.get('max_origin', 32))
+        deltas = _deltas(form)
+        if form.get('original_width') and form.get('original_height'):
+            dimensions = [(int(form['original_width']), int(form['original_height']))]
+        else:
+            dimensions = await _run_cpu(request, recorded_dimensions, key)
+        if not dimensions:
+            return _json_error("Original dimensions unknown; pass original_width and original_height", 400)
+
+        async with admission.cpu.admit_async(admission.image_cost(input_path, "resync")):
+            best = await _run_cpu(request, resync_upload, input_path, key, deltas, dimensions, max_origin, 0.3)
+        if best is None:
+            return _json_error("Image is larger than every candidate original", 400)
+        return web.json_response(best)
+    except ValueError as e:
+        return _json_error(f"Invalid parameter: {str(e)}", 400)
+    except ScratchQuotaExceeded as e:
+        return _json_error(str(e), 507)
+    except Overloaded as e:
+        return _overloaded(e)
+    except Exception as e:
+        logger.exception("Error in /resync route")
+        return _json_error(f"An error occurred: {str(e)}", 500)
+    finally:
+        scratch_files.close()
+
+
+async def embed_audio_route(request):
+    scratch_files = scratch.scope()
+    try:
+        admission.cpu.check()
+        input_path, form = await _save_upload(request, 'audio', scratch_files, '.wav')
+        if input_path is None:
+            return _json_error("No audio file provided", 400)
+        if input_path == '':
+            return _json_error("No selected audio file", 400)
+
+        key = int(form.get('key', DEFAULT_KEY))
+        delta = float(form['delta']) if form.get('delta') else None
+        output_path = scratch_files.path('.wav', os.path.getsize(input_path))
+        async with admission.cpu.admit_async(admission.audio_cost(input_path, "audio_embed")):
+            result = await _run_cpu(request, audio.embed_audio, input_path, output_path, key, delta)
+        scratch_files.written(output_path)
+
+        body = await _read_file(output_path)
+        return web.Response(body=body, content_type='audio/wav', headers={
+            'Content-Disposition': 'attachment; filename=watermarked.wav',
+            'X-Delta': str(result["delta"]),
+            'X-Key-Id': key_fingerprint(key),
+            'X-Audio-Frames': str(result["frames"]),
+            'Access-Control-Expose-Headers': 'X-Delta, X-Key-Id, X-Audio-Frames'
+        })
+    except ValueError as e:
+        return _json_error(f"Invalid parameter: {str(e)}", 400)
+    except ScratchQuotaExceeded as e:
+        return _json_error(str(e), 507)
+    except Overloaded as e:
+        return _overloaded(e)
+    except Exception as e:
+        logger.exception("Error in /embed_audio route")
+        return _json_error(f"An error occurred: {str(e)}", 500)
+    finally:
+        scratch_files.close()
+
+
+async def detect_audio_route(request):
+    scratch_files = scratch.scope()
+    try:
+        admission.cpu.check()
+        input_path, form = await _save_upload(request, 'audio', scratch_files, '.wav')
+        if input_path is None:
+            return _json_error("No audio file provided", 400)
+        if input_path == '':
+            return _json_error("No selected audio file", 400)
+
+        key = int(form.get('key', DEFAULT_KEY))
+        delta = float(form['delta']) if form.get('delta') else None
+        async with admission.cpu.admit_async(admission.audio_cost(input_path, "audio_detect")):
+            result = await _run_cpu(request, audio.detect_audio, input_path, key, delta)
+        return web.json_response(result)
+    except ValueError as e:
+        return _json_error(f"Invalid parameter: {str(e)}", 400)
+    except ScratchQuotaExceeded as e:
+        return _json_error(str(e), 507)
+    except Overloaded as e:
+        return _overloaded(e)
+    except Exception as e:
+        logger.exception("Error in /detect_audio route")
+        return _json_error(f"An error occurred: {str(e)}", 500)
+    finally:
+        scratch_files.close()
+
+# --- Metrics ---
+
+async def metrics(request):
+    return web.json_response({"scratch": scratch.store.metrics(), "admission": admission.metrics(),
+                              "registry_filter": content_filter.metrics(), "encoders": encoders.metrics(),
+                              "ipfs_cache": ipfs_cache.cache.metrics(), "singleflight": singleflight.metrics()})
+
+
+# --- Application ---
+
+@web.middleware
+async def cors_middleware(request, handler):
+    if request.method == 'OPTIONS':
+        response = web.Response()
+    else:
+        response = await handler(request)
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Access-Control-Allow-Headers'] = '*'
+    response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
+    return response
+
+
+@web.middleware
+async def admission_middleware(request, handler):
+    """
+    Blockchain and IPFS requests each get their own concurrency budget;
+    watermark handlers are admitted by cost inside the handler.
+    """
+    if request.path.startswith('/api/blockchain/'):
+        gate = admission.chain
+    elif request.path.startswith('/api/ipfs/'):
+        gate = admission.ipfs
+    else:
+        return await handler(request)
+    try:
+        async with gate.admit_async():
+            return await handler(request)
+    except Overloaded as e:
+        return _overloaded(e)
+
+
+async def _resources(app):
+    app[cpu_pool_key] = ProcessPoolExecutor(max_workers=CPU_WORKERS, initializer=_init_worker)
+    app[http_session_key] = aiohttp.ClientSession()
+    yield
+    await app[http_session_key].close()
+    app[cpu_pool_key].shutdown(wait=False, cancel_futures=True)
+
+
+def flask_routes():
+    """
+    (method, path) of every API route of app.py, paths in aiohttp's syntax.
+    """
+    from app import app as flask_app
+    return {(method, re.sub(r"<(?:\w+:)?(\w+)>", r"{\1}", rule.rule))
+            for rule in flask_app.url_map.iter_rules() if rule.endpoint != 'static'
+            for method in rule.methods - {'HEAD', 'OPTIONS'}}
+
+
+def missing_routes(app):
+    """
+    Routes of app.py that app does not serve (empty when the servers agree).
+    """
+    served = {(route.method, route.resource.canonical) for route in app.router.routes()}
+    return sorted(flask_routes() - served)
+
+
+def create_app(argv=None):
+    app = web.Application(middlewares=[cors_middleware, admission_middleware], client_max_size=100 * 1024 * 1024)
+    app.cleanup_ctx.append(_resources)
+    app.add_routes([
+        web.post('/api/watermark/check_image', check_image),
+        web.post('/api/watermark/embed', embed),
+        web.post('/api/watermark/verify', verify),
+        web.post('/api/watermark/triage', triage),
+        web.post('/api/watermark/detect_keys', detect_keys_route),
+        web.post('/api/watermark/resync', resync),
+        web.post('/api/watermark/embed_audio', embed_audio_route),
+        web.post('/api/watermark/detect_audio', detect_audio_route),
+        web.post('/api/ipfs/upload_ipfs', upload_file_ipfs),
+        web.get('/api/ipfs/content/{cid}', get_ipfs_content),
+        web.get('/api/blockchain/check_image_hash', check_image_hash),
+        web.post('/api/blockchain/store_metadata', store_metadata),
+        web.get('/api/blockchain/get_content', get_content),
+        web.get('/api/blockchain/get_user_content', get_user_content),
+        web.get('/api/blockchain/get_contents', get_contents),
+        web.post('/api/blockchain/prepare_batch', prepare_batch),
+        web.get('/api/blockchain/batch_proof', batch_proof),
+        web.get('/api/metrics', metrics),
+    ])
+    # Both servers must serve the same API; fail at startup rather than with 404s
+    missing = missing_routes(app)
+    if missing:
+        raise RuntimeError(f"async_app does not serve these routes of app.py: {missing}")
+    return app
+
+
+if __name__ == "__main__":
+    web.run_app(create_app(), port=int(os.getenv("PORT", "5000")))
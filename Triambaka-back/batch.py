@@ -0,0 +1,285 @@
+"""
+Offline batch watermarking of directory trees, without the HTTP server.
+
+    python batch.py embed archive/ marked/ --key 12345 --workers 8 --report marked/report.csv
+    python batch.py embed archive/ marked-web/ --profile webp-lossless
+    python batch.py verify marked/ --key 12345 --report verify.jsonl
+
+Uses the same engine as the API (embed_upload / verify_upload, including the
+JPEG coefficient path and the embed registry). Every finished file is appended
+to a JSONL manifest; re-running the same command skips files whose manifest
+entry still matches the input and the run's parameters (key, delta, threshold,
+profile, format version; for embed, also the output, which must still exist),
+so an interrupted run resumes where it stopped. Manifest entries and report
+rows are streamed to disk, so memory does not grow with the tree.
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.webp'}
+REPORT_FIELDS = ['path', 'output', 'status', 'image_hash', 'delta', 'ber', 'format_version', 'width', 'height',
+                 'profile', 'output_bytes', 'encode_seconds', 'verified_by', 'seconds', 'error']
+
+_options = None
+
+
+def _registry_app():
+    from flask import Flask
+
+    app = Flask(__name__)
+    app.config.from_object("config.Config")
+    return app
+
+
+def _init_worker(options):
+    """
+    Runs once in each worker: the registry needs a Flask app context. The
+    tables already exist (created by run), so workers only bind the session.
+    """
+    global _options
+    _options = options
+    from database import db
+    import models  # noqa: F401
+
+    app = _registry_app()
+    db.init_app(app)
+    app.app_context().push()
+
+
+def _process(job):
+    """
+    Embeds into or verifies one file. Returns a report row; errors are reported
+    per file instead of stopping the run.
+    """
+    import cv2
+    from routes.watermark import embed_upload
+    from routes.verify import verify_upload
+
+    rel_path, input_path, output_path, stat = job
+    row = {'path': rel_path, 'output': output_path, 'size': stat[0], 'mtime_ns': stat[1],
+           'params': _options['params']}
+    start = time.perf_counter()
+    try:
+        if not cv2.haveImageReader(input_path):
+            raise ValueError("not a readable image")
+        if _options['command'] == 'embed':
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            result = embed_upload(input_path, _options['key'], _options['delta'], _options['threshold'],
+                                  output_path=output_path, record=_options['record'], profile=_options['profile'])
+            row.update({k: result[k] for k in ('image_hash', 'delta', 'ber', 'format_version', 'width', 'height',
+                                               'profile', 'encode_seconds', 'output_bytes')})
+        else:
+            row.update(verify_upload(input_path, _options['key'], _options['delta']))
+        row['status'] = 'ok'
+    except Exception as e:
+        row.update({'status': 'failed', 'error': str(e)})
+    row['seconds'] = round(time.perf_counter() - start, 4)
+    return row
+
+
+def find_images(root):
+    """
+    Yields paths of image files under root, relative to it, in a stable order.
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                yield os.path.relpath(os.path.join(dirpath, name), root)
+
+
+class Manifest:
+    """
+    The JSONL manifest of a run. Only the offset of the latest entry per input
+    path is kept in memory; entries are read back from the file when planning.
+    A torn last line from a crash is ignored (and terminated before appending).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.offsets = {}
+        with open(path, 'a+b') as f:
+            f.seek(0)
+            offset, line = 0, b''
+            for line in f:
+                try:
+                    self.offsets[json.loads(line)['path']] = offset
+                except ValueError:
+                    pass
+                offset += len(line)
+            if line and not line.endswith(b'\n'):
+                f.write(b'\n')
+        self._reader = open(path, 'rb')
+        self._writer = open(path, 'a')
+
+    def get(self, rel_path):
+        """Latest entry for an input path, or None."""
+        offset = self.offsets.get(rel_path)
+        if offset is None:
+            return None
+        self._reader.seek(offset)
+        return json.loads(self._reader.readline())
+
+    def append(self, row):
+        self._writer.write(json.dumps(row) + '\n')
+        self._writer.flush()  # progress survives a crash
+
+    def close(self):
+        self._reader.close()
+        self._writer.close()
+
+
+def job_params(args):
+    """
+    The parameters a run's results depend on, stored with every manifest entry:
+    an entry made under different ones is not up to date.
+    """
+    from models import key_fingerprint
+    from watermark_engine import FORMAT_VERSION, encoders
+    from watermark_engine.core import TRIAGE_LAYER
+
+    params = {'key_id': key_fingerprint(args.key), 'delta': args.delta, 'format_version': FORMAT_VERSION}
+    if args.command == 'embed':
+        params.update({'threshold': args.threshold, 'profile': args.profile or encoders.DEFAULT_PROFILE,
+                       'triage_layer': TRIAGE_LAYER, 'record': not args.no_record})
+    return params
+
+
+def _output_path(args, rel_path, input_path):
+    from routes.watermark import output_format
+
+    suffix, _ = output_format(input_path, args.profile)
+    return os.path.join(args.output, os.path.splitext(rel_path)[0] + suffix)
+
+
+def plan_jobs(args, manifest, params, skip):
+    """
+    Yields (rel_path, input_path, output_path, (size, mtime_ns)) for every file
+    that is not up to date in the manifest; up-to-date entries are passed to skip.
+    """
+    for rel_path in find_images(args.input):
+        input_path = os.path.join(args.input, rel_path)
+        stat = os.stat(input_path)
+        output_path = _output_path(args, rel_path, input_path) if args.command == 'embed' else None
+        entry = manifest.get(rel_path)
+        if (entry is not None and entry['status'] == 'ok' and entry['size'] == stat.st_size
+                and entry['mtime_ns'] == stat.st_mtime_ns and entry.get('params') == params
+                and entry['output'] == output_path
+                and (args.command == 'verify' or os.path.exists(output_path))):
+            skip(entry)
+            continue
+        yield rel_path, input_path, output_path, (stat.st_size, stat.st_mtime_ns)
+
+
+@contextmanager
+def report_writer(path):
+    """
+    Yields a function that appends a row to the report, CSV or JSONL by the
+    file extension (rows are in the order files finish). It may be called from
+    several threads. Without a path rows are dropped.
+    """
+    if not path:
+        yield lambda row: None
+        return
+    lock = threading.Lock()
+    with open(path, 'w', newline='') as f:
+        if path.endswith('.csv'):
+            writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            write = writer.writerow
+        else:
+            def write(row):
+                f.write(json.dumps({k: row.get(k) for k in REPORT_FIELDS}) + '\n')
+
+        def write_row(row):
+            with lock:
+                write(row)
+
+        yield write_row
+
+
+def run(args):
+    if args.command == 'embed':
+        os.makedirs(args.output, exist_ok=True)
+        manifest_path = args.manifest or os.path.join(args.output, 'manifest.jsonl')
+    else:
+        manifest_path = args.manifest or os.path.join(args.input, 'verify-manifest.jsonl')
+
+    from database import init_db
+    init_db(_registry_app())  # create the registry tables once, before the workers start
+
+    manifest = Manifest(manifest_path)
+    params = job_params(args)
+    options = {'command': args.command, 'key': args.key, 'delta': args.delta, 'threshold': args.threshold,
+               'record': not args.no_record, 'profile': args.profile, 'params': params}
+    counts = {'ok': 0, 'failed': 0, 'skipped': 0}
+
+    start = time.perf_counter()
+    megapixels = 0.0
+    with report_writer(args.report) as report:
+        def skip(entry):
+            # Called from the pool's task thread as it plans ahead
+            counts['skipped'] += 1
+            report(entry)
+
+        try:
+            with multiprocessing.Pool(args.workers, initializer=_init_worker, initargs=(options,)) as pool:
+                jobs = plan_jobs(args, manifest, params, skip)
+                for row in pool.imap_unordered(_process, jobs, chunksize=args.chunksize):
+                    manifest.append(row)
+                    report(row)
+                    counts[row['status']] += 1
+                    if row['status'] == 'ok' and row.get('width'):
+                        megapixels += row['width'] * row['height'] / 1e6
+                    elif row['status'] != 'ok':
+                        print(f"FAILED {row['path']}: {row['error']}")
+        finally:
+            manifest.close()
+    elapsed = time.perf_counter() - start
+
+    done, failed = counts['ok'], counts['failed']
+    rate = done / elapsed if elapsed > 0 else 0.0
+    print(f"{args.command}: {done} processed, {counts['skipped']} up to date, {failed} failed in {elapsed:.1f}s "
+          f"({rate:.2f} files/s, {megapixels / elapsed if elapsed > 0 else 0.0:.2f} MP/s, {args.workers} workers)")
+    return 1 if failed else 0
+
+
+def main():
+    from watermark_engine.encoders import PROFILES
+
+    parser = argparse.ArgumentParser(description="Batch watermark embedding and verification")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    embed = sub.add_parser('embed', help="Watermark every image under INPUT into OUTPUT (same tree)")
+    embed.add_argument('input')
+    embed.add_argument('output')
+    embed.add_argument('--delta', type=float, default=7.25)
+    embed.add_argument('--threshold', type=float, default=0.3)
+    embed.add_argument('--no-record', action='store_true', help="Do not record embeds in the registry")
+    embed.add_argument('--profile', choices=list(PROFILES),
+                       help="Output encoder profile (default: JPEGs stay JPEGs, the rest use WATERMARK_OUTPUT_PROFILE)")
+
+    verify = sub.add_parser('verify', help="Verify every image under INPUT against a key")
+    verify.add_argument('input')
+    verify.add_argument('--delta', type=float, default=None,
+                        help="Delta for images not in the embed registry")
+    verify.set_defaults(threshold=None, no_record=True, profile=None)
+
+    for command in (embed, verify):
+        command.add_argument('--key', type=int, default=12345)
+        command.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+        command.add_argument('--chunksize', type=int, default=4)
+        command.add_argument('--manifest', help="Progress manifest (JSONL); defaults to one inside the tree")
+        command.add_argument('--report', help="Per-file report, .csv or .jsonl")
+
+    return run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
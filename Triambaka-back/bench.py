@@ -0,0 +1,409 @@
+"""
+Benchmarks for the watermark engine.
+
+    python bench.py memory img/input.png --dtype float32 --budget-mb 32
+    python bench.py precision img/input.png img/input2.jpg
+    python bench.py resync img/input.png --crop 101 77
+    python bench.py parallel img/input.png --workers 1 2 4 8
+    python bench.py encode img/input.png --profiles png png-fast webp-lossless jpeg-hq
+    python bench.py matrix img/ --deltas 5 7.25 10 14 --jpeg 90 75 --target 0.95 --csv matrix.csv
+"""
+import argparse
+import csv
+import multiprocessing
+import os
+import resource
+import time
+
+import cv2
+import numpy as np
+
+from batch import find_images
+from watermark_engine import (process_frame, estimate_peak_bytes, choose_strategy, MemoryBudgetExceeded,
+                              block_dct, frame_ber, key_tables, qim_bits, qim_votes, resync_search, FORMAT_VERSION,
+                              PROFILES)
+from watermark_engine import encoders
+
+# Largest BER difference accepted between the float32 and float64 paths.
+FLOAT32_BER_TOLERANCE = 0.01
+
+
+def _peak_rss_bytes():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _measure_memory(path, mode, key, delta, dtype, budget, queue):
+    img = cv2.imread(path)
+    # Warm up lazily-initialized library state so it is not counted.
+    process_frame(img[:64, :64].copy(), key, delta, mode=mode, dtype=dtype)
+    before = _peak_rss_bytes()
+    start = time.perf_counter()
+    process_frame(img, key, delta, mode=mode, dtype=dtype, memory_budget=budget)
+    elapsed = time.perf_counter() - start
+    queue.put((_peak_rss_bytes() - before, elapsed))
+
+
+def measure_memory(path, mode='embed', key=12345, delta=7.25, dtype='float64', budget=0):
+    """
+    Runs process_frame once in a fresh process and returns the growth of its
+    peak RSS (bytes) together with the elapsed time.
+    """
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_measure_memory, args=(path, mode, key, delta, dtype, budget, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def run_memory(args):
+    budget = int(args.budget_mb * 1024 * 1024)
+    print(f"{'image':<28}{'mode':<9}{'dtype':<9}{'strategy':<14}{'est MB':>9}{'peak MB':>9}{'MB/MP':>8}{'sec':>8}")
+    for path in args.images:
+        shape = cv2.imread(path).shape
+        megapixels = shape[0] * shape[1] / 1e6
+        for mode in ('embed', 'extract'):
+            try:
+                strategy, rows = choose_strategy(shape, mode, budget)
+            except MemoryBudgetExceeded as e:
+                print(f"{path[-27:]:<28}{mode:<9}{args.dtype:<9}{e}")
+                continue
+            label = strategy if rows is None else f"{strategy}({rows})"
+            estimate = estimate_peak_bytes(shape, mode, rows) / 2**20
+            peak, elapsed = measure_memory(path, mode, args.key, args.delta, args.dtype, budget)
+            print(f"{path[-27:]:<28}{mode:<9}{args.dtype:<9}{label:<14}{estimate:>9.1f}"
+                  f"{peak / 2**20:>9.1f}{peak / 2**20 / megapixels:>8.1f}{elapsed:>8.2f}")
+
+
+def precision_bers(img, key, delta, dtype_embed, version=None):
+    """
+    Embeds with dtype_embed and extracts with each precision. Returns the BER
+    per extraction dtype and the fraction of pixels that differ from a float64
+    embed.
+    """
+    marked, _, _ = process_frame(img, key, delta, mode='embed', dtype=dtype_embed, version=version)
+    bers = {}
+    for dtype_extract in ('float64', 'float32'):
+        _, expected, extracted = process_frame(marked, key, delta, mode='extract', dtype=dtype_extract,
+                                               version=version)
+        bers[dtype_extract] = np.mean(expected != extracted)
+    pixels = np.mean(marked != process_frame(img, key, delta, mode='embed', dtype='float64', version=version)[0])
+    return bers, pixels
+
+
+def run_precision(args):
+    """
+    Embeds with each precision and extracts with each precision, comparing the
+    BERs against the float64 reference.
+    """
+    failed = False
+    for path in args.images:
+        img = cv2.imread(path)
+        for dtype_embed in ('float64', 'float32'):
+            bers, pixels = precision_bers(img, args.key, args.delta, dtype_embed)
+            diff = abs(bers['float32'] - bers['float64'])
+            ok = diff <= FLOAT32_BER_TOLERANCE
+            failed |= not ok
+            print(f"{path}: embed={dtype_embed} BER64={bers['float64']:.4f} BER32={bers['float32']:.4f} "
+                  f"diff={diff:.4f} changed_pixels={pixels:.4%} {'OK' if ok else 'FAIL'}")
+    return 1 if failed else 0
+
+
+def run_resync(args):
+    """
+    Times a grid-resynchronized detection of a cropped copy against a normal
+    extraction of the uncropped watermarked image.
+    """
+    deltas = [args.delta + 0.25 * i for i in range(11)]
+    for path in args.images:
+        marked, _, _ = process_frame(cv2.imread(path), args.key, args.delta, mode='embed')
+        watermark_shape = ((marked.shape[0] + 7) // 8, (marked.shape[1] + 7) // 8)
+        key_tables(args.key, watermark_shape, FORMAT_VERSION)  # shared by both paths
+
+        start = time.perf_counter()
+        full_ber = frame_ber(marked, args.key, args.delta)
+        normal = time.perf_counter() - start
+
+        cy, cx = args.crop
+        cropped = marked[cy:, cx:]
+        naive_ber = frame_ber(cropped, args.key, args.delta)
+        start = time.perf_counter()
+        result = resync_search(cropped, args.key, deltas, watermark_shape)
+        elapsed = time.perf_counter() - start
+        print(f"{path}: full BER={full_ber:.4f} ({normal:.2f}s) crop={cy},{cx} naive BER={naive_ber:.4f} "
+              f"resync BER={result['ber']:.4f} crop_found={result['crop']} ({elapsed:.2f}s, {elapsed / normal:.1f}x)")
+
+
+def run_parallel(args):
+    """
+    Latency of a sharded process_frame per worker count, checking that the
+    output matches the serial path byte for byte.
+    """
+    failed = False
+    print(f"cores={os.cpu_count()}")
+    for path in args.images:
+        img = cv2.imread(path)
+        for mode in ('embed', 'extract'):
+            reference, serial = None, None
+            for workers in args.workers:
+                # Sharded whatever the image size (process_frame keeps small frames serial)
+                backend = "parallel" if workers > 1 else None
+                process_frame(img[:64, :64].copy(), args.key, args.delta, mode=mode, workers=workers,
+                              backend=backend)  # warm pool
+                start = time.perf_counter()
+                frame, _, extracted = process_frame(img, args.key, args.delta, mode=mode, workers=workers,
+                                                    backend=backend)
+                elapsed = time.perf_counter() - start
+                output = frame if mode == 'embed' else extracted
+                if reference is None:
+                    reference, serial = output, elapsed
+                same = np.array_equal(output, reference)
+                failed |= not same
+                print(f"{path}: {mode:<8}workers={workers:<3}{elapsed:>7.2f}s speedup={serial / elapsed:>5.2f}x "
+                      f"{'identical' if same else 'MISMATCH'}")
+    return 1 if failed else 0
+
+
+def run_encode(args):
+    """
+    Encode time, output size and post-encode BER of a watermarked frame for
+    each output profile (best of --repeat encodes).
+    """
+    print(f"{'image':<28}{'profile':<15}{'ms':>9}{'ms/MP':>9}{'KB':>10}{'bits/px':>9}{'BER':>8}")
+    for path in args.images:
+        marked, _, _ = process_frame(cv2.imread(path), args.key, args.delta, mode='embed')
+        megapixels = marked.shape[0] * marked.shape[1] / 1e6
+        for profile in args.profiles:
+            data, elapsed = min((encoders.encode_timed(marked, profile) for _ in range(args.repeat)),
+                                key=lambda result: result[1])
+            stored = marked if PROFILES[profile][3] else encoders.decode(data)
+            ber = frame_ber(stored, args.key, args.delta)
+            print(f"{path[-27:]:<28}{profile:<15}{elapsed * 1e3:>9.1f}{elapsed * 1e3 / megapixels:>9.1f}"
+                  f"{len(data) / 1024:>10.0f}{len(data) * 8 / (megapixels * 1e6):>9.2f}{ber:>8.4f}")
+
+
+# --- Robustness versus throughput matrix ---
+# One task per (image, dtype) embeds at every delta, applies every transform
+# and computes the block DCT of each transformed copy once; every vote rule
+# and threshold is then read from those coefficients. The unmarked original's
+# DCT gives the false-positive rate.
+
+def matrix_transforms(options):
+    """
+    (name, function of a BGR frame) for every transform of the matrix.
+    """
+    def jpeg(quality):
+        return lambda img: cv2.imdecode(cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality])[1],
+                                        cv2.IMREAD_COLOR)
+
+    def resize(scale):
+        # Down and back up to the original size, as a reposted copy is viewed
+        return lambda img: cv2.resize(cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA),
+                                      (img.shape[1], img.shape[0]), interpolation=cv2.INTER_LINEAR)
+
+    def noise(sigma):
+        return lambda img: np.clip(img + np.random.RandomState(0).normal(0, sigma, img.shape), 0, 255).astype(np.uint8)
+
+    transforms = [("none", lambda img: img)]
+    transforms += [(f"jpeg{q}", jpeg(q)) for q in options.jpeg]
+    transforms += [(f"resize{round(s * 100)}", resize(s)) for s in options.scales]
+    transforms += [(f"noise{g:g}", noise(g)) for g in options.noise]
+    if options.crop:
+        cy, cx = options.crop
+        transforms.append((f"crop{cy},{cx}", lambda img: img[cy:, cx:]))
+    return transforms
+
+
+def _aligned_block_dct(frame, key, delta, watermark_shape, dtype):
+    """
+    Block DCT of a frame and the (rows, cols) slices of the original block grid
+    its blocks are; frames whose grid differs (crops) are located with
+    resync_search first.
+    """
+    y = cv2.cvtColor(frame, cv2.COLOR_BGR2YCrCb)[:, :, 0]
+    h, w = y.shape
+    dy, dx, i0, j0 = 0, 0, 0, 0
+    if ((h + 7) // 8, (w + 7) // 8) != tuple(watermark_shape):
+        found = resync_search(frame, key, [delta], watermark_shape, dtype=dtype)
+        (dy, dx), (i0, j0) = found["offset"], found["origin"]
+        y = y[dy:, dx:]
+        h, w = y.shape
+        h, w = min(h // 8, watermark_shape[0] - i0) * 8, min(w // 8, watermark_shape[1] - j0) * 8
+        y = y[:h, :w]
+    y = cv2.copyMakeBorder(y, 0, (8 - h % 8) % 8, 0, (8 - w % 8) % 8, cv2.BORDER_REFLECT)
+    return block_dct(y, dtype), (slice(i0, i0 + y.shape[0] // 8), slice(j0, j0 + y.shape[1] // 8))
+
+
+def _vote_ber(coeffs, positions, expected, delta, votes):
+    """
+    BER of the watermark read with votes of the 3 embedding positions: 3 is
+    process_frame's majority vote, 1 reads the first position only.
+    """
+    gathered = coeffs[np.arange(coeffs.shape[0])[:, None], positions]
+    bits = qim_votes(gathered, delta) if votes == 3 else qim_bits(gathered[:, 0], delta)
+    return float(np.mean(bits != expected))
+
+
+def _matrix_task(task):
+    """
+    Every delta, transform and vote rule of one image at one dtype. Returns
+    report rows.
+    """
+    path, dtype, options = task
+    img = cv2.imread(path)
+    megapixels = img.shape[0] * img.shape[1] / 1e6
+    watermark_shape = ((img.shape[0] + 7) // 8, (img.shape[1] + 7) // 8)
+    positions, expected = key_tables(options.key, watermark_shape, FORMAT_VERSION)
+    positions = positions.reshape(*watermark_shape, 3)
+    expected = expected.reshape(watermark_shape)
+    process_frame(img[:64, :64].copy(), options.key, options.deltas[0], mode='embed', dtype=dtype)  # warm up
+    unmarked, _ = _aligned_block_dct(img, options.key, options.deltas[0], watermark_shape, dtype)
+
+    rows = []
+    for delta in options.deltas:
+        start = time.perf_counter()
+        marked, _, _ = process_frame(img, options.key, delta, mode='embed', dtype=dtype)
+        embed_ms = (time.perf_counter() - start) * 1e3 / megapixels
+        psnr = cv2.PSNR(img, marked)
+        copies = [(name, transform(marked)) for name, transform in matrix_transforms(options)]
+        for name, copy in [("unmarked", None)] + copies:
+            start = time.perf_counter()
+            if copy is None:
+                coeffs, grid = unmarked, (slice(None), slice(None))
+            else:
+                coeffs, grid = _aligned_block_dct(copy, options.key, delta, watermark_shape, dtype)
+            dct_ms = (time.perf_counter() - start) * 1e3 / megapixels
+            for votes in options.votes:
+                start = time.perf_counter()
+                ber = _vote_ber(coeffs, positions[grid].reshape(-1, 3), expected[grid].ravel(), delta, votes)
+                extract_ms = dct_ms + (time.perf_counter() - start) * 1e3 / megapixels
+                rows.append({"image": path, "delta": delta, "dtype": dtype, "votes": votes, "transform": name,
+                             "embed_ms_per_mp": embed_ms, "extract_ms_per_mp": extract_ms, "psnr": psnr,
+                             "ber": ber})
+    return rows
+
+
+def run_matrix(args):
+    """
+    Embed/extract time, PSNR and BER over a corpus for every delta, dtype and
+    vote rule, under each transform, then the fastest settings whose detection
+    rate under every transform (or those named by --require) meets --target at
+    a false-positive rate of at most --max-fpr.
+    """
+    images = []
+    for path in args.images:
+        images += [os.path.join(path, name) for name in find_images(path)] if os.path.isdir(path) else [path]
+    if not images:
+        print("No images found")
+        return 1
+    transforms = ["unmarked"] + [name for name, _ in matrix_transforms(args)]
+    required = args.require or transforms[1:]
+    unknown = set(required) - set(transforms[1:])
+    if unknown:
+        print(f"Unknown transforms {sorted(unknown)} (this grid has {', '.join(transforms[1:])})")
+        return 1
+    tasks = [(path, dtype, args) for path in images for dtype in args.dtypes]
+    with multiprocessing.Pool(args.workers) as pool:
+        rows = [row for task_rows in pool.imap_unordered(_matrix_task, tasks) for row in task_rows]
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+
+    groups = {}
+    for row in rows:
+        groups.setdefault((row["delta"], row["dtype"], row["votes"], row["transform"]), []).append(row)
+    print(f"{len(images)} images, workers={args.workers}; times are means per megapixel, "
+          f"det@t is the share of images with BER < t (false positives for 'unmarked')")
+    print(f"{'delta':>6} {'dtype':<8}{'votes':>5} {'transform':<12}{'embed ms':>9}{'extr ms':>9}{'PSNR':>7}{'BER':>7}"
+          + "".join(f"{'det@' + format(t, 'g'):>9}" for t in args.thresholds))
+    for (delta, dtype, votes, name), group in sorted(groups.items(), key=lambda item: (
+            item[0][:3], transforms.index(item[0][3]))):
+        bers = np.array([row["ber"] for row in group])
+        print(f"{delta:>6g} {dtype:<8}{votes:>5} {name:<12}{np.mean([r['embed_ms_per_mp'] for r in group]):>9.1f}"
+              f"{np.mean([r['extract_ms_per_mp'] for r in group]):>9.1f}{np.mean([r['psnr'] for r in group]):>7.2f}"
+              f"{bers.mean():>7.3f}" + "".join(f"{np.mean(bers < t):>9.0%}" for t in args.thresholds))
+
+    passing = []
+    for delta in args.deltas:
+        for dtype in args.dtypes:
+            for votes in args.votes:
+                for threshold in args.thresholds:
+                    rate = {name: np.mean([r["ber"] < threshold for r in groups[(delta, dtype, votes, name)]])
+                            for name in transforms}
+                    worst = min(rate[name] for name in required)
+                    if worst >= args.target and rate["unmarked"] <= args.max_fpr:
+                        clean = groups[(delta, dtype, votes, "none")]
+                        seconds = np.mean([r["embed_ms_per_mp"] + r["extract_ms_per_mp"] for r in clean])
+                        passing.append((seconds, -np.mean([r["psnr"] for r in clean]), delta, dtype, votes,
+                                        threshold, worst, rate["unmarked"]))
+    print(f"\nFastest settings detecting >= {args.target:.0%} under {', '.join(required)} "
+          f"with <= {args.max_fpr:.0%} false positives:")
+    if not passing:
+        print("  none")
+    for ms, neg_psnr, delta, dtype, votes, threshold, worst, fpr in sorted(passing)[:args.top]:
+        print(f"  delta={delta:g} dtype={dtype} votes={votes} threshold={threshold:g}: "
+              f"{ms:.1f} ms/MP embed+extract, PSNR {-neg_psnr:.2f}, worst detection {worst:.0%}, FPR {fpr:.0%}")
+    return 0 if passing else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Watermark engine benchmarks")
+    parser.add_argument('--key', type=int, default=12345)
+    parser.add_argument('--delta', type=float, default=7.25)
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    memory = sub.add_parser('memory', help="Peak RSS per megapixel for each processing strategy")
+    memory.add_argument('images', nargs='+')
+    memory.add_argument('--dtype', default='float64', choices=['float64', 'float32'])
+    memory.add_argument('--budget-mb', type=float, default=0)
+    memory.set_defaults(func=run_memory)
+
+    precision = sub.add_parser('precision', help="BER agreement of float32 with float64")
+    precision.add_argument('images', nargs='+')
+    precision.set_defaults(func=run_precision)
+
+    resync = sub.add_parser('resync', help="Cropped-copy detection time versus a normal extraction")
+    resync.add_argument('images', nargs='+')
+    resync.add_argument('--crop', type=int, nargs=2, default=(101, 77), metavar=('TOP', 'LEFT'))
+    resync.set_defaults(func=run_resync)
+
+    parallel = sub.add_parser('parallel', help="Sharded process_frame latency per worker count")
+    parallel.add_argument('images', nargs='+')
+    parallel.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parallel.set_defaults(func=run_parallel)
+
+    encode = sub.add_parser('encode', help="Encode time, bytes and post-encode BER per output profile")
+    encode.add_argument('images', nargs='+')
+    encode.add_argument('--profiles', nargs='+', default=list(PROFILES), choices=list(PROFILES))
+    encode.add_argument('--repeat', type=int, default=3)
+    encode.set_defaults(func=run_encode)
+
+    matrix = sub.add_parser('matrix', help="Time, PSNR and BER under transforms over a parameter grid")
+    matrix.add_argument('images', nargs='+', help="Image files or directories")
+    matrix.add_argument('--deltas', type=float, nargs='+', default=[5, 7.25, 10, 14])
+    matrix.add_argument('--thresholds', type=float, nargs='+', default=[0.25, 0.3, 0.35])
+    matrix.add_argument('--votes', type=int, nargs='+', default=[3, 1], choices=[1, 3],
+                        help="Embedding positions read per block (3: majority vote)")
+    matrix.add_argument('--dtypes', nargs='+', default=['float64'], choices=['float64', 'float32'])
+    matrix.add_argument('--jpeg', type=int, nargs='*', default=[90, 75, 50], help="JPEG recompression qualities")
+    matrix.add_argument('--scales', type=float, nargs='*', default=[0.75, 0.5], help="Resize factors (and back)")
+    matrix.add_argument('--noise', type=float, nargs='*', default=[2, 5], help="Gaussian noise sigmas")
+    matrix.add_argument('--crop', type=int, nargs=2, default=(101, 77), metavar=('TOP', 'LEFT'))
+    matrix.add_argument('--no-crop', dest='crop', action='store_const', const=None)
+    matrix.add_argument('--require', nargs='+', help="Transforms the summary requires (default: all)")
+    matrix.add_argument('--target', type=float, default=0.95, help="Detection rate the summary requires")
+    matrix.add_argument('--max-fpr', type=float, default=0.0, help="False-positive rate the summary allows")
+    matrix.add_argument('--top', type=int, default=10)
+    matrix.add_argument('--workers', type=int, default=os.cpu_count())
+    matrix.add_argument('--csv', help="Write every (image, setting, transform) row here")
+    matrix.set_defaults(func=run_matrix)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main() or 0)
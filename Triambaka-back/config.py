@@ -5,6 +5,10 @@ from dotenv import load_dotenv
 load_dotenv()
 
 class Config:
+    # Database (local embed registry)
+    SQLALCHEMY_DATABASE_URI = os.getenv("DATABASE_URL", "sqlite:///triambaka.db")
+    MONGO_URI = os.getenv("MONGO_URI")
+
     # Blockchain Configuration
     BLOCKCHAIN_URL = os.getenv("BLOCKCHAIN_URL", "http://127.0.0.1:7545")  # Default to Ganache
     CONTRACT_ADDRESS = os.getenv("CONTRACT_ADDRESS")
@@ -14,7 +18,3 @@ class Config:
     PINATA_API_KEY = os.getenv("PINATA_API_KEY")
     PINATA_API_SECRET = os.getenv("PINATA_API_SECRET")
     PINATA_BASE_URL = os.getenv("PINATA_BASE_URL", "https://api.pinata.cloud/pinning/pinFileToIPFS")
-
-    # Upload Folder
-    UPLOAD_FOLDER = os.getenv("UPLOAD_FOLDER", "uploads")
-    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
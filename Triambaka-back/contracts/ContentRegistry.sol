@@ -10,11 +10,28 @@ contract ContentRegistry {
         uint delta; // Added delta value
     }
 
+    // Many contents registered at once: a Merkle root over their
+    // (sha256Hash, ipfsHash, delta) leaves, see batchLeaf(). Each sha256Hash
+    // is claimed for the batch, so a hash has one owner across single and
+    // batch registration.
+    struct Batch {
+        address owner;
+        bytes32 merkleRoot;
+        uint leafCount;
+        string manifestIpfsHash; // IPFS hash of the full leaf list
+        uint timestamp;
+    }
+
     mapping(uint => Content) public contents;
     mapping(string => uint) private hashToContentId; // Maps sha256Hash to content ID
     mapping(address => uint[]) private ownerToContentIds; // Maps owner address to content IDs
     uint public contentCount;
 
+    mapping(uint => Batch) public batches;
+    mapping(bytes32 => uint) public rootToBatchId; // Maps Merkle root to batch ID
+    mapping(string => uint) public hashToBatchId; // Maps sha256Hash to the batch that registered it
+    uint public batchCount;
+
     event ContentRegistered(
         uint contentId,
         address indexed owner,
@@ -31,6 +48,14 @@ contract ContentRegistry {
         uint timestamp,
         uint delta
     );
+    event BatchRegistered(
+        uint batchId,
+        address indexed owner,
+        bytes32 merkleRoot,
+        string[] sha256Hashes,
+        string manifestIpfsHash,
+        uint timestamp
+    );
 
     // Register new content with IPFS hash, SHA256 hash, and delta value
     function registerContent(
@@ -56,6 +81,7 @@ contract ContentRegistry {
             );
             return existingContentId;
         }
+        require(hashToBatchId[_sha256Hash] == 0, "Content is already registered in a batch");
 
         // Register new content
         contentCount++;
@@ -79,6 +105,86 @@ contract ContentRegistry {
         return contentCount;
     }
 
+    // Register a batch of contents with one transaction by committing to the
+    // Merkle root of their leaves and claiming their SHA256 hashes, which must
+    // not be registered yet, singly or in a batch. Registering the same root
+    // again returns the existing batch ID.
+    function registerBatch(
+        bytes32 _merkleRoot,
+        string[] memory _sha256Hashes,
+        string memory _manifestIpfsHash
+    ) public returns (uint) {
+        require(_merkleRoot != bytes32(0), "Merkle root cannot be empty");
+        require(_sha256Hashes.length > 0, "Batch cannot be empty");
+
+        uint existingBatchId = rootToBatchId[_merkleRoot];
+        if (existingBatchId != 0) {
+            return existingBatchId;
+        }
+
+        batchCount++;
+        for (uint i = 0; i < _sha256Hashes.length; i++) {
+            require(bytes(_sha256Hashes[i]).length > 0, "SHA256 hash cannot be empty");
+            require(hashToContentId[_sha256Hashes[i]] == 0, "Content is already registered");
+            require(hashToBatchId[_sha256Hashes[i]] == 0, "Content is already registered in a batch");
+            hashToBatchId[_sha256Hashes[i]] = batchCount;
+        }
+        batches[batchCount] = Batch(
+            msg.sender,
+            _merkleRoot,
+            _sha256Hashes.length,
+            _manifestIpfsHash,
+            block.timestamp
+        );
+        rootToBatchId[_merkleRoot] = batchCount;
+        emit BatchRegistered(
+            batchCount,
+            msg.sender,
+            _merkleRoot,
+            _sha256Hashes,
+            _manifestIpfsHash,
+            block.timestamp
+        );
+        return batchCount;
+    }
+
+    // Leaf of a batch Merkle tree. Hashed twice so that a leaf can never be
+    // mistaken for an inner node.
+    function batchLeaf(
+        string memory _sha256Hash,
+        string memory _ipfsHash,
+        uint _delta
+    ) public pure returns (bytes32) {
+        return keccak256(abi.encodePacked(keccak256(abi.encode(_sha256Hash, _ipfsHash, _delta))));
+    }
+
+    // Check that a content is part of a registered batch that claimed its
+    // hash. Inner nodes hash their children in sorted order, so the proof is
+    // just the sibling hashes.
+    function verifyBatchContent(
+        uint _batchId,
+        string memory _sha256Hash,
+        string memory _ipfsHash,
+        uint _delta,
+        bytes32[] memory _proof
+    ) public view returns (bool) {
+        require(
+            _batchId > 0 && _batchId <= batchCount,
+            "Batch ID does not exist"
+        );
+        if (hashToBatchId[_sha256Hash] != _batchId) {
+            return false;
+        }
+        bytes32 node = batchLeaf(_sha256Hash, _ipfsHash, _delta);
+        for (uint i = 0; i < _proof.length; i++) {
+            bytes32 sibling = _proof[i];
+            node = node < sibling
+                ? keccak256(abi.encodePacked(node, sibling))
+                : keccak256(abi.encodePacked(sibling, node));
+        }
+        return node == batches[_batchId].merkleRoot;
+    }
+
     // Retrieve content details
     function getContent(
         uint _contentId
@@ -97,6 +203,58 @@ contract ContentRegistry {
         );
     }
 
+    // Resolve a SHA256 hash to its content in one call; contentId is 0 when
+    // the hash is not registered on its own (see hashToBatchId for batches)
+    function getContentByHash(
+        string memory _sha256Hash
+    ) public view returns (uint, address, string memory, string memory, uint, uint) {
+        uint contentId = hashToContentId[_sha256Hash];
+        Content memory content = contents[contentId];
+        return (
+            contentId,
+            content.owner,
+            content.ipfsHash,
+            content.sha256Hash,
+            content.timestamp,
+            content.delta
+        );
+    }
+
+    // Page through contents: up to _count records starting at ID _start
+    function getContentsRange(
+        uint _start,
+        uint _count
+    ) public view returns (Content[] memory) {
+        require(_start > 0, "Content IDs start at 1");
+        if (_start > contentCount) {
+            return new Content[](0);
+        }
+        uint end = contentCount;
+        if (_count < contentCount + 1 - _start) {
+            end = _start + _count - 1;
+        }
+        Content[] memory page = new Content[](end + 1 - _start);
+        for (uint i = _start; i <= end; i++) {
+            page[i - _start] = contents[i];
+        }
+        return page;
+    }
+
+    // Retrieve many contents by ID in one call
+    function getContents(
+        uint[] memory _contentIds
+    ) public view returns (Content[] memory) {
+        Content[] memory result = new Content[](_contentIds.length);
+        for (uint i = 0; i < _contentIds.length; i++) {
+            require(
+                _contentIds[i] > 0 && _contentIds[i] <= contentCount,
+                "Content ID does not exist"
+            );
+            result[i] = contents[_contentIds[i]];
+        }
+        return result;
+    }
+
     // Verify ownership of content
     function verifyOwnership(
         uint _contentId,
@@ -116,10 +274,11 @@ contract ContentRegistry {
         return ownerToContentIds[_user];
     }
 
-    // Check if an image already exists using its SHA256 hash
+    // Check if an image already exists using its SHA256 hash, registered
+    // singly or in a batch
     function checkImageExists(
         string memory _sha256Hash
     ) public view returns (bool) {
-        return hashToContentId[_sha256Hash] != 0;
+        return hashToContentId[_sha256Hash] != 0 || hashToBatchId[_sha256Hash] != 0;
     }
 }
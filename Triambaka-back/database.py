@@ -1,9 +1,40 @@
 from flask_sqlalchemy import SQLAlchemy
-from flask_pymongo import PyMongo
+
+try:
+    from flask_pymongo import PyMongo
+except ImportError:  # MongoDB support is optional
+    PyMongo = None
 
 db = SQLAlchemy()
-mongo = PyMongo()
+mongo = PyMongo() if PyMongo else None
 
 def init_db(app):
     db.init_app(app)
-    mongo.init_app(app)
+    if mongo is not None and app.config.get("MONGO_URI"):
+        mongo.init_app(app)
+
+    # Import models so their tables are registered before create_all
+    import models  # noqa: F401
+    with app.app_context():
+        db.create_all()
+        _add_missing_columns()
+
+
+def _add_missing_columns():
+    """
+    create_all does not alter existing tables; columns added to a model later
+    are added here (they must be nullable or carry a server_default).
+    """
+    inspector = db.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(db.engine.dialect)}"
+            if column.server_default is not None:
+                ddl += f" DEFAULT {column.server_default.arg}"
+            with db.engine.begin() as conn:
+                conn.execute(db.text(ddl))
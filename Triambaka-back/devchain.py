@@ -0,0 +1,291 @@
+"""
+In-process development chain (eth-tester + py-evm) with ContentRegistry
+compiled from contracts/ and deployed, so the contract and the backend's Merkle
+proofs can be exercised without Ganache.
+
+    pip install -r requirements-dev.txt
+    python devchain.py --contents 50 --batch 500
+    python devchain.py --records 5000        # view functions against many records
+    python devchain.py --serve 8545          # JSON-RPC node for the API (like Ganache)
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import solcx
+from eth_tester.exceptions import TransactionFailed
+from web3 import Web3, EthereumTesterProvider
+from web3.exceptions import ContractLogicError
+from web3.providers.eth_tester.middleware import filter_request_transformer, log_result_remapper
+
+import merkle
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CONTRACT_PATH = os.path.join(BASE_DIR, "contracts", "ContentRegistry.sol")
+ABI_PATH = os.path.join(BASE_DIR, "routes", "ContentRegistry_abi.json")
+SOLC_VERSION = os.getenv("SOLC_VERSION", "0.8.24")
+
+
+def compile_registry():
+    """
+    Returns the compiled {"abi", "bin"} of ContentRegistry, installing solc on first use.
+    """
+    if SOLC_VERSION not in {str(v) for v in solcx.get_installed_solc_versions()}:
+        solcx.install_solc(SOLC_VERSION)
+    compiled = solcx.compile_files([CONTRACT_PATH], output_values=["abi", "bin"], solc_version=SOLC_VERSION)
+    return next(output for name, output in compiled.items() if name.endswith(":ContentRegistry"))
+
+
+def abi_drift(compiled_abi):
+    """
+    Names of ABI entries that differ between the compiled contract and the
+    checked-in ContentRegistry_abi.json (empty when they agree).
+    """
+    def signatures(abi):
+        return {(e.get("name"), e["type"], tuple(i["type"] for i in e.get("inputs", [])),
+                 tuple(o["type"] for o in e.get("outputs", []))) for e in abi}
+
+    with open(ABI_PATH) as f:
+        checked_in = signatures(json.load(f))
+    return sorted({s[0] for s in signatures(compiled_abi) ^ checked_in})
+
+
+def deploy():
+    """
+    Starts a fresh in-process chain and deploys ContentRegistry on it.
+    Returns (web3, contract); transactions are sent from the first test account.
+    """
+    compiled = compile_registry()
+    web3 = Web3(EthereumTesterProvider())
+    web3.eth.default_account = web3.eth.accounts[0]
+    tx_hash = web3.eth.contract(abi=compiled["abi"], bytecode=compiled["bin"]).constructor().transact()
+    receipt = web3.eth.wait_for_transaction_receipt(tx_hash)
+    return web3, web3.eth.contract(address=receipt.contractAddress, abi=compiled["abi"])
+
+
+def _json_default(value):
+    if isinstance(value, (bytes, bytearray)):
+        return "0x" + bytes(value).hex()
+    if hasattr(value, "items"):
+        return dict(value)
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+# Position of the block parameter of the JSON-RPC methods that take one
+BLOCK_PARAMS = {"eth_call": 1, "eth_estimateGas": 1, "eth_getBalance": 1, "eth_getCode": 1,
+                "eth_getTransactionCount": 1, "eth_getStorageAt": 2, "eth_getBlockByNumber": 0}
+
+
+def serve_rpc(web3, port=0):
+    """
+    Serves the in-process chain over HTTP JSON-RPC so the API (and its async
+    server) can use it as GANACHE_URL. Runs in a daemon thread; returns
+    (server, url). Requests are handled one at a time (eth-tester is not thread-safe).
+    """
+    lock = threading.Lock()
+    default_from = web3.eth.accounts[0]
+
+    def handle(request):
+        method, params = request["method"], list(request.get("params", []))
+        if method in ("eth_call", "eth_estimateGas") and params and "from" not in params[0]:
+            params[0] = dict(params[0], **{"from": default_from})  # eth-tester needs a sender
+        index = BLOCK_PARAMS.get(method)
+        if index is not None and index < len(params) and str(params[index]).startswith("0x"):
+            params[index] = int(params[index], 16)  # eth-tester takes block numbers as integers
+        if method == "eth_getLogs" and params:
+            params[0] = filter_request_transformer(params[0])  # eth-tester's key names and integer blocks
+        try:
+            with lock:
+                response = dict(web3.provider.make_request(method, params))
+            if method == "eth_getLogs" and isinstance(response.get("result"), (list, tuple)):
+                response["result"] = [log_result_remapper(log) for log in response["result"]]
+        except TransactionFailed as e:
+            message = str(e) if str(e).startswith("execution reverted") else f"execution reverted: {e}"
+            response = {"error": {"code": 3, "message": message}}
+        except Exception as e:
+            response = {"error": {"code": -32000, "message": str(e)}}
+        return dict(response, jsonrpc="2.0", id=request.get("id"))
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            result = [handle(r) for r in payload] if isinstance(payload, list) else handle(payload)
+            body = json.dumps(result, default=_json_default).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def _random_content(rng):
+    return {
+        "sha256_hash": "%064x" % rng.getrandbits(256),
+        "ipfs_hash": "Qm%044x" % rng.getrandbits(176),
+        "delta": merkle.chain_delta(7.25 + 0.25 * rng.randrange(11))
+    }
+
+
+def _reverts(call):
+    try:
+        call.call()
+    except (ContractLogicError, TransactionFailed):
+        return True
+    return False
+
+
+def run_batch_demo(web3, contract, contents, batch_size, samples=20):
+    """
+    Registers contents one transaction each and a batch of batch_size with one
+    registerBatch, checks sampled proofs on chain and that a hash cannot be
+    registered both ways, and returns a summary.
+    """
+    rng = random.Random(0)
+
+    gas_single, start, singles = 0, time.perf_counter(), []
+    for _ in range(contents):
+        item = _random_content(rng)
+        tx_hash = contract.functions.registerContent(item["ipfs_hash"], item["sha256_hash"], item["delta"]).transact()
+        gas_single += web3.eth.wait_for_transaction_receipt(tx_hash).gasUsed
+        singles.append(item)
+    time_single = time.perf_counter() - start
+
+    items = [_random_content(rng) for _ in range(batch_size)]
+    start = time.perf_counter()
+    levels = merkle.build_levels([merkle.leaf_hash(i["sha256_hash"], i["ipfs_hash"], i["delta"]) for i in items])
+    root = levels[-1][0]
+    receipt = web3.eth.wait_for_transaction_receipt(
+        contract.functions.registerBatch(root, [i["sha256_hash"] for i in items], "").transact()
+    )
+    time_batch = time.perf_counter() - start
+    batch_id = contract.functions.rootToBatchId(root).call()
+
+    failures = 0
+    for index in rng.sample(range(len(items)), min(samples, len(items))):
+        item, proof = items[index], merkle.proof_for(levels, index)
+        ok = contract.functions.verifyBatchContent(batch_id, item["sha256_hash"], item["ipfs_hash"], item["delta"],
+                                                   proof).call()
+        tampered = contract.functions.verifyBatchContent(batch_id, item["sha256_hash"], item["ipfs_hash"],
+                                                         item["delta"] + 1, proof).call()
+        failures += (not ok) or tampered or not merkle.verify_proof(merkle.leaf_hash(**item), proof, root)
+        failures += contract.functions.hashToBatchId(item["sha256_hash"]).call() != batch_id
+
+    # One owner per hash: a batch hash cannot be registered on its own, nor a
+    # registered hash (single or batch) in another batch
+    conflicts = 0
+    item = items[0]
+    conflicts += not _reverts(contract.functions.registerContent(item["ipfs_hash"], item["sha256_hash"], item["delta"]))
+    for taken in filter(None, (singles[:1], items[:1])):
+        extra = [_random_content(rng) for _ in range(2)] + taken
+        other = merkle.build_levels([merkle.leaf_hash(**i) for i in extra])[-1][0]
+        conflicts += not _reverts(contract.functions.registerBatch(other, [i["sha256_hash"] for i in extra], ""))
+    conflicts += not contract.functions.checkImageExists(item["sha256_hash"]).call()
+
+    return {
+        "gas_per_content_single": gas_single / max(contents, 1),
+        "gas_per_content_batch": receipt.gasUsed / len(items),
+        "seconds_per_content_single": time_single / max(contents, 1),
+        "seconds_per_content_batch": time_batch / len(items),
+        "proof_length": len(merkle.proof_for(levels, 0)),
+        "proof_failures": failures,
+        "ownership_conflicts": conflicts,
+    }
+
+
+def run_view_demo(web3, contract, records, page_size=500):
+    """
+    Registers records contents, then checks getContentByHash, getContentsRange
+    and getContents against getContent and times a hash lookup both ways.
+    """
+    rng = random.Random(1)
+    items = [_random_content(rng) for _ in range(records)]
+    first_id = contract.functions.contentCount().call() + 1
+    for item in items:
+        contract.functions.registerContent(item["ipfs_hash"], item["sha256_hash"], item["delta"]).transact()
+    total = contract.functions.contentCount().call()
+
+    mismatches = 0
+    for index in rng.sample(range(records), min(50, records)):
+        content_id, *content = contract.functions.getContentByHash(items[index]["sha256_hash"]).call()
+        mismatches += content_id != first_id + index or content != list(contract.functions.getContent(content_id).call())
+    mismatches += contract.functions.getContentByHash("not registered").call()[0] != 0
+
+    start, pages, listed = time.perf_counter(), 0, []
+    for page_start in range(1, total + 1, page_size):
+        listed += contract.functions.getContentsRange(page_start, page_size).call()
+        pages += 1
+    time_pages = time.perf_counter() - start
+    mismatches += len(listed) != total
+    for content_id in rng.sample(range(1, total + 1), min(50, total)):
+        mismatches += tuple(listed[content_id - 1]) != tuple(contract.functions.getContent(content_id).call())
+    ids = rng.sample(range(1, total + 1), min(page_size, total))
+    mismatches += [tuple(c) for c in contract.functions.getContents(ids).call()] != [tuple(listed[i - 1]) for i in ids]
+
+    # Worst case of the old lookup: the last record, found by scanning every ID
+    target = items[-1]["sha256_hash"]
+    start = time.perf_counter()
+    contract.functions.getContentByHash(target).call()
+    time_by_hash = time.perf_counter() - start
+    start = time.perf_counter()
+    for content_id in range(1, total + 1):
+        if contract.functions.getContent(content_id).call()[2] == target:
+            break
+    time_scan = time.perf_counter() - start
+
+    return {
+        "records": total,
+        "lookup_seconds_by_hash": time_by_hash,
+        "lookup_seconds_linear_scan": time_scan,
+        "list_calls": pages,
+        "list_seconds": time_pages,
+        "view_mismatches": mismatches,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ContentRegistry on an in-process chain")
+    parser.add_argument('--contents', type=int, default=50, help="contents registered one transaction each")
+    parser.add_argument('--batch', type=int, default=500, help="contents registered in one batch transaction")
+    parser.add_argument('--records', type=int, default=0, help="also check the view functions over this many records")
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help="skip the demos and serve the chain over JSON-RPC on PORT until interrupted")
+    args = parser.parse_args()
+
+    web3, contract = deploy()
+    drift = abi_drift(contract.abi)
+    if drift:
+        print(f"ContentRegistry_abi.json is out of date for: {', '.join(drift)}")
+
+    if args.serve is not None:
+        server, url = serve_rpc(web3, args.serve)
+        print(f"GANACHE_URL={url}\nCONTRACT_ADDRESS={contract.address}")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
+        return 0
+
+    summary = run_batch_demo(web3, contract, args.contents, args.batch)
+    if args.records:
+        summary.update(run_view_demo(web3, contract, args.records))
+    for name, value in summary.items():
+        print(f"{name:<30}{value:,.6g}")
+    failed = summary["proof_failures"] or summary["ownership_conflicts"] or summary.get("view_mismatches")
+    return 1 if drift or failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,358 @@
+"""
+Read-through disk cache of IPFS content, for originals behind a record's
+ipfsHash that forensic comparison and re-verification fetch again and again.
+
+Files are stored under their CID, so an entry never goes stale. A miss is
+downloaded from IPFS_GATEWAY_URL into a temporary file, checked against the
+CID and only then moved into place; concurrent requests for the same CID wait
+for that one download instead of starting their own. The cache is kept under
+IPFS_CACHE_MB by evicting the least recently used files.
+
+CIDs are checked by rebuilding the DAG `ipfs add` (and Pinata) makes with the
+default settings: sha2-256, 256 KiB chunks, balanced layout of up to 174 links
+per node, dag-pb leaves for CIDv0 and raw leaves for CIDv1. Content added with
+other settings cannot be checked and is refused unless IPFS_CACHE_VERIFY=0.
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+IPFS_GATEWAY_URL = os.getenv("IPFS_GATEWAY_URL", "https://gateway.pinata.cloud").rstrip('/')
+IPFS_CACHE_DIR = os.getenv("IPFS_CACHE_DIR", os.path.join(os.getcwd(), 'ipfs_cache'))
+# Total bytes of cached content; least recently used files are evicted past it
+IPFS_CACHE_MB = float(os.getenv("IPFS_CACHE_MB", "2048"))
+# Check downloads against their CID before caching them
+IPFS_CACHE_VERIFY = os.getenv("IPFS_CACHE_VERIFY", "1") == "1"
+IPFS_FETCH_TIMEOUT_S = float(os.getenv("IPFS_FETCH_TIMEOUT_S", "60"))
+
+# Defaults of the UnixFS importer
+CHUNK_SIZE = 262144
+MAX_LINKS = 174
+
+# Multicodec and multihash codes
+DAG_PB = 0x70
+RAW = 0x55
+SHA2_256 = 0x12
+
+# Bytes read per step while downloading
+DOWNLOAD_CHUNK = 1 << 16
+
+_BASE58 = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+_BASE32 = "abcdefghijklmnopqrstuvwxyz234567"
+
+
+class InvalidCid(ValueError):
+    """Raised for strings that are not a CID this cache can check."""
+
+
+class ContentNotFound(LookupError):
+    """Raised when the gateway does not have the content of a CID."""
+
+
+class GatewayError(Exception):
+    """Raised when a download fails or does not match its CID."""
+
+
+# --- CIDs ---
+
+def _b58encode(data):
+    n = int.from_bytes(data, 'big')
+    out = ""
+    while n:
+        n, r = divmod(n, 58)
+        out = _BASE58[r] + out
+    return "1" * (len(data) - len(data.lstrip(b"\0"))) + out
+
+
+def _b58decode(text):
+    n = 0
+    for char in text:
+        n = n * 58 + _BASE58.index(char)
+    body = n.to_bytes((n.bit_length() + 7) // 8, 'big')
+    return b"\0" * (len(text) - len(text.lstrip("1"))) + body
+
+
+def _b32encode(data):
+    bits = int.from_bytes(data, 'big') << (-len(data) * 8 % 5)
+    length = (len(data) * 8 + 4) // 5
+    return "".join(_BASE32[(bits >> (5 * (length - 1 - i))) & 31] for i in range(length))
+
+
+def _b32decode(text):
+    bits = 0
+    for char in text:
+        bits = (bits << 5) | _BASE32.index(char)
+    extra = len(text) * 5 % 8
+    return (bits >> extra).to_bytes(len(text) * 5 // 8, 'big')
+
+
+def _varint(n):
+    out = bytearray()
+    while True:
+        byte, n = n & 0x7F, n >> 7
+        out.append(byte | (0x80 if n else 0))
+        if not n:
+            return bytes(out)
+
+
+def _read_varint(data, pos):
+    n, shift = 0, 0
+    while True:
+        byte = data[pos]
+        n |= (byte & 0x7F) << shift
+        pos, shift = pos + 1, shift + 7
+        if not byte & 0x80:
+            return n, pos
+
+
+def parse_cid(cid):
+    """
+    (version, codec, sha2-256 digest) of a CIDv0 ("Qm...") or base32 CIDv1
+    ("b...") string.
+    """
+    try:
+        if cid.startswith("Qm") and len(cid) == 46:
+            version, codec, multihash = 0, DAG_PB, _b58decode(cid)
+        elif cid.startswith("b"):
+            raw = _b32decode(cid[1:])
+            version, pos = _read_varint(raw, 0)
+            codec, pos = _read_varint(raw, pos)
+            multihash = raw[pos:]
+            if version != 1:
+                raise InvalidCid(f"Unsupported CID version {version}")
+        else:
+            raise InvalidCid(f"Not a CIDv0 or base32 CIDv1: {cid!r}")
+    except (ValueError, IndexError) as e:
+        if isinstance(e, InvalidCid):
+            raise
+        raise InvalidCid(f"Malformed CID {cid!r}")
+    if codec not in (DAG_PB, RAW):
+        raise InvalidCid(f"Unsupported CID codec 0x{codec:x}")
+    if multihash[:2] != bytes([SHA2_256, 32]) or len(multihash) != 34:
+        raise InvalidCid("Only sha2-256 CIDs are supported")
+    return version, codec, multihash[2:]
+
+
+def _cid_bytes(version, codec, digest):
+    multihash = bytes([SHA2_256, 32]) + digest
+    return multihash if version == 0 else _varint(1) + _varint(codec) + multihash
+
+
+def format_cid(version, codec, digest):
+    cid = _cid_bytes(version, codec, digest)
+    return _b58encode(cid) if version == 0 else "b" + _b32encode(cid)
+
+
+# --- UnixFS DAG of a file (see module docstring) ---
+
+def _field(number, payload):
+    """Length-delimited protobuf field."""
+    return _varint(number << 3 | 2) + _varint(len(payload)) + payload
+
+
+def _uint_field(number, value):
+    return _varint(number << 3) + _varint(value)
+
+
+class _Chunks:
+    """Fixed-size chunks of a binary file, with one chunk of lookahead."""
+
+    def __init__(self, f):
+        self.f = f
+        self.next = f.read(CHUNK_SIZE)
+
+    def done(self):
+        return not self.next
+
+    def take(self):
+        chunk, self.next = self.next, self.f.read(CHUNK_SIZE)
+        return chunk
+
+
+def _leaf(chunk, version):
+    """(link bytes, cumulative size, file size) of a leaf block."""
+    if version == 1:
+        return _cid_bytes(1, RAW, hashlib.sha256(chunk).digest()), len(chunk), len(chunk)
+    unixfs = _uint_field(1, 2) + (_field(2, chunk) if chunk else b"") + _uint_field(3, len(chunk))
+    block = _field(1, unixfs)
+    return _cid_bytes(0, DAG_PB, hashlib.sha256(block).digest()), len(block), len(chunk)
+
+
+def _node(children, version):
+    """(link bytes, cumulative size, file size) of an internal node over children."""
+    filesize = sum(child[2] for child in children)
+    unixfs = _uint_field(1, 2) + _uint_field(3, filesize) + b"".join(_uint_field(4, c[2]) for c in children)
+    links = b"".join(_field(2, _field(1, link) + _field(2, b"") + _uint_field(3, tsize))
+                     for link, tsize, _ in children)
+    block = links + _field(1, unixfs)
+    return (_cid_bytes(version, DAG_PB, hashlib.sha256(block).digest()), len(block) + sum(c[1] for c in children),
+            filesize)
+
+
+def _fill(chunks, children, depth, version):
+    while len(children) < MAX_LINKS and not chunks.done():
+        children.append(_leaf(chunks.take(), version) if depth == 1 else _fill(chunks, [], depth - 1, version))
+    return _node(children, version)
+
+
+def file_cid(f, version=0):
+    """
+    CID that `ipfs add` with default settings gives the content of a binary
+    file object (CIDv1: --cid-version 1, raw leaves).
+    """
+    chunks = _Chunks(f)
+    root = _leaf(chunks.take(), version)
+    depth = 1
+    while not chunks.done():
+        root = _fill(chunks, [root], depth, version)
+        depth += 1
+    if version == 0:
+        return _b58encode(root[0])
+    return "b" + _b32encode(root[0])
+
+
+def matches_cid(path, cid):
+    version, _, _ = parse_cid(cid)
+    with open(path, 'rb') as f:
+        return file_cid(f, version) == cid
+
+
+# --- Cache ---
+
+class IpfsCache:
+    """
+    Content-addressed files under root in LRU order, filled from a gateway on
+    a miss with one download per CID however many requests want it.
+    Thread-safe; one instance per process.
+    """
+
+    def __init__(self, root, quota_bytes, gateway, timeout, verify=True):
+        self.root = root
+        self.quota_bytes = quota_bytes
+        self.gateway = gateway
+        self.timeout = timeout
+        self.verify = verify
+        self._lock = threading.Lock()
+        self._files = OrderedDict()  # cid -> size, least recently used first
+        self._bytes = 0
+        self._inflight = {}  # cid -> Future of its path
+        self._counters = {"hits": 0, "misses": 0, "coalesced": 0, "downloads": 0, "downloaded_bytes": 0,
+                          "download_seconds": 0.0, "rejected": 0, "evicted": 0}
+
+        os.makedirs(self.root, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.root):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith(".part"):
+                os.remove(entry.path)  # download cut short by a restart
+            else:
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, cid, size in sorted(entries):
+            self._files[cid] = size
+            self._bytes += size
+
+    def path(self, cid):
+        return os.path.join(self.root, cid)
+
+    def get(self, cid):
+        """
+        Path of the cached content of a CID, downloading it first on a miss.
+        Raises InvalidCid, ContentNotFound or GatewayError.
+        """
+        parse_cid(cid)
+        with self._lock:
+            if cid in self._files:
+                self._counters["hits"] += 1
+                self._files.move_to_end(cid)
+                os.utime(self.path(cid))  # keeps the LRU order across restarts
+                return self.path(cid)
+            flight = self._inflight.get(cid)
+            leader = flight is None
+            if leader:
+                self._counters["misses"] += 1
+                flight = self._inflight[cid] = Future()
+            else:
+                self._counters["coalesced"] += 1
+        if not leader:
+            return flight.result()
+
+        try:
+            flight.set_result(self._download(cid))
+        except Exception as e:
+            flight.set_exception(e)
+        finally:
+            with self._lock:
+                del self._inflight[cid]
+        return flight.result()
+
+    def _download(self, cid):
+        part = os.path.join(self.root, f"{cid}.{uuid.uuid4().hex}.part")
+        start = time.monotonic()
+        size = 0
+        try:
+            try:
+                with requests.get(f"{self.gateway}/ipfs/{cid}", stream=True, timeout=self.timeout) as response:
+                    if response.status_code == 404:
+                        raise ContentNotFound(f"{cid} is not available from the gateway")
+                    if response.status_code != 200:
+                        raise GatewayError(f"Gateway returned {response.status_code} for {cid}")
+                    with open(part, 'wb') as f:
+                        for block in response.iter_content(DOWNLOAD_CHUNK):
+                            size += len(block)
+                            if size > self.quota_bytes:
+                                raise GatewayError(f"{cid} is larger than the cache")
+                            f.write(block)
+            except requests.RequestException as e:
+                raise GatewayError(f"Gateway request for {cid} failed: {e}")
+            if self.verify and not matches_cid(part, cid):
+                with self._lock:
+                    self._counters["rejected"] += 1
+                raise GatewayError(f"Content from the gateway does not match {cid}")
+            os.replace(part, self.path(cid))
+        finally:
+            if os.path.exists(part):
+                os.remove(part)
+
+        with self._lock:
+            self._counters["downloads"] += 1
+            self._counters["downloaded_bytes"] += size
+            self._counters["download_seconds"] += time.monotonic() - start
+            self._files[cid] = size
+            self._bytes += size
+            for old in list(self._files):
+                if self._bytes <= self.quota_bytes:
+                    break
+                if old != cid:
+                    self._evict(old)
+        return self.path(cid)
+
+    def _evict(self, cid):
+        """Caller holds the lock. Readers that already opened the file keep it."""
+        self._bytes -= self._files.pop(cid)
+        try:
+            os.remove(self.path(cid))
+        except FileNotFoundError:
+            pass
+        self._counters["evicted"] += 1
+
+    def metrics(self):
+        with self._lock:
+            lookups = self._counters["hits"] + self._counters["misses"] + self._counters["coalesced"]
+            return dict(self._counters, files=len(self._files), bytes=self._bytes,
+                        quota_bytes=self.quota_bytes, downloading=len(self._inflight),
+                        hit_rate=self._counters["hits"] / lookups if lookups else None)
+
+
+cache = IpfsCache(IPFS_CACHE_DIR, int(IPFS_CACHE_MB * 1024 * 1024), IPFS_GATEWAY_URL, IPFS_FETCH_TIMEOUT_S,
+                  IPFS_CACHE_VERIFY)
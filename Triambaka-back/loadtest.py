@@ -0,0 +1,478 @@
+"""
+End-to-end load test of the API on an in-process chain with a local Pinata stand-in.
+
+    pip install -r requirements-dev.txt
+    python loadtest.py --concurrency 16 --duration 60
+    python loadtest.py --server async --mix embed=1,check=2,verify=2,lookup=6 --images img/
+    python loadtest.py --url http://127.0.0.1:5000 --mix embed=1,verify=1   # an already running server
+
+Deploys ContentRegistry from contracts/ on devchain's test chain and serves it
+over JSON-RPC, starts a Pinata-compatible stub and the API (app.py or
+async_app.py) as a subprocess wired to both, and registers a few contents
+(embed -> pin -> register) so every operation has data. Then --concurrency
+clients replay the weighted operation mix and throughput, latency percentiles
+and error rates are reported per operation. 429 responses are counted as shed,
+not as errors. Lookups and content reads of registered contents are checked
+against what was registered; contradicting answers fail the run.
+"""
+import argparse
+import asyncio
+import email.policy
+import io
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from email.parser import BytesParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import aiohttp
+import cv2
+import numpy as np
+
+import ipfs_cache
+import merkle
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.webp'}
+DEFAULT_MIX = "embed=2,check=3,verify=2,lookup=6,content=3,pin=1,register=1"
+# Operations that need the harness's own chain (accounts to sign with)
+CHAIN_OPERATIONS = {"register"}
+# Embeds use one of several rights-holder keys, so the same image yields new contents
+KEYS = [12345 + i for i in range(16)]
+
+
+# --- Pinata stand-in ---
+
+def _multipart_file(content_type, body, field='file'):
+    message = BytesParser(policy=email.policy.default).parsebytes(
+        b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body
+    )
+    for part in message.iter_parts():
+        if part.get_param('name', header='content-disposition') == field:
+            return part.get_payload(decode=True)
+    return None
+
+
+def serve_pinata(port=0):
+    """
+    Minimal Pinata stand-in: POST .../pinFileToIPFS pins the "file" field under
+    its CIDv0, GET /ipfs/<cid> returns it (a gateway for ipfs_cache). Runs in a daemon
+    thread; returns (server, url, pins).
+    """
+    pins = {}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self, status, body, content_type="application/json"):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            content = _multipart_file(self.headers.get("Content-Type", ""), body)
+            if not self.path.endswith("/pinFileToIPFS") or content is None:
+                return self._reply(400, b'{"error": "expected a multipart file field"}')
+            ipfs_hash = ipfs_cache.file_cid(io.BytesIO(content))
+            pins[ipfs_hash] = content
+            self._reply(200, json.dumps({"IpfsHash": ipfs_hash, "PinSize": len(content),
+                                         "Timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}).encode())
+
+        def do_GET(self):
+            content = pins.get(self.path.rsplit('/', 1)[-1]) if self.path.startswith("/ipfs/") else None
+            if content is None:
+                return self._reply(404, b'{"error": "not pinned"}')
+            self._reply(200, content, "application/octet-stream")
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}", pins
+
+
+# --- Environment ---
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_chain(accounts):
+    """
+    Deploys ContentRegistry, funds `accounts` new signing accounts and serves
+    the chain over JSON-RPC. Returns a dict with rpc_url, contract, chain_id,
+    gas_price and accounts.
+    """
+    import devchain
+    from eth_account import Account
+
+    web3, contract = devchain.deploy()
+    drift = devchain.abi_drift(contract.abi)
+    if drift:
+        print(f"warning: ContentRegistry_abi.json is out of date for: {', '.join(drift)}")
+    signers = [Account.create() for _ in range(accounts)]
+    for signer in signers:
+        web3.eth.send_transaction({"to": signer.address, "value": 10 ** 20})
+    server, url = devchain.serve_rpc(web3)
+    return {"server": server, "rpc_url": url, "contract": contract, "chain_id": web3.eth.chain_id,
+            "gas_price": 2 * web3.eth.gas_price, "accounts": signers}
+
+
+def start_server(kind, env, port, log_path, timeout=120):
+    """
+    Starts app.py (flask) or async_app.py as a subprocess and waits until it answers.
+    """
+    if kind == 'flask':
+        cmd = [sys.executable, '-m', 'flask', '--app', 'app', 'run', '--port', str(port), '--with-threads']
+    else:
+        cmd = [sys.executable, 'async_app.py']
+    log = open(log_path, 'wb')
+    proc = subprocess.Popen(cmd, cwd=BASE_DIR, env=dict(env, PORT=str(port)), stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"{kind} server exited with {proc.returncode}; see {log_path}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return proc
+        except OSError:
+            time.sleep(0.25)
+    proc.terminate()
+    raise RuntimeError(f"{kind} server did not start within {timeout}s; see {log_path}")
+
+
+# --- Workload ---
+
+def load_images(directory, count, size, seed):
+    """
+    Upload bodies: the image files in directory, or `count` synthetic photos
+    (smooth gradients, shapes and noise), alternately PNG and JPEG.
+    """
+    if directory:
+        paths = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                       if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS)
+        if not paths:
+            raise SystemExit(f"No images in {directory}")
+        images = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                images.append((os.path.basename(path), f.read()))
+        return images
+
+    rng = np.random.default_rng(seed)
+    width, height = size
+    yy, xx = np.mgrid[0:height, 0:width].astype(np.float32)
+    images = []
+    for i in range(count):
+        base = [128 + 100 * np.sin(xx / rng.uniform(40, 200) + rng.uniform(0, 6)) * np.cos(yy / rng.uniform(40, 200))
+                for _ in range(3)]
+        img = np.clip(np.dstack(base) + rng.normal(0, 6, (height, width, 3)), 0, 255).astype(np.uint8)
+        for _ in range(8):
+            center = (int(rng.integers(width)), int(rng.integers(height)))
+            cv2.circle(img, center, int(rng.integers(10, max(11, width // 6))), rng.integers(0, 255, 3).tolist(), -1)
+        ext = '.png' if i % 2 == 0 else '.jpg'
+        images.append((f"synthetic{i}{ext}", cv2.imencode(ext, img, [cv2.IMWRITE_JPEG_QUALITY, 92])[1].tobytes()))
+    return images
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        mix[name.strip()] = float(weight or 1)
+    unknown = set(mix) - set(OPERATIONS)
+    if unknown:
+        raise SystemExit(f"Unknown operations: {', '.join(sorted(unknown))} (known: {', '.join(OPERATIONS)})")
+    return mix
+
+
+class Workload:
+    """
+    Shared state of the clients: the originals, and the watermarked, pinned
+    and registered contents produced so far.
+    """
+
+    def __init__(self, base_url, images, chain, rng):
+        self.base_url = base_url
+        self.images = images
+        self.chain = chain
+        self.rng = rng
+        self.marked = []      # {"name", "data", "image_hash", "delta"}
+        self.pinned = []      # marked + "ipfs_hash", not registered yet
+        self.registered = []  # pinned, in content ID order
+        self.registered_hashes = set()
+        self.results = defaultdict(list)  # operation -> [(seconds, status)]
+        self.errors = {}                 # operation -> first error seen
+        self.wrong = defaultdict(int)    # operation -> 200 answers that contradict what was registered
+        self.web3 = None                 # AsyncWeb3 on the harness chain, while running
+
+    async def _request(self, session, op, method, path, **kwargs):
+        start = time.perf_counter()
+        try:
+            async with session.request(method, self.base_url + path, **kwargs) as response:
+                body = await response.read()
+                status = response.status
+                headers = response.headers
+        except Exception as e:
+            body, status, headers = str(e).encode(), 0, {}
+        self.results[op].append((time.perf_counter() - start, status))
+        if status not in (200, 304, 429) and op not in self.errors:
+            self.errors[op] = f"{status}: {body[:200].decode(errors='replace')}"
+        return status, headers, body
+
+    @staticmethod
+    def _form(field, name, data, **fields):
+        form = aiohttp.FormData()
+        form.add_field(field, data, filename=name)
+        for key, value in fields.items():
+            form.add_field(key, str(value))
+        return form
+
+    async def embed(self, session, client):
+        name, data = self.rng.choice(self.images)
+        key = self.rng.choice(KEYS)
+        status, headers, body = await self._request(session, "embed", "POST", "/api/watermark/embed",
+                                                    data=self._form('image', name, data, key=key))
+        if status == 200:
+            self.marked.append({"name": "watermarked" + os.path.splitext(name)[1], "data": body, "key": key,
+                                "image_hash": headers["X-Image-Hash"], "delta": float(headers["X-Delta"])})
+
+    async def check(self, session, client):
+        if self.rng.random() < 0.3:
+            name, data = self.rng.choice(self.images)  # originals take the embed-and-hash path
+        else:
+            item = self.rng.choice(self.marked)
+            name, data = item["name"], item["data"]
+        await self._request(session, "check", "POST", "/api/watermark/check_image",
+                            data=self._form('image', name, data))
+
+    async def verify(self, session, client):
+        item = self.rng.choice(self.marked)
+        await self._request(session, "verify", "POST", "/api/watermark/verify",
+                            data=self._form('image', item["name"], item["data"], key=item["key"]))
+
+    async def pin(self, session, client):
+        item = self.rng.choice(self.marked)
+        status, _, body = await self._request(session, "pin", "POST", "/api/ipfs/upload_ipfs",
+                                              data=self._form('file', item["name"], item["data"]))
+        if status == 200 and item["image_hash"] not in self.registered_hashes:
+            self.pinned.append(dict(item, ipfs_hash=json.loads(body)["ipfs_hash"]))
+
+    async def register(self, session, client):
+        item = self.pinned.pop(self.rng.randrange(len(self.pinned)))
+        if item["image_hash"] in self.registered_hashes:
+            return
+        self.registered_hashes.add(item["image_hash"])
+        signer = self.chain["accounts"][client % len(self.chain["accounts"])]
+        tx = {
+            "to": self.chain["contract"].address,
+            "data": self.chain["contract"].encode_abi(
+                "registerContent", [item["ipfs_hash"], item["image_hash"], merkle.chain_delta(item["delta"])]
+            ),
+            "gas": 1_000_000,
+            "gasPrice": self.chain["gas_price"],
+            "nonce": await self.web3.eth.get_transaction_count(signer.address, "pending"),
+            "chainId": self.chain["chain_id"],
+        }
+        signed_tx = "0x" + signer.sign_transaction(tx).raw_transaction.hex().removeprefix("0x")
+        status, _, _ = await self._request(session, "register", "POST", "/api/blockchain/store_metadata",
+                                           json={"signed_tx": signed_tx})
+        if status == 200:
+            self.registered.append(item)
+        else:
+            self.registered_hashes.discard(item["image_hash"])
+
+    async def lookup(self, session, client):
+        registered = self.registered and self.rng.random() < 0.7
+        item = self.rng.choice(self.registered if registered else self.marked)
+        status, _, body = await self._request(session, "lookup", "GET", "/api/blockchain/check_image_hash",
+                                              params={"image_hash": item["image_hash"]})
+        if status == 200 and registered and json.loads(body).get("ipfs_hash") != item["ipfs_hash"]:
+            self.wrong["lookup"] += 1
+
+    async def content(self, session, client):
+        content_id = self.rng.randint(1, len(self.registered))
+        status, _, body = await self._request(session, "content", "GET", "/api/blockchain/get_content",
+                                              params={"content_id": content_id})
+        if status == 200 and json.loads(body).get("sha256_hash") not in self.registered_hashes:
+            self.wrong["content"] += 1
+
+    def runnable(self, op):
+        """
+        The operation to run for op: its prerequisites fall back to the
+        operation that produces them (embed -> pin -> register).
+        """
+        if op in ("check", "verify", "pin", "lookup") and not self.marked:
+            return "embed"
+        if op == "register" and not self.pinned:
+            return "pin" if self.marked else "embed"
+        if op == "content" and not self.registered:
+            return "register" if self.pinned and self.chain else "lookup" if self.marked else "embed"
+        return op
+
+
+OPERATIONS = ["embed", "check", "verify", "lookup", "content", "pin", "register"]
+
+
+async def seed(workload, session, count):
+    """
+    Runs embed -> pin -> register `count` times before measuring.
+    """
+    for i in range(count):
+        await workload.embed(session, i)
+        if workload.marked:
+            await workload.pin(session, i)
+        if workload.pinned and workload.chain:
+            await workload.register(session, i)
+    workload.results.clear()
+    workload.errors.clear()
+    workload.wrong.clear()
+
+
+async def run_load(workload, mix, concurrency, duration, total, seed_count):
+    from web3 import AsyncWeb3, AsyncHTTPProvider
+
+    names, weights = list(mix), list(mix.values())
+    timeout = aiohttp.ClientTimeout(total=300)
+    if workload.chain:
+        workload.web3 = AsyncWeb3(AsyncHTTPProvider(workload.chain["rpc_url"]))
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency), timeout=timeout) as session:
+        await seed(workload, session, seed_count)
+        issued = 0
+        deadline = time.monotonic() + duration
+
+        async def client(index):
+            nonlocal issued
+            while time.monotonic() < deadline and (total is None or issued < total):
+                issued += 1
+                op = workload.runnable(workload.rng.choices(names, weights)[0])
+                await getattr(workload, op)(session, index)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client(i) for i in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    if workload.web3 is not None:
+        await workload.web3.provider.disconnect()
+    return elapsed
+
+
+def summarize(results, elapsed):
+    """
+    Per-operation count, ok throughput, latency percentiles (ms) and shed/error rates.
+    """
+    rows = {}
+    for op in OPERATIONS + ["total"]:
+        samples = [s for name in (OPERATIONS if op == "total" else [op]) for s in results.get(name, [])]
+        if not samples:
+            continue
+        latencies = np.array([seconds for seconds, _ in samples]) * 1000
+        statuses = np.array([status for _, status in samples])
+        ok = int(np.sum((statuses >= 200) & (statuses < 400)))
+        shed = int(np.sum(statuses == 429))
+        rows[op] = {
+            "count": len(samples),
+            "ok_per_s": ok / elapsed,
+            "p50_ms": float(np.percentile(latencies, 50)),
+            "p90_ms": float(np.percentile(latencies, 90)),
+            "p99_ms": float(np.percentile(latencies, 99)),
+            "max_ms": float(latencies.max()),
+            "shed_rate": shed / len(samples),
+            "error_rate": (len(samples) - ok - shed) / len(samples),
+        }
+    return rows
+
+
+def print_report(rows, elapsed, errors, wrong):
+    print(f"{'operation':<10}{'count':>8}{'ok/s':>9}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+          f"{'shed':>8}{'errors':>8}")
+    for op, row in rows.items():
+        print(f"{op:<10}{row['count']:>8}{row['ok_per_s']:>9.2f}{row['p50_ms']:>10.1f}{row['p90_ms']:>10.1f}"
+              f"{row['p99_ms']:>10.1f}{row['max_ms']:>10.1f}{row['shed_rate']:>8.1%}{row['error_rate']:>8.1%}")
+    print(f"{elapsed:.1f}s")
+    for op, error in errors.items():
+        print(f"first {op} error: {error}")
+    for op, count in wrong.items():
+        print(f"{op}: {count} answers contradict the registered contents")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end load test of the Triambaka API")
+    parser.add_argument('--server', choices=['flask', 'async'], default='flask', help="server to start")
+    parser.add_argument('--url', help="test an already running server instead (no chain, no register)")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="operation weights, e.g. embed=1,lookup=4")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=30, help="seconds of load")
+    parser.add_argument('--requests', type=int, help="stop after this many requests")
+    parser.add_argument('--seed-contents', type=int, default=8, help="contents registered before measuring")
+    parser.add_argument('--images', help="directory of upload images (default: synthetic)")
+    parser.add_argument('--corpus', type=int, default=8, help="synthetic images")
+    parser.add_argument('--size', type=int, nargs=2, default=(1024, 768), metavar=('W', 'H'))
+    parser.add_argument('--seed', type=int, default=0, help="random seed of images and traffic")
+    parser.add_argument('--json', help="write the report here as JSON")
+    parser.add_argument('--server-log', help="server output (default: in the temp directory)")
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    images = load_images(args.images, args.corpus, args.size, args.seed)
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix="triambaka-loadtest-")
+    chain, proc, pinata = None, None, None
+    try:
+        if args.url:
+            if CHAIN_OPERATIONS & set(mix):
+                raise SystemExit(f"--url cannot run {', '.join(sorted(CHAIN_OPERATIONS & set(mix)))}")
+            base_url = args.url.rstrip('/')
+        else:
+            chain = start_chain(args.concurrency)
+            pinata, pinata_url, _ = serve_pinata()
+            env = dict(os.environ,
+                       GANACHE_URL=chain["rpc_url"], BLOCKCHAIN_URL=chain["rpc_url"],
+                       CONTRACT_ADDRESS=chain["contract"].address,
+                       PINATA_BASE_URL=pinata_url + "/pinning/pinFileToIPFS",
+                       PINATA_API_KEY="loadtest", PINATA_API_SECRET="loadtest",
+                       DATABASE_URL="sqlite:///" + os.path.join(workdir, "registry.db"),
+                       SCRATCH_DIR=os.path.join(workdir, "scratch"))
+            port = _free_port()
+            log_path = args.server_log or os.path.join(tempfile.gettempdir(), f"triambaka-loadtest-{args.server}.log")
+            proc = start_server(args.server, env, port, log_path)
+            base_url = f"http://127.0.0.1:{port}"
+            print(f"{args.server} server on {base_url} (log: {log_path}), chain on {chain['rpc_url']}")
+
+        workload = Workload(base_url, images, chain, rng)
+        elapsed = asyncio.run(run_load(workload, mix, args.concurrency, args.duration, args.requests,
+                                       args.seed_contents))
+        rows = summarize(workload.results, elapsed)
+        print_report(rows, elapsed, workload.errors, workload.wrong)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({"server": args.server if not args.url else args.url, "concurrency": args.concurrency,
+                           "mix": mix, "seconds": elapsed, "operations": rows, "errors": workload.errors,
+                           "wrong_answers": dict(workload.wrong)}, f, indent=2)
+        return 1 if rows.get("total", {}).get("error_rate") or workload.wrong else 0
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait(timeout=30)
+        if pinata is not None:
+            pinata.shutdown()
+        if chain is not None:
+            chain["server"].shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
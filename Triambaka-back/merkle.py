@@ -0,0 +1,63 @@
+"""
+Merkle trees for batch content registration, matching ContentRegistry's
+batchLeaf() and verifyBatchContent(): leaves are
+keccak256(keccak256(abi.encode(sha256Hash, ipfsHash, delta))) and inner nodes
+hash their two children in sorted order. A level with an odd number of nodes
+carries its last node up unchanged.
+"""
+from eth_abi import encode
+from eth_utils import keccak
+
+# The frontend registers round(delta * 1e6) on chain; batches use the same unit.
+DELTA_SCALE = 10 ** 6
+
+
+def chain_delta(delta):
+    return int(round(float(delta) * DELTA_SCALE))
+
+
+def leaf_hash(sha256_hash, ipfs_hash, delta):
+    """
+    Leaf for one content; delta is the on-chain (scaled integer) value.
+    """
+    return keccak(keccak(encode(['string', 'string', 'uint256'], [sha256_hash, ipfs_hash, int(delta)])))
+
+
+def _hash_pair(a, b):
+    return keccak(a + b) if a < b else keccak(b + a)
+
+
+def build_levels(leaves):
+    """
+    All levels of the tree, leaves first and the root level last.
+    """
+    if not leaves:
+        raise ValueError("Cannot build a Merkle tree without leaves")
+    levels = [list(leaves)]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        parents = [_hash_pair(level[k], level[k + 1]) for k in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            parents.append(level[-1])
+        levels.append(parents)
+    return levels
+
+
+def proof_for(levels, index):
+    """
+    Sibling hashes from leaf index up to the root.
+    """
+    proof = []
+    for level in levels[:-1]:
+        sibling = index ^ 1
+        if sibling < len(level):
+            proof.append(level[sibling])
+        index //= 2
+    return proof
+
+
+def verify_proof(leaf, proof, root):
+    node = leaf
+    for sibling in proof:
+        node = _hash_pair(node, sibling)
+    return node == root
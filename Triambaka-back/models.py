@@ -0,0 +1,165 @@
+import hashlib
+import json
+from datetime import datetime, timezone
+
+from database import db
+
+
+def key_fingerprint(key):
+    """
+    Returns a short, non-reversible identifier for a watermark key, so records
+    can name the key they were embedded with without storing the key itself.
+    """
+    return hashlib.sha256(f"triambaka-key:{key}".encode()).hexdigest()[:16]
+
+
+class EmbedRecord(db.Model):
+    """
+    One row per watermarked image produced by /embed, indexed by the SHA-256 of
+    the output file and of its decoded pixels.
+    """
+    __tablename__ = "embed_records"
+
+    id = db.Column(db.Integer, primary_key=True)
+    image_hash = db.Column(db.String(64), unique=True, nullable=False, index=True)
+    pixel_hash = db.Column(db.String(64), nullable=False, index=True)
+    key_id = db.Column(db.String(16), nullable=False, index=True)
+    delta = db.Column(db.Float, nullable=False)
+    ber = db.Column(db.Float, nullable=False)
+    width = db.Column(db.Integer, nullable=False)
+    height = db.Column(db.Integer, nullable=False)
+    # Watermark format (watermark_engine FORMAT_VERSIONS); rows from before v2 are v1
+    format_version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    # ContentRegistry ID carried by a payload watermark (watermark_engine/payload.py), if any
+    content_id = db.Column(db.Integer, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+
+    def to_dict(self):
+        return {
+            "image_hash": self.image_hash,
+            "pixel_hash": self.pixel_hash,
+            "key_id": self.key_id,
+            "delta": self.delta,
+            "ber": self.ber,
+            "width": self.width,
+            "height": self.height,
+            "format_version": self.format_version,
+            "content_id": self.content_id,
+            "created_at": self.created_at.isoformat(),
+        }
+
+
+def record_embed(image_hash, pixel_hash, key, delta, ber, width, height, format_version=1, content_id=None):
+    """
+    Stores (or refreshes) the embed record for a watermarked image.
+    """
+    record = EmbedRecord.query.filter_by(image_hash=image_hash).one_or_none()
+    if record is None:
+        record = EmbedRecord(image_hash=image_hash)
+        db.session.add(record)
+    record.pixel_hash = pixel_hash
+    record.key_id = key_fingerprint(key)
+    record.delta = float(delta)
+    record.ber = float(ber)
+    record.width = int(width)
+    record.height = int(height)
+    record.format_version = int(format_version)
+    record.content_id = content_id
+    db.session.commit()
+    return record
+
+
+def find_by_image_hash(image_hash, key=None):
+    query = EmbedRecord.query.filter_by(image_hash=image_hash)
+    if key is not None:
+        query = query.filter_by(key_id=key_fingerprint(key))
+    return query.one_or_none()
+
+
+def find_by_pixel_hash(pixel_hash, key=None):
+    query = EmbedRecord.query.filter_by(pixel_hash=pixel_hash)
+    if key is not None:
+        query = query.filter_by(key_id=key_fingerprint(key))
+    return query.order_by(EmbedRecord.id.desc()).first()
+
+
+def recorded_dimensions(key, limit=20):
+    """
+    Distinct (width, height) pairs of images embedded with a key, most recent first.
+    """
+    rows = (db.session.query(EmbedRecord.width, EmbedRecord.height)
+            .filter_by(key_id=key_fingerprint(key))
+            .group_by(EmbedRecord.width, EmbedRecord.height)
+            .order_by(db.func.max(EmbedRecord.id).desc())
+            .limit(limit)
+            .all())
+    return [(width, height) for width, height in rows]
+
+
+class ContentBatch(db.Model):
+    """
+    A batch of contents prepared for ContentRegistry.registerBatch, identified
+    by its Merkle root.
+    """
+    __tablename__ = "content_batches"
+
+    id = db.Column(db.Integer, primary_key=True)
+    merkle_root = db.Column(db.String(66), unique=True, nullable=False, index=True)
+    leaf_count = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+
+
+class BatchLeaf(db.Model):
+    """
+    One content of a batch with its inclusion proof, indexed by image hash.
+    """
+    __tablename__ = "batch_leaves"
+
+    id = db.Column(db.Integer, primary_key=True)
+    batch_id = db.Column(db.Integer, db.ForeignKey("content_batches.id"), nullable=False, index=True)
+    leaf_index = db.Column(db.Integer, nullable=False)
+    sha256_hash = db.Column(db.String(64), nullable=False, index=True)
+    ipfs_hash = db.Column(db.String(128), nullable=False)
+    delta = db.Column(db.BigInteger, nullable=False)  # on-chain (scaled) value
+    proof = db.Column(db.Text, nullable=False)  # JSON list of 0x-prefixed sibling hashes
+
+    batch = db.relationship(ContentBatch)
+
+    def to_dict(self):
+        return {
+            "sha256_hash": self.sha256_hash,
+            "ipfs_hash": self.ipfs_hash,
+            "delta": self.delta,
+            "leaf_index": self.leaf_index,
+            "merkle_root": self.batch.merkle_root,
+            "proof": json.loads(self.proof),
+        }
+
+
+def record_batch(merkle_root, leaves):
+    """
+    Stores a batch and its leaves; leaves are dicts with sha256_hash, ipfs_hash,
+    delta and proof (list of hex strings), in leaf order. A root that is already
+    stored is returned unchanged.
+    """
+    batch = ContentBatch.query.filter_by(merkle_root=merkle_root).one_or_none()
+    if batch is not None:
+        return batch
+    batch = ContentBatch(merkle_root=merkle_root, leaf_count=len(leaves))
+    db.session.add(batch)
+    db.session.flush()
+    db.session.add_all(
+        BatchLeaf(batch_id=batch.id, leaf_index=index, sha256_hash=leaf["sha256_hash"], ipfs_hash=leaf["ipfs_hash"],
+                  delta=int(leaf["delta"]), proof=json.dumps(leaf["proof"]))
+        for index, leaf in enumerate(leaves)
+    )
+    db.session.commit()
+    return batch
+
+
+def find_batch_leaves(sha256_hash):
+    """
+    Batch leaves for an image hash, in the order their batches were prepared
+    (the on-chain order is only known from rootToBatchId).
+    """
+    return BatchLeaf.query.filter_by(sha256_hash=sha256_hash).order_by(BatchLeaf.batch_id).all()
@@ -0,0 +1,291 @@
+"""
+In-memory Bloom filter of every sha256Hash registered in ContentRegistry, one
+by one or in a batch, so lookups of unregistered images (most of what a
+crawler checks) are answered without a call to the node.
+
+The filter is built from chain state (getContentsRange, pinned to one block,
+plus the hashes listed by BatchRegistered events up to it) and then follows
+ContentRegistered and BatchRegistered events. Building and syncing run in a
+background thread that lookups start on demand, so a lookup never waits on the
+node. A "definitely absent" answer is only given when the filter has seen
+every block up to the block being asked about, or, for 'latest', when it
+synced within REGISTRY_FILTER_MAX_LAG_S; otherwise the caller asks the chain.
+Snapshots on disk make restarts warm: one is reused when its block is still
+on the chain, and only the events after it are replayed.
+"""
+import hashlib
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+REGISTRY_FILTER = os.getenv("REGISTRY_FILTER", "1") == "1"
+# Registered hashes the filter is sized for; it is rebuilt twice as large when they are exceeded
+REGISTRY_FILTER_CAPACITY = int(os.getenv("REGISTRY_FILTER_CAPACITY", "1000000"))
+# False-positive rate at capacity (a false positive only costs the usual chain lookup)
+REGISTRY_FILTER_FP_RATE = float(os.getenv("REGISTRY_FILTER_FP_RATE", "0.001"))
+# New events are fetched at most this often
+REGISTRY_FILTER_SYNC_S = float(os.getenv("REGISTRY_FILTER_SYNC_S", "2"))
+# 'latest' lookups trust the filter only if it synced this recently
+REGISTRY_FILTER_MAX_LAG_S = float(os.getenv("REGISTRY_FILTER_MAX_LAG_S", "10"))
+# Snapshot file for warm starts ("" disables)
+REGISTRY_FILTER_SNAPSHOT = os.getenv("REGISTRY_FILTER_SNAPSHOT", "registry_filter.bin")
+
+# Snapshots are written at most this often
+SNAPSHOT_INTERVAL_S = 60
+# Blocks per eth_getLogs request
+LOG_CHUNK_BLOCKS = 10000
+# Contents per getContentsRange call while building
+BUILD_PAGE_SIZE = 500
+
+_SNAPSHOT_MAGIC = b"TRIAMBAKA-BLOOM-1\n"
+
+
+class BloomFilter:
+    """
+    Bloom filter of strings sized for capacity items at fp_rate. Bit positions
+    come from double hashing of one BLAKE2b digest.
+    """
+
+    def __init__(self, capacity, fp_rate, bits=None, hashes=None, data=None, count=0):
+        self.capacity = capacity
+        self.fp_rate = fp_rate
+        if bits is None:
+            bits = math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2 / 8) * 8
+            hashes = max(1, round(bits / capacity * math.log(2)))
+        self.bits = bits
+        self.hashes = hashes
+        self.data = bytearray(bits // 8) if data is None else bytearray(data)
+        self.count = count
+
+    def _positions(self, value):
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, value):
+        for position in self._positions(value):
+            self.data[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        data = self.data
+        return all(data[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+    def estimated_fp_rate(self):
+        """False-positive rate at the current number of items."""
+        return (1 - math.exp(-self.hashes * self.count / self.bits)) ** self.hashes
+
+
+class RegistryFilter:
+    """
+    Bloom filter of a ContentRegistry's sha256Hash values kept in sync with the
+    chain. Thread-safe; one instance per process.
+    """
+
+    def __init__(self, web3, contract, capacity=REGISTRY_FILTER_CAPACITY, fp_rate=REGISTRY_FILTER_FP_RATE,
+                 snapshot_path=REGISTRY_FILTER_SNAPSHOT, enabled=REGISTRY_FILTER):
+        self.web3 = web3
+        self.contract = contract
+        self.capacity = capacity
+        self.fp_rate = fp_rate
+        self.snapshot_path = snapshot_path
+        self.enabled = enabled
+        self._bloom = None
+        self._block = None  # (number, hash) of the last block the filter has seen
+        self._synced_at = 0.0
+        self._snapshot_at = 0.0
+        self._syncing = threading.Lock()
+        self._lock = threading.Lock()
+        self._counters = {"lookups": 0, "absent": 0, "maybe_present": 0, "unknown": 0, "syncs": 0,
+                          "sync_errors": 0, "builds": 0, "warm_starts": 0}
+
+    # --- Lookups ---
+
+    def definitely_absent(self, sha256_hash, block_identifier='latest'):
+        """
+        True only if the hash is certainly not registered as of block_identifier
+        (a block number or 'latest'). False means it may be, or that the filter
+        cannot tell yet; either way the caller asks the chain.
+        """
+        if not self.enabled:
+            return False
+        self._counters["lookups"] += 1
+        bloom, block, synced_at = self._bloom, self._block, self._synced_at
+        if isinstance(block_identifier, int):
+            current = block is not None and block[0] >= block_identifier
+        else:
+            current = block is not None and time.monotonic() - synced_at < REGISTRY_FILTER_MAX_LAG_S
+        if not current or time.monotonic() - synced_at >= REGISTRY_FILTER_SYNC_S:
+            self.refresh()
+        if bloom is None or not current:
+            self._counters["unknown"] += 1
+            return False
+        if sha256_hash in bloom:
+            self._counters["maybe_present"] += 1
+            return False
+        self._counters["absent"] += 1
+        return True
+
+    def invalidate(self):
+        """
+        Stops trusting 'latest' until the next sync, e.g. after this server sent
+        a registration, and starts that sync.
+        """
+        self._synced_at = 0.0
+        self.refresh()
+
+    # --- Syncing ---
+
+    def refresh(self):
+        """
+        Starts a background sync unless one is running.
+        """
+        if self.enabled and self._syncing.acquire(blocking=False):
+            threading.Thread(target=self._sync_in_background, daemon=True).start()
+
+    def _sync_in_background(self):
+        try:
+            self.sync()
+        except Exception:
+            self._counters["sync_errors"] += 1
+            logger.warning("Registry filter sync failed", exc_info=True)
+        finally:
+            self._syncing.release()
+
+    def sync(self):
+        """
+        Brings the filter up to the latest block: warm start or build when it
+        has none, otherwise replays new registration events. Rebuilds
+        when the last block it saw is no longer on the chain.
+        """
+        latest = self.web3.eth.get_block('latest')
+        if self._block is not None and not self._on_chain(self._block):
+            logger.info("Registry filter block %s left the chain; rebuilding", self._block[0])
+            self._bloom, self._block = None, None
+        if self._bloom is None and not self._load_snapshot():
+            self._build(latest)
+        elif latest['number'] > self._block[0]:
+            self._replay(self._block[0] + 1, latest['number'])
+            self._block = (latest['number'], bytes(latest['hash']))
+        if self._bloom.count > self._bloom.capacity:
+            self.capacity = 2 * self._bloom.count
+            self._build(latest)
+        self._synced_at = time.monotonic()
+        self._counters["syncs"] += 1
+        if time.monotonic() - self._snapshot_at >= SNAPSHOT_INTERVAL_S:
+            self.save_snapshot()
+
+    def _on_chain(self, block):
+        try:
+            return bytes(self.web3.eth.get_block(block[0])['hash']) == block[1]
+        except Exception:
+            return False
+
+    def _build(self, block):
+        """
+        Builds a new filter from every content registered as of block. Batch
+        hashes are only listed in events, so those are read from the start of
+        the chain when there are batches.
+        """
+        bloom = BloomFilter(self.capacity, self.fp_rate)
+        number = block['number']
+        total = self.contract.functions.contentCount().call(block_identifier=number)
+        for start in range(1, total + 1, BUILD_PAGE_SIZE):
+            page = self.contract.functions.getContentsRange(start, BUILD_PAGE_SIZE).call(block_identifier=number)
+            for content in page:
+                bloom.add(content[2])
+        if self.contract.functions.batchCount().call(block_identifier=number):
+            self._add_logs(bloom, self.contract.events.BatchRegistered, 0, number)
+        with self._lock:
+            self._bloom, self._block = bloom, (number, bytes(block['hash']))
+        self._counters["builds"] += 1
+
+    def _replay(self, from_block, to_block):
+        for event in (self.contract.events.ContentRegistered, self.contract.events.BatchRegistered):
+            self._add_logs(self._bloom, event, from_block, to_block)
+
+    @staticmethod
+    def _add_logs(bloom, event, from_block, to_block):
+        """
+        Adds the hashes of ContentRegistered (sha256Hash) or BatchRegistered
+        (sha256Hashes) events in a block range.
+        """
+        for start in range(from_block, to_block + 1, LOG_CHUNK_BLOCKS):
+            for log in event.get_logs(from_block=start, to_block=min(start + LOG_CHUNK_BLOCKS - 1, to_block)):
+                args = log['args']
+                for sha256_hash in args['sha256Hashes'] if 'sha256Hashes' in args else [args['sha256Hash']]:
+                    bloom.add(sha256_hash)
+
+    # --- Snapshots ---
+
+    def save_snapshot(self):
+        """
+        Writes the filter and the block it is current at to snapshot_path (atomically).
+        """
+        if not self.snapshot_path or self._bloom is None:
+            return
+        with self._lock:
+            bloom, block = self._bloom, self._block
+            data = bytes(bloom.data)
+        header = {"contract": self.contract.address, "block": block[0], "block_hash": block[1].hex(),
+                  "capacity": bloom.capacity, "fp_rate": bloom.fp_rate, "bits": bloom.bits, "hashes": bloom.hashes,
+                  "count": bloom.count}
+        temp_path = f"{self.snapshot_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(_SNAPSHOT_MAGIC + json.dumps(header).encode() + b"\n" + data)
+        os.replace(temp_path, self.snapshot_path)
+        self._snapshot_at = time.monotonic()
+
+    def _load_snapshot(self):
+        """
+        Restores the filter from snapshot_path if it belongs to this contract
+        and its block is still on the chain, then replays the events since.
+        Returns whether it did.
+        """
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return False
+        try:
+            with open(self.snapshot_path, 'rb') as f:
+                if f.readline() != _SNAPSHOT_MAGIC:
+                    return False
+                header = json.loads(f.readline())
+                data = f.read()
+            block = (header["block"], bytes.fromhex(header["block_hash"]))
+            if header["contract"] != self.contract.address or len(data) * 8 != header["bits"] \
+                    or not self._on_chain(block):
+                return False
+        except (OSError, ValueError, KeyError):
+            logger.warning("Ignoring unreadable registry filter snapshot %s", self.snapshot_path)
+            return False
+
+        bloom = BloomFilter(header["capacity"], header["fp_rate"], header["bits"], header["hashes"], data,
+                            header["count"])
+        with self._lock:
+            self._bloom, self._block = bloom, block
+        latest = self.web3.eth.get_block('latest')
+        self._replay(block[0] + 1, latest['number'])
+        self._block = (latest['number'], bytes(latest['hash']))
+        self._counters["warm_starts"] += 1
+        return True
+
+    def metrics(self):
+        bloom, block = self._bloom, self._block
+        return {
+            "enabled": self.enabled,
+            "ready": bloom is not None,
+            "block": block[0] if block else None,
+            "seconds_since_sync": time.monotonic() - self._synced_at if self._synced_at else None,
+            "capacity": bloom.capacity if bloom else self.capacity,
+            "fp_rate": bloom.fp_rate if bloom else self.fp_rate,
+            "estimated_fp_rate": bloom.estimated_fp_rate() if bloom else None,
+            "registered_hashes": bloom.count if bloom else 0,
+            "bits": bloom.bits if bloom else None,
+            "hash_functions": bloom.hashes if bloom else None,
+            "memory_bytes": len(bloom.data) if bloom else 0,
+            **self._counters,
+        }
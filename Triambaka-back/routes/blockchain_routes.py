@@ -1,12 +1,20 @@
 import os
 import json
-from flask import Blueprint, request, jsonify
+import hashlib
+from flask import Blueprint, request, jsonify, Response
 from web3 import Web3
+from web3.exceptions import ContractLogicError
 from dotenv import load_dotenv
+import admission
+import merkle
+import registry_filter
+import singleflight
+from models import record_batch, find_batch_leaves
 
 load_dotenv()
 
 blockchain_bp = Blueprint('blockchain', __name__)
+admission.limit_blueprint(blockchain_bp, admission.chain)
 
 # Load environment variables
 GANACHE_URL = os.getenv("GANACHE_URL", "http://127.0.0.1:7545")
@@ -22,6 +30,215 @@ with open("./routes/ContentRegistry_abi.json", 'r') as abi_file:
 contract_address = Web3.to_checksum_address(CONTRACT_ADDRESS)
 contract = web3.eth.contract(address=contract_address, abi=abi)
 
+# Registered hashes, so lookups of unregistered images skip the node (see registry_filter.py)
+content_filter = registry_filter.RegistryFilter(web3, contract)
+
+# Most records returned by one getContentsRange/getContents call
+MAX_PAGE_SIZE = int(os.getenv("CONTENT_PAGE_SIZE_MAX", "500"))
+
+# Registered contents never change, so responses made only of them can be cached for good
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Responses that depend on the latest block are revalidated after this many seconds
+BLOCK_CACHE_MAX_AGE = int(os.getenv("BLOCK_CACHE_MAX_AGE_S", "0"))
+BLOCK_CACHE_CONTROL = f"public, max-age={BLOCK_CACHE_MAX_AGE}, must-revalidate"
+
+def format_content(content, content_id=None):
+    """Converts a getContent() tuple into the JSON shape the API returns."""
+    data = {
+        "owner": content[0],
+        "ipfs_hash": content[1],
+        "sha256_hash": content[2],
+        "timestamp": content[3],
+        "delta": content[4]
+    }
+    if content_id is not None:
+        data = {"exists": True, "content_id": content_id, **data}
+    return data
+
+
+def format_contents(contents, content_ids):
+    """Formats the Content[] returned by getContentsRange/getContents."""
+    return [{"content_id": content_id, **format_content(content)} for content_id, content in zip(content_ids, contents)]
+
+
+def parse_page(args):
+    """
+    Reads start/count query arguments; returns (start, count) or raises ValueError.
+    """
+    start = int(args.get('start', 1))
+    count = int(args.get('count', MAX_PAGE_SIZE))
+    if start < 1 or count < 1:
+        raise ValueError("start and count must be positive")
+    return start, min(count, MAX_PAGE_SIZE)
+
+
+def body_etag(body):
+    """Strong ETag of a response body (bytes), without quotes."""
+    return hashlib.sha1(body).hexdigest()
+
+
+def block_etag(block):
+    """
+    ETag (without quotes) of a response computed at a block. It changes only when
+    a block is mined, or when the chain is reset since the block hash is part of it.
+    """
+    return f"{block['number']}-{bytes(block['hash']).hex()[:16]}"
+
+
+def etag_matches(if_none_match, etag):
+    """Whether an If-None-Match header value matches etag (weak comparison)."""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or any(tag.removeprefix('W/').strip('"') == etag for tag in tags)
+
+
+def immutable_response(payload):
+    """JSON response that never changes, answering If-None-Match with 304."""
+    response = jsonify(payload)
+    response.set_etag(body_etag(response.get_data()))
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response.make_conditional(request)
+
+
+def block_cached_response(build):
+    """
+    Runs build(block_number) -> (payload, status) pinned to the latest block and
+    tags the response with that block. If the client already has the response
+    for this block, answers 304 without calling build.
+    """
+    try:
+        block = web3.eth.get_block('latest')
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    etag = block_etag(block)
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        response = Response(status=304)
+    else:
+        payload, status = build(block['number'])
+        response = jsonify(payload)
+        response.status_code = status
+        if status != 200:
+            return response
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = BLOCK_CACHE_CONTROL
+    return response
+
+
+def _proof_bytes(proof):
+    return [bytes.fromhex(node[2:]) for node in proof]
+
+
+def batch_leaves_on_chain(image_hash, block_identifier='latest'):
+    """
+    Batch leaves of an image hash as (on-chain batch ID, leaf): registered
+    batches first, in on-chain order, then batches prepared but not
+    registered (yet), whose ID is 0. A hash in several batches belongs to the
+    batch registered first.
+    """
+    leaves = [(contract.functions.rootToBatchId(bytes.fromhex(leaf.batch.merkle_root[2:])).call(
+        block_identifier=block_identifier
+    ), leaf) for leaf in find_batch_leaves(image_hash)]
+    return sorted(leaves, key=lambda item: (item[0] == 0, item[0]))
+
+
+def verify_leaf(batch_id, leaf, block_identifier='latest'):
+    """Whether verifyBatchContent accepts a leaf's proof for a registered batch."""
+    return batch_id != 0 and contract.functions.verifyBatchContent(
+        batch_id, leaf.sha256_hash, leaf.ipfs_hash, leaf.delta, _proof_bytes(json.loads(leaf.proof))
+    ).call(block_identifier=block_identifier)
+
+
+def batch_inclusion(image_hash, block_identifier='latest'):
+    """
+    Returns the on-chain batch record of an image hash that was registered as
+    part of a batch, or None. The batch comes from hashToBatchId; the leaf
+    (IPFS hash, delta, proof) is filled in when this server prepared that batch
+    and verifyBatchContent accepts its proof, and is None otherwise (the
+    batch manifest has it).
+    """
+    batch_id = contract.functions.hashToBatchId(image_hash).call(block_identifier=block_identifier)
+    if batch_id == 0:
+        return None
+    owner, merkle_root, _, manifest_ipfs_hash, timestamp = contract.functions.batches(batch_id).call(
+        block_identifier=block_identifier
+    )
+    merkle_root = "0x" + bytes(merkle_root).hex()
+    leaf = next((leaf for leaf in find_batch_leaves(image_hash)
+                 if leaf.batch.merkle_root == merkle_root and verify_leaf(batch_id, leaf, block_identifier)), None)
+    return {
+        "exists": True,
+        "content_id": None,
+        "batch_id": batch_id,
+        "owner": owner,
+        "ipfs_hash": leaf.ipfs_hash if leaf else None,
+        "sha256_hash": image_hash,
+        "timestamp": timestamp,
+        "delta": leaf.delta if leaf else None,
+        "merkle_root": merkle_root,
+        "manifest_ipfs_hash": manifest_ipfs_hash,
+        "proof": json.loads(leaf.proof) if leaf else None
+    }
+
+
+def lookup_image_hash(image_hash, block_identifier='latest'):
+    """
+    Looks an image hash up on chain. Returns (payload, status code) so it can be
+    used both by the route and in-process by other blueprints. Identical
+    concurrent lookups share one (see singleflight.py).
+    """
+    return singleflight.chain_reads.do(("image_hash", image_hash, block_identifier), _lookup_image_hash,
+                                       image_hash, block_identifier)
+
+
+def _lookup_image_hash(image_hash, block_identifier):
+    try:
+        # Step 1: Resolve the hash to its content in one call (ID 0 = not registered on its own),
+        # unless the registry filter already knows it is not registered at all
+        if content_filter.definitely_absent(image_hash, block_identifier):
+            return {"exists": False, "message": "Image hash not found on blockchain."}, 200
+        content_id, *content = contract.functions.getContentByHash(image_hash).call(
+            block_identifier=block_identifier
+        )
+
+        if content_id == 0:
+            # Step 2: It may have been registered as part of a batch
+            batch_data = batch_inclusion(image_hash, block_identifier)
+            if batch_data is not None:
+                return batch_data, 200
+            return {"exists": False, "message": "Image hash not found on blockchain."}, 200
+
+        return format_content(content, content_id), 200
+
+    except Exception as e:
+        return {"error": str(e)}, 500
+
+
+def call_get_content(content_id, block_identifier='latest'):
+    """
+    getContent(content_id); identical concurrent calls share one.
+    """
+    return singleflight.chain_reads.do(
+        ("content", content_id, block_identifier),
+        lambda: contract.functions.getContent(content_id).call(block_identifier=block_identifier)
+    )
+
+
+def lookup_content_id(content_id, block_identifier='latest'):
+    """
+    Fetches a content by the ID a payload watermark carries, with one
+    getContent call. Returns (payload, status code) like lookup_image_hash.
+    """
+    try:
+        content = call_get_content(content_id, block_identifier)
+        return format_content(content, content_id), 200
+    except ContractLogicError:
+        return {"exists": False, "message": "Content ID not found on blockchain."}, 200
+    except Exception as e:
+        return {"error": str(e)}, 500
+
+
 @blockchain_bp.route('/check_image_hash', methods=['GET'])
 def check_image_hash():
     """Check if an image hash exists on the blockchain and return its metadata."""
@@ -30,41 +247,8 @@ def check_image_hash():
     if not image_hash:
         return jsonify({"error": "Image hash required"}), 400
 
-    try:
-        # Step 1: Check if the image exists using checkImageExists function
-        exists = contract.functions.checkImageExists(image_hash).call()
-
-        if not exists:
-            return jsonify({"exists": False, "message": "Image hash not found on blockchain."}), 200
-
-        # Step 2: Find the content ID manually
-        total_contents = contract.functions.contentCount().call()
-        content_id = None
-
-        for i in range(1, total_contents + 1):  # Solidity mapping starts at 1
-            content = contract.functions.getContent(i).call()
-            if content[2] == image_hash:  # content[2] is sha256Hash
-                content_id = i
-                break
-
-        if content_id is None:
-            return jsonify({"error": "Content ID not found for this hash."}), 404
-
-        # Step 3: Retrieve full content metadata
-        content = contract.functions.getContent(content_id).call()
-
-        return jsonify({
-            "exists": True,
-            "content_id": content_id,
-            "owner": content[0],
-            "ipfs_hash": content[1],
-            "sha256_hash": content[2],
-            "timestamp": content[3],
-            "delta": content[4]
-        }), 200
-
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    # Only a new block can change the answer
+    return block_cached_response(lambda block_number: lookup_image_hash(image_hash, block_number))
 
 
 @blockchain_bp.route("/store_metadata", methods=["POST"]) 
@@ -84,6 +268,7 @@ def store_file_metadata():
 
         # Convert signed transaction to raw bytes correctly
         tx_hash = web3.eth.send_raw_transaction(bytes.fromhex(signed_tx[2:]))  # Strip "0x" before conversion
+        content_filter.invalidate()  # the transaction may register a hash
         
         return jsonify({"transaction_hash": tx_hash.hex()}), 200
 
@@ -100,28 +285,144 @@ def get_content():
     
     try:
         content_id = int(content_id)
-        content = contract.functions.getContent(content_id).call()
+        content = call_get_content(content_id)
         
-        return jsonify({
-            "owner": content[0],
-            "ipfs_hash": content[1],
-            "sha256_hash": content[2],
-            "timestamp": content[3],
-            "delta": content[4]
-        }), 200
+        # A registered content never changes
+        return immutable_response(format_content(content))
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @blockchain_bp.route('/get_user_content', methods=['GET'])
 def get_user_content():
     """Retrieve all content IDs registered by a specific user."""
-    user_address = Web3.to_checksum_address(request.args.get('user_address'))
+    user_address = request.args.get('user_address')
 
     if not user_address:
         return jsonify({"error": "User address required"}), 400
 
+    details = request.args.get('details', '').lower() in ('1', 'true')
+
+    def build(block_number):
+        try:
+            content_ids = contract.functions.getUserContents(Web3.to_checksum_address(user_address)).call(
+                block_identifier=block_number
+            )
+            response = {"content_ids": content_ids}
+            if details:
+                # Metadata of every ID, one getContents call per page
+                response["contents"] = []
+                for k in range(0, len(content_ids), MAX_PAGE_SIZE):
+                    ids = content_ids[k:k + MAX_PAGE_SIZE]
+                    response["contents"] += format_contents(
+                        contract.functions.getContents(ids).call(block_identifier=block_number), ids
+                    )
+            return response, 200
+        except Exception as e:
+            return {"error": str(e)}, 500
+
+    # The list only grows when a block is mined
+    return block_cached_response(build)
+
+
+@blockchain_bp.route('/get_contents', methods=['GET'])
+def get_contents():
+    """
+    Retrieve a page of content metadata in one call: ?start=&count= for a range
+    of IDs, or ?ids=1,2,3 for specific IDs.
+    """
     try:
-        content_ids = contract.functions.getUserContents(user_address).call()
-        return jsonify({"content_ids": content_ids}), 200
+        ids = [int(i) for i in request.args.get('ids', '').split(',') if i.strip()]
+        if len(ids) > MAX_PAGE_SIZE:
+            return jsonify({"error": f"At most {MAX_PAGE_SIZE} IDs per request"}), 400
+        start, count = parse_page(request.args)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid parameter: {str(e)}"}), 400
+
+    try:
+        if ids:
+            return immutable_response({"contents": format_contents(contract.functions.getContents(ids).call(), ids)})
+
+        contents = contract.functions.getContentsRange(start, count).call()
+        payload = {
+            "contents": format_contents(contents, range(start, start + len(contents))),
+            "next_start": start + len(contents) if len(contents) == count else None
+        }
+        if len(contents) == count:
+            return immutable_response(payload)  # a full page cannot change; the last one still grows
+        return jsonify(payload), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+def build_batch(items):
+    """
+    Builds the Merkle tree of a batch's items, stores their inclusion proofs and
+    returns {"merkle_root", "leaf_count", "sha256_hashes"}, the arguments of
+    registerBatch. Raises ValueError for invalid items.
+    Shared by both servers; needs the Flask app context for the registry.
+    """
+    try:
+        leaves = [{
+            "sha256_hash": item["sha256_hash"],
+            "ipfs_hash": item["ipfs_hash"],
+            "delta": merkle.chain_delta(item["delta"])
+        } for item in items]
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid item: {str(e)}")
+    if len({leaf["sha256_hash"] for leaf in leaves}) != len(leaves):
+        raise ValueError("Duplicate sha256_hash in batch")
+
+    levels = merkle.build_levels([
+        merkle.leaf_hash(leaf["sha256_hash"], leaf["ipfs_hash"], leaf["delta"]) for leaf in leaves
+    ])
+    for index, leaf in enumerate(leaves):
+        leaf["proof"] = ["0x" + node.hex() for node in merkle.proof_for(levels, index)]
+    merkle_root = "0x" + levels[-1][0].hex()
+    record_batch(merkle_root, leaves)
+    return {"merkle_root": merkle_root, "leaf_count": len(leaves),
+            "sha256_hashes": [leaf["sha256_hash"] for leaf in leaves]}
+
+
+@blockchain_bp.route('/prepare_batch', methods=['POST'])
+def prepare_batch():
+    """
+    Builds the Merkle tree for many contents and stores their inclusion proofs.
+    The client then registers the returned root with one registerBatch
+    transaction (signed and sent through /store_metadata).
+    """
+    data = request.get_json(silent=True) or {}
+    items = data.get("items")
+    if not items:
+        return jsonify({"error": "items required"}), 400
+
+    try:
+        return jsonify(build_batch(items)), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@blockchain_bp.route('/batch_proof', methods=['GET'])
+def batch_proof():
+    """Inclusion proof of a batch-registered image hash, checked against the on-chain root."""
+    image_hash = request.args.get('image_hash')
+
+    if not image_hash:
+        return jsonify({"error": "Image hash required"}), 400
+
+    try:
+        leaves = batch_leaves_on_chain(image_hash)
+        if not leaves:
+            return jsonify({"error": "Image hash is not part of any batch."}), 404
+
+        # The batch batch_inclusion reports, else the first one it passed over
+        found = next(((batch_id, leaf) for batch_id, leaf in leaves if verify_leaf(batch_id, leaf)), None)
+        batch_id, leaf = found or leaves[0]
+        payload = leaf.to_dict()
+        payload["batch_id"] = batch_id or None
+        payload["registered"] = batch_id != 0
+        payload["verified"] = found is not None
+        return jsonify(payload), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -1,28 +1,33 @@
 import os
 import requests
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, send_file
 from web3 import Web3
 from dotenv import load_dotenv
+import admission
+import ipfs_cache
+import scratch
+from ipfs_cache import ContentNotFound, GatewayError, InvalidCid
+from scratch import ScratchQuotaExceeded
 
 load_dotenv()
 
 # IPFS Routes
 ipfs_bp = Blueprint('ipfs', __name__)
-UPLOAD_FOLDER = 'uploads'
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+admission.limit_blueprint(ipfs_bp, admission.ipfs)
 
 PINATA_API_KEY = os.getenv("PINATA_API_KEY")
 PINATA_API_SECRET = os.getenv("PINATA_API_SECRET")
-PINATA_BASE_URL = 'https://api.pinata.cloud/pinning/pinFileToIPFS'
+PINATA_BASE_URL = os.getenv("PINATA_BASE_URL", 'https://api.pinata.cloud/pinning/pinFileToIPFS')
 
-def upload_to_pinata(file_path):
+def upload_to_pinata(file_path, filename=None):
     headers = {
         'pinata_api_key': PINATA_API_KEY,
         'pinata_secret_api_key': PINATA_API_SECRET
     }
     
     with open(file_path, 'rb') as file:
-        response = requests.post(PINATA_BASE_URL, headers=headers, files={'file': file})
+        response = requests.post(PINATA_BASE_URL, headers=headers,
+                                 files={'file': (filename or os.path.basename(file_path), file)})
 
     if response.status_code == 200:
         return response.json().get('IpfsHash')
@@ -35,11 +40,36 @@ def upload_file_ipfs():
         return jsonify({"error": "No file provided"}), 400
 
     file = request.files['file']
-    file_path = os.path.join(UPLOAD_FOLDER, file.filename)
-    file.save(file_path)
-
     try:
-        ipfs_hash = upload_to_pinata(file_path)
+        # Kept only while it is sent to Pinata
+        with scratch.scope() as scratch_files:
+            file_path = scratch_files.save_upload(file, os.path.splitext(file.filename)[1], request.content_length)
+            ipfs_hash = upload_to_pinata(file_path, file.filename)
         return jsonify({"ipfs_hash": ipfs_hash})
+    except ScratchQuotaExceeded as e:
+        return jsonify({"error": str(e)}), 507
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@ipfs_bp.route('/content/<cid>', methods=['GET'])
+def get_ipfs_content(cid):
+    """
+    Content of a CID (e.g. a record's ipfsHash) from the local read-through
+    cache (ipfs_cache.py). Supports Range and If-None-Match.
+    """
+    try:
+        path = ipfs_cache.cache.get(cid)
+        response = send_file(path, mimetype='application/octet-stream', conditional=True, etag=cid,
+                             download_name=cid)
+        # A CID names its content, so it can be cached forever
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return response
+    except InvalidCid as e:
+        return jsonify({"error": str(e)}), 400
+    except ContentNotFound as e:
+        return jsonify({"error": str(e)}), 404
+    except GatewayError as e:
+        return jsonify({"error": str(e)}), 502
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -0,0 +1,20 @@
+from flask import Blueprint, jsonify
+import admission
+import ipfs_cache
+import scratch
+import singleflight
+from watermark_engine import encoders
+from .blockchain_routes import content_filter
+
+# Process metrics
+metrics_bp = Blueprint('metrics', __name__)
+
+
+@metrics_bp.route('', methods=['GET'])
+def metrics():
+    """
+    Resource usage of this server process.
+    """
+    return jsonify({"scratch": scratch.store.metrics(), "admission": admission.metrics(),
+                    "registry_filter": content_filter.metrics(), "encoders": encoders.metrics(),
+                    "ipfs_cache": ipfs_cache.cache.metrics(), "singleflight": singleflight.metrics()})
@@ -2,9 +2,14 @@ from flask import Blueprint, request, jsonify
 import cv2
 import numpy as np
 import hashlib
-import os
-import tempfile
-from .watermark import extract_watermark
+import admission
+import scratch
+import singleflight
+from admission import Overloaded
+from scratch import ScratchQuotaExceeded
+from watermark_engine import detect_key_coeffs, calculate_pixel_hash, MemoryBudgetExceeded, FORMAT_VERSIONS
+from .watermark import localize_upload, upload_block_dct
+from models import find_by_image_hash, find_by_pixel_hash
 
 verify_bp = Blueprint("verify", __name__)
 
@@ -17,9 +22,57 @@ def calculate_hash(image_path):
         hasher.update(f.read())
     return hasher.hexdigest()
 
+class DeltaRequired(ValueError):
+    """Raised when an image is not in the embed registry and no delta was given."""
+
+
+def verify_upload(input_path, key, delta=None, localize=False, image_hash=None):
+    """
+    Verifies an uploaded file against a key, consulting the embed registry
+    before extracting. Shared by the Flask blueprint and the async server.
+    localize adds the tamper localization (see check_upload); image_hash is
+    the upload's SHA-256, for callers that already have it.
+    """
+    block_dct = None
+    # Calculate hash of the image and look it up in the embed registry first
+    image_hash = image_hash or calculate_hash(input_path)
+    record = find_by_image_hash(image_hash, key)
+    if record is not None:
+        # Byte-identical to an image we produced with this key
+        ber, delta, verified_by, version = record.ber, record.delta, "hash", record.format_version
+        content_id = record.content_id
+    else:
+        img = cv2.imread(input_path)
+        record = find_by_pixel_hash(calculate_pixel_hash(img), key)
+        if record is not None:
+            delta, verified_by, versions = record.delta, "pixels", [record.format_version]
+        elif delta is None:
+            raise DeltaRequired("'delta' is required for images not in the embed registry")
+        else:
+            verified_by, versions = "extraction", FORMAT_VERSIONS
+        # Extract watermark and calculate BER (JPEGs straight from their coefficients)
+        block_dct = upload_block_dct(input_path, img)
+        best = detect_key_coeffs(*block_dct, key, [delta], versions)
+        ber, version, content_id = best["ber"], best["version"], best["content_id"]
+
+    result = {
+        "ber": float(ber),
+        "delta": delta,
+        "format_version": version,
+        "image_hash": image_hash,
+        "verified_by": verified_by,
+        "content_id": content_id
+    }
+    if localize:
+        result["localization"] = localize_upload(input_path, key, delta, version, content_id, block_dct)
+    return result
+
+
 @verify_bp.route('/verify', methods=['POST'])
 def verify():
     try:
+        admission.cpu.check()  # shed before the upload is read
+
         if 'image' not in request.files:
             return jsonify({"error": "No image file provided"}), 400
         
@@ -30,27 +83,37 @@ def verify():
         data = request.get_json(silent=True) or {}
         key = request.form.get('key') or data.get('key')
         delta = request.form.get('delta') or data.get('delta')
+        # Per-region BER heatmap and watermarked areas (optional)
+        localize = str(request.form.get('localize') or data.get('localize') or '').lower() in ('1', 'true')
         
-        if key is None or delta is None:
-            return jsonify({"error": "Both 'key' and 'delta' are required"}), 400
+        if key is None:
+            return jsonify({"error": "'key' is required"}), 400
         
-        key, delta = int(key), float(delta)
+        try:
+            key = int(key)
+            delta = float(delta) if delta is not None else None
+        except ValueError as e:
+            return jsonify({"error": f"Invalid parameter: {str(e)}"}), 400
         
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as temp_input:
-            input_path = temp_input.name
-            file.save(input_path)
-        
-        # Extract watermark and calculate BER
-        ber = extract_watermark(input_path, key, delta)
-        
-        # Calculate hash of the image
-        image_hash = calculate_hash(input_path)
-        
-        os.remove(input_path)  # Cleanup temporary file
-        
-        return jsonify({
-            "ber": ber,
-            "image_hash": image_hash
-        })
+        with scratch.scope() as scratch_files:
+            input_path = scratch_files.save_upload(file, '.png', request.content_length)
+
+            upload_hash = calculate_hash(input_path)
+
+            def run_verify():
+                with admission.cpu.admit(admission.image_cost(input_path, "verify")):
+                    return verify_upload(input_path, key, delta, localize, upload_hash)
+
+            # Identical uploads verified at the same time share one verification (see singleflight.py)
+            flight_key = ("verify", upload_hash, key, delta, localize)
+            return jsonify(singleflight.uploads.do(flight_key, run_verify))
+    except DeltaRequired as e:
+        return jsonify({"error": str(e)}), 400
+    except MemoryBudgetExceeded as e:
+        return jsonify({"error": str(e)}), 413
+    except ScratchQuotaExceeded as e:
+        return jsonify({"error": str(e)}), 507
+    except Overloaded as e:
+        return jsonify({"error": str(e)}), 429, {"Retry-After": str(e.retry_after)}
     except Exception as e:
         return jsonify({"error": f"An error occurred: {str(e)}"}), 500
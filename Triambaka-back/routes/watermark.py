@@ -1,12 +1,20 @@
-from flask import Blueprint, request, jsonify, send_file, after_this_request
+from flask import Blueprint, request, jsonify, send_file
 import cv2
-import numpy as np
-from scipy.fftpack import dct, idct
 import os
-import tempfile
 import logging
-import hashlib
-import requests
+import admission
+import scratch
+import singleflight
+from admission import Overloaded
+from scratch import ScratchQuotaExceeded
+from watermark_engine import audio, encoders, jpeg
+from watermark_engine import localize as localization
+from watermark_engine import triage as triage_layer
+from watermark_engine.core import (DETECT_VERSIONS, FORMAT_VERSION, FORMAT_VERSIONS, TRIAGE_LAYER, MemoryBudgetExceeded,
+                                   block_mismatches, calculate_image_hash, calculate_pixel_hash, detect_key_coeffs,
+                                   detect_keys_coeffs, embed_encoded, frame_block_dct, resync_block_dct,
+                                   resync_search)
+from models import record_embed, find_by_image_hash, find_by_pixel_hash, key_fingerprint, recorded_dimensions
 
 # Set up logging
 logging.basicConfig(level=logging.DEBUG)
@@ -15,243 +23,449 @@ logger = logging.getLogger(__name__)
 
 watermark_bp = Blueprint("watermark", __name__)
 
-# Create a 'temp' directory in your project folder
-temp_dir = os.path.join(os.getcwd(), 'temp')
-os.makedirs(temp_dir, exist_ok=True)
-
-
-def calculate_image_hash(image_path):
-    """
-    Calculates the SHA-256 hash of an image file.
-    """
-    hasher = hashlib.sha256()
-    with open(image_path, 'rb') as img_file:
-        while chunk := img_file.read(8192):
-            hasher.update(chunk)
-    return hasher.hexdigest()
-
-
-def scramble_watermark(watermark, perm_key):
-    """
-    Scrambles a 2D watermark using a permutation generated with perm_key.
-    Returns the scrambled watermark and the permutation vector.
-    """
-    flat = watermark.flatten()
-    np.random.seed(perm_key)
-    perm = np.random.permutation(len(flat))
-    scrambled_flat = flat[perm]
-    scrambled = scrambled_flat.reshape(watermark.shape)
-    return scrambled, perm
-
-def generate_scrambled_watermark(shape, key, perm_offset=54321):
-    """
-    Generate an unsolved watermark using key, then scramble it using a permutation key derived from key.
-    """
-    np.random.seed(key)
-    watermark = np.random.randint(0, 2, shape)
-    perm_key = key + perm_offset
-    scrambled, perm = scramble_watermark(watermark, perm_key)
-    return watermark, scrambled, perm
-
-def adaptive_delta(y_channel, factor=10, min_delta=2.0):
-    contrast = np.std(y_channel)
-    return max(contrast / factor, min_delta)
-
-def qim_embed(coefficient, bit, delta):
-    return np.round(coefficient / delta) * delta if bit == 0 else np.round((coefficient - delta/2) / delta) * delta + delta/2
-
-def qim_extract(coefficient, delta):
-    q0 = np.round(coefficient / delta) * delta
-    q1 = q0 + delta/2
-    return 0 if abs(coefficient - q0) < abs(coefficient - q1) else 1
-
-def process_frame(frame, key, delta=None, mode='embed'):
-    """
-    Processes an image frame to either embed or extract a watermark.
-    The watermark bits are first scrambled using a secret permutation.
-    For each 8x8 block, pseudorandom embedding positions (key-dependent) are chosen.
-    """
-    # Convert image to YCrCb color space and split channels
-    ycrcb = cv2.cvtColor(frame, cv2.COLOR_BGR2YCrCb)
-    y, cr, cb = cv2.split(ycrcb)
-    if delta is None:
-        delta = adaptive_delta(y)
-    
-    h, w = y.shape
-    pad_h, pad_w = (8 - h % 8) % 8, (8 - w % 8) % 8
-    y_padded = cv2.copyMakeBorder(y, 0, pad_h, 0, pad_w, cv2.BORDER_REFLECT)
-    num_blocks_h, num_blocks_w = y_padded.shape[0] // 8, y_padded.shape[1] // 8
-    
-    # --- Generate (and scramble) watermark ---
-    # Generate the original (unscrambled) watermark using key
-    watermark_shape = (num_blocks_h, num_blocks_w)
-    orig_watermark, scrambled_watermark, perm = generate_scrambled_watermark(watermark_shape, key)
-    # For embedding, we will embed the scrambled watermark bits.
-    # In extraction, we will generate the expected scrambled watermark in the same way.
-    expected_watermark = scrambled_watermark.copy() # This is the secret watermark to be embedded/extracted
-    
-    # For additional key-based randomness in block positions:
-    pos_key = key + 98765
-
-    # Prepare an empty array to hold the extracted scrambled watermark bits.
-    extracted_scrambled_watermark = np.zeros_like(expected_watermark)
-    
-    # Process each 8x8 block.
-    for i in range(num_blocks_h):
-        for j in range(num_blocks_w):
-            block = y_padded[i*8:(i+1)*8, j*8:(j+1)*8].astype(float)
-            # Apply 2D DCT to block
-            dct_block = dct(dct(block.T, norm='ortho').T, norm='ortho')
-
-            # Generate pseudorandom embedding positions for this block (same for embed/extract)
-            embed_positions = [(a, b) for a in range(8) for b in range(8) if not (a == 0 and b == 0)]
-            np.random.seed(pos_key + i * 1000 + j)
-            chosen_indices = np.random.choice(len(embed_positions), 3, replace=False)
-            positions = [embed_positions[k] for k in chosen_indices]
-            
-            if mode == 'embed':
-                # Use the corresponding bit from the scrambled watermark.
-                bit = expected_watermark[i, j]
-                for pos in positions:
-                    dct_block[pos] = qim_embed(dct_block[pos], bit, delta)
-            elif mode == 'extract':
-                # Extract the bits from the selected positions.
-                bits = [qim_extract(dct_block[pos], delta) for pos in positions]
-                # Use majority voting
-                extracted_scrambled_watermark[i, j] = int(round(np.mean(bits)))
-            
-            # Inverse 2D DCT to reconstruct the block
-            idct_block = idct(idct(dct_block.T, norm='ortho').T, norm='ortho')
-            y_padded[i*8:(i+1)*8, j*8:(j+1)*8] = np.clip(idct_block, 0, 255)
-    
-    # Reconstruct the Y channel and convert back to BGR color space.
-    y_processed = y_padded[:h, :w].astype(np.uint8)
-    final_frame = cv2.cvtColor(cv2.merge([y_processed, cr, cb]), cv2.COLOR_YCrCb2BGR)
-    
-    # For extraction mode, we return the expected scrambled watermark (which you can compare with)
-    return (final_frame, expected_watermark, None) if mode == 'embed' else (final_frame, expected_watermark, extracted_scrambled_watermark)
-
-# --- High-level functions ---
-def embed_watermark(input_path, output_path, key, delta=None):
-    img = cv2.imread(input_path)
-    watermarked_img, expected_wm, _ = process_frame(img, key, delta, mode='embed')
-    cv2.imwrite(output_path, watermarked_img)
-    # For debugging or record-keeping, you might want to store expected_wm securely.
-    return expected_wm
-
-def extract_watermark(input_path, key, delta=None):
-    img = cv2.imread(input_path)
-    _, expected_wm, extracted_wm = process_frame(img, key, delta, mode='extract')
-    # Calculate BER between expected scrambled watermark and extracted scrambled watermark.
-    return np.mean(expected_wm != extracted_wm)
+# Key used when a request does not name one
+DEFAULT_KEY = 12345
+# Candidate rights-holder keys for /detect_keys when the request lists none
+TENANT_KEYS = [int(k) for k in os.getenv("WATERMARK_KEYS", "").split(",") if k.strip()]
 
-@watermark_bp.route('/check_image', methods=['POST'])
-def check_image():
-    temp_input = None
-    temp_output = None
-    try:
-        # Validate file input
-        if 'image' not in request.files:
-            return jsonify({"error": "No image file provided"}), 400
+# Watermark JPEG uploads in the coefficient domain (needs jpegio)
+JPEG_NATIVE = os.getenv("WATERMARK_JPEG_NATIVE", "1") == "1"
 
-        file = request.files['image']
-        if file.filename == '':
-            return jsonify({"error": "No selected image file"}), 400
+def upload_block_dct(path, img=None):
+    """
+    Block DCT coefficients of an uploaded file. JPEGs are read straight from their
+    stored coefficients; everything else is decoded (or img is used, if given).
+    """
+    if JPEG_NATIVE and jpeg.supports_jpeg_native(path):
+        return jpeg.jpeg_block_dct(path)
+    img = cv2.imread(path) if img is None else img
+    if img is None:
+        raise ValueError("Could not decode image")
+    return frame_block_dct(img)
+
+
+def localize_upload(path, key, delta, version, content_id=None, block_dct=None):
+    """
+    Tamper localization of an upload (see watermark_engine/localize.py) for the
+    candidate a check settled on. block_dct is the upload's (coefficients, grid
+    shape) from upload_block_dct, when the caller already has it.
+    """
+    coeffs, watermark_shape = block_dct or upload_block_dct(path)
+    return localization.localize(block_mismatches(coeffs, watermark_shape, key, delta, version, content_id))
+
+
+# --- Request handlers shared by the Flask blueprint and the async server ---
+# Both need the Flask app context for the embed registry.
+
+def sweep_deltas(initial_delta=7.25, steps=10):
+    """
+    The deltas embed_upload can end on, starting from initial_delta or from the
+    starting delta of a lossy profile: the candidates checks sweep.
+    """
+    starts = [initial_delta, *encoders.LOSSY_START_DELTA.values()]
+    return sorted({start + 0.25 * i for start in starts for i in range(steps + 1)})
+
+
+def check_key(path, threshold=0.3):
+    """
+    The key to check an upload against when the request names none: the
+    rights-holder key (WATERMARK_KEYS) it carries, found by multi-key detection,
+    or else DEFAULT_KEY.
+    """
+    if TENANT_KEYS:
+        found = detect_keys_upload(path, [DEFAULT_KEY, *TENANT_KEYS], sweep_deltas(), threshold=threshold)["key"]
+        if found is not None:
+            return found
+    return DEFAULT_KEY
 
-        # Save the uploaded image to a temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as temp_file:
-            temp_input = temp_file.name
-            file.save(temp_input)
-
-        # Define constants
-        key = 12345               # Must match the embedding key
-        initial_delta = 7.25      # Starting delta value
-        threshold = 0.3           # BER threshold for a valid watermark
-
-        # --- Dynamic Delta Selection on Uploaded Image ---
-        # This checks if the image is already watermarked.
-        best_delta = initial_delta
-        best_ber = extract_watermark(temp_input, key, initial_delta)
-        max_iterations = 10  # Try up to 10 steps
-        for i in range(max_iterations):
-            candidate_delta = initial_delta + 0.25 * (i + 1)
-            candidate_ber = extract_watermark(temp_input, key, candidate_delta)
-            if candidate_ber < best_ber:
-                best_ber = candidate_ber
-                best_delta = candidate_delta
+
+def check_upload(temp_input, key=None, initial_delta=7.25, threshold=0.3, localize=False, image_hash=None):
+    """
+    Decides whether an uploaded file is watermarked and returns the hash to look
+    up on chain: the upload's own hash if it is watermarked, otherwise the hash
+    the image would have once watermarked. Without a key the upload is checked
+    against the key check_key finds. localize adds the tamper localization of
+    the best candidate, so collages and partly edited copies that fail the
+    global threshold still show where the watermark is. image_hash is the
+    upload's SHA-256, for callers that already have it.
+    """
+    if key is None:
+        key = check_key(temp_input, threshold)
+    scratch_files = scratch.scope()
+    try:
+        # --- Hash-first lookup in the local embed registry ---
+        uploaded_hash = image_hash or calculate_image_hash(temp_input)
+        record = find_by_image_hash(uploaded_hash, key)
+        content_id, block_dct = None, None
+        if record is not None:
+            # Byte-identical to an image we produced: no extraction needed.
+            best_delta, best_ber, verified_by = record.delta, record.ber, "hash"
+            best_version, content_id = record.format_version, record.content_id
+        else:
+            img = cv2.imread(temp_input)
+            record = find_by_pixel_hash(calculate_pixel_hash(img), key)
+            if record is not None:
+                # Same pixels in a different file: one extraction at the recorded delta.
+                best_delta, verified_by, best_version = record.delta, "pixels", record.format_version
+                content_id = record.content_id
+                block_dct = upload_block_dct(temp_input, img)
+                best_ber = float(block_mismatches(*block_dct, key, record.delta, best_version, content_id).mean())
+
+        if record is None:
+            # --- Dynamic Delta Selection on Uploaded Image ---
+            # This checks if the image is already watermarked. The block DCT is
+            # computed once and every candidate delta reuses it.
+            verified_by = "extraction"
+            max_iterations = 10  # Try up to 10 steps
+            deltas = sweep_deltas(initial_delta, max_iterations)
+            block_dct = upload_block_dct(temp_input, img)
+            best = detect_key_coeffs(*block_dct, key, deltas, threshold=threshold)
+            best_delta, best_ber, best_version = best["delta"], best["ber"], best["version"]
+            content_id = best["content_id"]
+        if localize:
+            localization_report = localize_upload(temp_input, key, best_delta, best_version, content_id, block_dct)
 
         # --- Determine if Image is Watermarked or Original ---
         if best_ber < threshold:
             # The image appears watermarked.
-            # Compute the hash directly on the uploaded file.
-            watermarked_hash = calculate_image_hash(temp_input)
+            # Use the hash of the uploaded file directly.
+            watermarked_hash = uploaded_hash
             used_delta = best_delta
             final_ber = best_ber
+            used_version = best_version
         else:
             # The image is original.
-            # Embed the watermark first, then compute the hash.
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as temp_out:
-                temp_output = temp_out.name
-
-            delta = initial_delta
-            ber = extract_watermark(temp_input, key, delta)
-            # Adjust delta until the watermark BER falls below threshold.
-            while ber >= threshold:
-                embed_watermark(temp_input, temp_output, key, delta)
-                new_ber = extract_watermark(temp_output, key, delta)
-                if new_ber < threshold:
-                    break
-                delta += 0.25  # Increment delta for better embedding
-                # Optionally, you might re-run embed_watermark here if needed.
-                # For simplicity, we assume the first successful attempt is acceptable.
-                ber = new_ber
-
-            watermarked_hash = calculate_image_hash(temp_output)
-            used_delta = delta
-            final_ber = new_ber
-
-        # --- Query the Blockchain using the Watermarked Image Hash ---
-        blockchain_url = "http://127.0.0.1:5000/api/blockchain/check_image_hash"
-        bc_response = requests.get(blockchain_url, params={"image_hash": watermarked_hash})
-        try:
-            bc_json = bc_response.json()
-        except requests.exceptions.JSONDecodeError:
-            return jsonify({"error": "Invalid response from blockchain API"}), 500
-
-        if bc_response.status_code == 200 and bc_json.get("exists", False):
-            blockchain_data = bc_json
-        elif bc_response.status_code != 200:
-            return jsonify({"error": f"Blockchain lookup failed: {bc_json}"}), 500
-        else:
-            blockchain_data = None
+            # Embed the watermark exactly as /embed would (JPEGs in the
+            # coefficient domain), then compute the hash.
+            temp_output = scratch_files.path(output_format(temp_input)[0], os.path.getsize(temp_input))
+            embedded = embed_upload(temp_input, key, initial_delta, threshold, output_path=temp_output, record=False)
+            watermarked_hash = embedded["image_hash"]
+            used_delta = embedded["delta"]
+            final_ber = embedded["ber"]
+            used_version = embedded["format_version"]
 
         is_watermarked = final_ber < threshold
-
-        response_data = {
+        result = {
             "image_hash": watermarked_hash,
             "ber": float(final_ber),
             "delta": float(used_delta),
+            "format_version": used_version,
             "is_watermarked": bool(is_watermarked),
-            "blockchain_data": blockchain_data,
+            "verified_by": verified_by,
+            "key_id": key_fingerprint(key),
+            "content_id": content_id if is_watermarked else None,
             "message": "Image is Watermarked" if is_watermarked else "Original Image"
         }
+        if localize:
+            result["localization"] = localization_report
+        return result
+    finally:
+        scratch_files.close()
+
+
+def payload_record_matches(content, content_id, image_hash):
+    """
+    Whether the ContentRegistry record a payload's content ID points to is the
+    checked image's. Clients embed contentCount + 1 before registering, so the
+    ID may have gone to another registration: the record must be for the
+    upload's own hash, or for an image the embed registry produced with that ID.
+    """
+    if content["sha256_hash"] == image_hash:
+        return True
+    record = find_by_image_hash(content["sha256_hash"])
+    return record is not None and record.content_id == content_id
+
+
+def triage_upload(path, key=DEFAULT_KEY):
+    """
+    First stage of a triage check: the triage layer's BER from a reduced decode
+    of the upload. Images that carry it are marked for escalation.
+    """
+    triage_ber = triage_layer.triage_watermark(path, key)
+    return {
+        "triage_ber": triage_ber,
+        "escalated": triage_ber < triage_layer.TRIAGE_THRESHOLD,
+        "is_watermarked": False,
+        "ber": None,
+        "delta": None,
+        "format_version": None,
+        "content_id": None
+    }
+
+
+def escalate_upload(path, key=DEFAULT_KEY, initial_delta=7.25, threshold=0.3):
+    """
+    Second stage for triage positives: a full extraction of the 8x8 layer over
+    the delta range /check_image sweeps.
+    """
+    deltas = sweep_deltas(initial_delta)
+    best = detect_key_coeffs(*upload_block_dct(path), key, deltas, threshold=threshold)
+    return {
+        "is_watermarked": best["ber"] < threshold,
+        "ber": best["ber"],
+        "delta": best["delta"],
+        "format_version": best["version"],
+        "content_id": best["content_id"]
+    }
+
+
+
+def detect_keys_upload(path, keys, deltas, versions=DETECT_VERSIONS, threshold=0.3):
+    """
+    Finds which of keys an uploaded file was watermarked with, from one block
+    DCT of the upload (JPEGs from their stored coefficients).
+    """
+    results = detect_keys_coeffs(*upload_block_dct(path), keys, deltas, versions)
+    best = results[0]
+    is_watermarked = best["ber"] < threshold
+    return {
+        "is_watermarked": bool(is_watermarked),
+        "key": best["key"] if is_watermarked else None,
+        "key_id": key_fingerprint(best["key"]) if is_watermarked else None,
+        "ber": best["ber"],
+        "delta": best["delta"],
+        "format_version": best["version"] if is_watermarked else None,
+        "candidates": results[:10],
+        "keys_tested": len(keys)
+    }
+
+
+def resync_upload(path, key, deltas, dimensions, max_origin=32, threshold=0.3):
+    """
+    Best grid resynchronization of an uploaded (possibly cropped) file against
+    originals of the candidate dimensions, or None when the upload is larger
+    than all of them. JPEG uploads are also searched in their stored
+    coefficients, where JPEG-native embeds (cropped on the 8x8 grid) are read.
+    """
+    img = cv2.imread(path)
+    if img is None:
+        raise ValueError("Could not decode image")
+    block_dct = None
+    if JPEG_NATIVE and jpeg.supports_jpeg_native(path):
+        block_dct = jpeg.jpeg_block_dct(path)
+
+    best = None
+    for width, height in dimensions:
+        if width < img.shape[1] or height < img.shape[0]:
+            continue
+        watermark_shape = ((height + 7) // 8, (width + 7) // 8)
+        for version in FORMAT_VERSIONS:
+            results = [resync_search(img, key, deltas, watermark_shape, max_origin, version=version)]
+            if block_dct is not None:
+                results.append(resync_block_dct(*block_dct, key, deltas, watermark_shape, max_origin, version))
+            for result in results:
+                if best is None or result["ber"] < best["ber"]:
+                    best = dict(result, original_width=width, original_height=height)
+    if best is not None:
+        best["is_watermarked"] = best["ber"] < threshold
+    return best
+
+def jpeg_native_output(input_path, profile=None):
+    """
+    Whether an input is watermarked in the JPEG coefficient domain: JPEG
+    uploads are, unless an output profile is asked for.
+    """
+    return profile is None and JPEG_NATIVE and jpeg.supports_jpeg_native(input_path)
+
+
+def output_format(input_path, profile=None):
+    """
+    (suffix, mimetype) of the watermarked output for an input file: JPEGs
+    watermarked in the coefficient domain stay JPEGs, the rest are encoded
+    with the output profile (default encoders.DEFAULT_PROFILE).
+    """
+    if jpeg_native_output(input_path, profile):
+        return '.jpg', 'image/jpeg'
+    return encoders.get_profile(profile)[:2]
+
+
+def embed_upload(input_path, key=DEFAULT_KEY, delta=7.25, threshold=0.3, max_iterations=10, output_path=None,
+                 record=True, version=None, triage=None, content_id=None, profile=None):
+    """
+    Watermarks an uploaded file, raising delta until the BER is below threshold,
+    and records the result in the embed registry. Returns a dict with the output
+    path (owned by the caller), its mimetype and suffix, delta, BER and hashes.
+    output_path should carry the suffix from output_format; by default a scratch
+    file is used, which the caller should release (see scratch.py). triage adds
+    the triage layer (default TRIAGE_LAYER); content_id embeds a payload
+    carrying that ContentRegistry ID instead of the key's bits. profile picks
+    the output encoder (see watermark_engine/encoders.py); the BER is that of
+    the encoded output, so lossy profiles raise delta until it survives.
+    """
+    version = version or FORMAT_VERSION
+    triage = TRIAGE_LAYER if triage is None else triage
+    if content_id is not None and version != 2:
+        raise ValueError("Payload watermarks need format version 2")
+    suffix, mimetype = output_format(input_path, profile)
+    jpeg_native = jpeg_native_output(input_path, profile)
+
+    # No blockchain or watermark-presence check; we simply proceed to embed.
+    if output_path is None:
+        output_path = scratch.store.new_path(suffix, os.path.getsize(input_path))
+
+    # Pixel-domain embeds decode once and encode in memory; only the final output is written
+    img = None if jpeg_native else cv2.imread(input_path)
+    if not jpeg_native:
+        delta = max(delta, encoders.LOSSY_START_DELTA.get(profile or encoders.DEFAULT_PROFILE, 0))
+    encoded, encode_seconds = None, None
+
+    def embed_and_measure():
+        nonlocal encoded, encode_seconds, jpeg_native, img, profile, delta
+        if jpeg_native:
+            try:
+                jpeg.jpeg_embed(input_path, output_path, key, delta, version, triage, content_id)
+                return jpeg.jpeg_extract(output_path, key, delta, version, content_id)
+            except jpeg.HuffmanTablesIncomplete:
+                # The input's Huffman tables cannot code the watermarked coefficients: re-encode
+                # from pixels as a JPEG (same suffix and mimetype)
+                jpeg_native, img, profile = False, cv2.imread(input_path), 'jpeg-hq'
+                delta = max(delta, encoders.LOSSY_START_DELTA[profile])
+        encoded, encode_seconds, ber = embed_encoded(img, key, delta, version, triage, content_id, profile)
+        return ber
+
+    # Step 1: Embed watermark using the initial delta
+    new_ber = embed_and_measure()
+
+    # Step 2: Adjust delta until BER is below threshold (or until max iterations)
+    iterations = 0
+    while new_ber >= threshold and iterations < max_iterations:
+        delta += 0.25  # Increment delta for better embedding
+        new_ber = embed_and_measure()
+        iterations += 1
+
+    if encoded is not None:
+        with open(output_path, 'wb') as f:
+            f.write(encoded)
+    scratch.store.update(output_path)
+
+    # Calculate the hash of the watermarked image
+    watermarked_hash = calculate_image_hash(output_path)
+
+    # Record the exact embed parameters so later checks can skip the delta search
+    watermarked_img = cv2.imread(output_path)
+    height, width = watermarked_img.shape[:2]
+    if record:
+        record_embed(watermarked_hash, calculate_pixel_hash(watermarked_img), key, delta, new_ber, width, height,
+                     version, content_id)
+
+    return {
+        "output_path": output_path,
+        "mimetype": mimetype,
+        "suffix": suffix,
+        "ber": float(new_ber),
+        "delta": float(delta),
+        "image_hash": watermarked_hash,
+        "key_id": key_fingerprint(key),
+        "format_version": version,
+        "triage_layer": triage,
+        "content_id": content_id,
+        "profile": 'jpeg-native' if jpeg_native else profile or encoders.DEFAULT_PROFILE,
+        "encode_seconds": encode_seconds,
+        "output_bytes": os.path.getsize(output_path),
+        "width": width,
+        "height": height
+    }
+
+
+def embed_headers(result):
+    """
+    Response headers the frontend reads the embed parameters from.
+    """
+    headers = {
+        'X-BER': str(result["ber"]),
+        'X-Image-Hash': result["image_hash"],
+        'X-Delta': str(result["delta"]),
+        'X-Key-Id': result["key_id"],
+        'X-Format-Version': str(result["format_version"]),
+        'X-Output-Profile': result["profile"],
+        'Access-Control-Expose-Headers': 'X-BER, X-Image-Hash, X-Delta, X-Key-Id, X-Format-Version, X-Content-Id, '
+                                         'X-Output-Profile'
+    }
+    if result.get("content_id") is not None:
+        headers['X-Content-Id'] = str(result["content_id"])
+    return headers
+
+
+@watermark_bp.route('/check_image', methods=['POST'])
+def check_image():
+    scratch_files = scratch.scope()
+    try:
+        admission.cpu.check()  # shed before the upload is read
+
+        # Validate file input
+        if 'image' not in request.files:
+            return jsonify({"error": "No image file provided"}), 400
+
+        file = request.files['image']
+        if file.filename == '':
+            return jsonify({"error": "No selected image file"}), 400
+
+        # Must match the embedding key; without one, the tenant key the image carries (see check_key)
+        try:
+            key = int(request.form['key']) if request.form.get('key') else None
+        except ValueError as e:
+            return jsonify({"error": f"Invalid parameter: {str(e)}"}), 400
+
+        # Save the uploaded image to a scratch file
+        temp_input = scratch_files.save_upload(file, '.png', request.content_length)
+        # Per-region BER heatmap and watermarked areas (optional)
+        localize = request.form.get('localize', '').lower() in ('1', 'true')
+
+        upload_hash = calculate_image_hash(temp_input)
+
+        def run_check():
+            with admission.cpu.admit(admission.image_cost(temp_input, "check_image")):
+                return check_upload(temp_input, key, localize=localize, image_hash=upload_hash)
+
+        # Identical uploads checked at the same time share one check (see singleflight.py)
+        flight_key = ("check_image", upload_hash, key, localize)
+        response_data = singleflight.uploads.do(flight_key, run_check)
+
+        # --- Query the Blockchain by payload content ID, or else by the Watermarked Image Hash ---
+        # Called in-process rather than over HTTP to this same server.
+        from .blockchain_routes import lookup_content_id, lookup_image_hash
+        content_id, image_hash = response_data["content_id"], response_data["image_hash"]
+        verified = None
+        if content_id is not None:
+            bc_json, bc_status = lookup_content_id(content_id)
+            verified = bc_status == 200 and bc_json.get("exists", False) and payload_record_matches(
+                bc_json, content_id, image_hash)
+        if not verified:
+            # No payload, or its ID belongs to another registration: look the hash up instead
+            bc_json, bc_status = lookup_image_hash(image_hash)
+        response_data["content_id_verified"] = verified
+
+        if bc_status == 200 and bc_json.get("exists", False):
+            blockchain_data = bc_json
+        elif bc_status != 200:
+            return jsonify({"error": f"Blockchain lookup failed: {bc_json}"}), 500
+        else:
+            blockchain_data = None
+
+        response_data["blockchain_data"] = blockchain_data
         return jsonify(response_data), 200
 
+    except MemoryBudgetExceeded as e:
+        return jsonify({"error": str(e)}), 413
+    except ScratchQuotaExceeded as e:
+        return jsonify({"error": str(e)}), 507
+    except Overloaded as e:
+        return jsonify({"error": str(e)}), 429, {"Retry-After": str(e.retry_after)}
     except Exception as e:
         logger.exception("Error in /check_image route")
         return jsonify({"error": f"An error occurred: {str(e)}"}), 500
 
     finally:
-        # Cleanup temporary files
-        if temp_input and os.path.exists(temp_input):
-            os.remove(temp_input)
-        if temp_output and os.path.exists(temp_output):
-            os.remove(temp_output)
+        scratch_files.close()
 
 
 @watermark_bp.route('/embed', methods=['POST'])
 def embed():
+    scratch_files = scratch.scope()
+    response = None
     try:
+        admission.cpu.check()  # shed before the upload is read
+
         if 'image' not in request.files:
             return jsonify({"error": "No image file provided"}), 400
         
@@ -259,62 +473,279 @@ def embed():
         if file.filename == '':
             return jsonify({"error": "No selected image file"}), 400
         
-        # Hardcoded key and initial delta
-        key = 12345
-        delta = 7.25
+        # Rights-holder key (defaults to the shared key)
+        key = int(request.form.get('key', DEFAULT_KEY))
+        # ContentRegistry ID to carry as a payload (optional)
+        content_id = request.form.get('content_id')
+        content_id = int(content_id) if content_id else None
+        # Output encoder profile (optional, see watermark_engine/encoders.py)
+        profile = request.form.get('profile') or None
         
-        # Save the uploaded image to a temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as temp_input:
-            input_path = temp_input.name
-            file.save(input_path)
-
-        # No blockchain or watermark-presence check; we simply proceed to embed.
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as temp_output:
-            output_path = temp_output.name
-        
-        # Set threshold for watermark BER
-        threshold = 0.3
-        
-        # Step 1: Embed watermark using the initial delta
-        embed_watermark(input_path, output_path, key, delta)
-        new_ber = extract_watermark(output_path, key, delta)
-        
-        # Step 2: Adjust delta until BER is below threshold (or until max iterations)
-        max_iterations = 10
-        iterations = 0
-        while new_ber >= threshold and iterations < max_iterations:
-            delta += 0.25  # Increment delta for better embedding
-            embed_watermark(input_path, output_path, key, delta)
-            new_ber = extract_watermark(output_path, key, delta)
-            iterations += 1
-
-        # Calculate the hash of the watermarked image
-        watermarked_hash = calculate_image_hash(output_path)
+        # Save the uploaded image to a scratch file
+        input_path = scratch_files.save_upload(file, '.png', request.content_length)
+        output_path = scratch_files.path(output_format(input_path, profile)[0], os.path.getsize(input_path))
+
+        with admission.cpu.admit(admission.image_cost(input_path, "embed")):
+            result = embed_upload(input_path, key, output_path=output_path, content_id=content_id, profile=profile)
         
         response = send_file(
-            output_path,
-            mimetype='image/png',
+            result["output_path"],
+            mimetype=result["mimetype"],
             as_attachment=True,
-            download_name='watermarked.png'
+            download_name='watermarked' + result["suffix"]
         )
-        response.headers['X-BER'] = str(new_ber)
-        response.headers['X-Image-Hash'] = watermarked_hash
-        response.headers['X-Delta'] = str(delta)
-        response.headers['Access-Control-Expose-Headers'] = 'X-BER, X-Image-Hash, X-Delta'
-
-        print(f"Final Delta: {delta}")
-        print(f"BER: {new_ber}")
-        print(f"Image Hash: {watermarked_hash}")
+        response.headers.update(embed_headers(result))
+
+        print(f"Final Delta: {result['delta']}")
+        print(f"BER: {result['ber']}")
+        print(f"Image Hash: {result['image_hash']}")
         print(response.headers)
 
-        @after_this_request
-        def cleanup(response):
-            if os.path.exists(input_path):
-                os.remove(input_path)
-            # if os.path.exists(output_path):
-                # os.remove(output_path)
-            return response
-        
+        # Both scratch files go once the output has been sent; call_on_close
+        # is skipped for direct passthrough responses
+        response.direct_passthrough = False
+        response.call_on_close(scratch_files.close)
+        return response
+    except ValueError as e:
+        return jsonify({"error": f"Invalid parameter: {str(e)}"}), 400
+    except MemoryBudgetExceeded as e:
+        return jsonify({"error": str(e)}), 413
+    except ScratchQuotaExceeded as e:
+        return jsonify({"error": str(e)}), 507
+    except Overloaded as e:
+        return jsonify({"error": str(e)}), 429, {"Retry-After": str(e.retry_after)}
+    except Exception as e:
+        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+    finally:
+        if response is None:
+            scratch_files.close()
+
+
+@watermark_bp.route('/detect_keys', methods=['POST'])
+def detect_keys_route():
+    """
+    Finds which of many candidate keys (one per rights holder) an image was
+    watermarked with, from a single block DCT of the upload.
+    """
+    scratch_files = scratch.scope()
+    try:
+        admission.cpu.check()
+
+        if 'image' not in request.files:
+            return jsonify({"error": "No image file provided"}), 400
+
+        file = request.files['image']
+        if file.filename == '':
+            return jsonify({"error": "No selected image file"}), 400
+
+        keys = [int(k) for k in request.form.get('keys', '').split(',') if k.strip()] or TENANT_KEYS
+        if not keys:
+            return jsonify({"error": "No candidate keys provided"}), 400
+
+        threshold = 0.3
+        if request.form.get('delta'):
+            deltas = [float(request.form['delta'])]
+        else:
+            # Same delta range /check_image sweeps
+            deltas = sweep_deltas()
+        # Legacy v1 tables are expensive to build per key, so they are opt-in
+        versions = FORMAT_VERSIONS if request.form.get('legacy') == '1' else DETECT_VERSIONS
+
+        temp_input = scratch_files.save_upload(file, '.png', request.content_length)
+        with admission.cpu.admit(admission.image_cost(temp_input, "detect_keys")):
+            result = detect_keys_upload(temp_input, keys, deltas, versions, threshold)
+        return jsonify(result), 200
+    except ValueError as e:
+        return jsonify({"error": f"Invalid parameter: {str(e)}"}), 400
+    except ScratchQuotaExceeded as e:
+        return jsonify({"error": str(e)}), 507
+    except Overloaded as e:
+        return jsonify({"error": str(e)}), 429, {"Retry-After": str(e.retry_after)}
+    except Exception as e:
+        logger.exception("Error in /detect_keys route")
+        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+    finally:
+        scratch_files.close()
+
+
+@watermark_bp.route('/resync', methods=['POST'])
+def resync():
+    """
+    Detects the watermark in a cropped copy by searching grid offsets and block
+    index origins. The original's dimensions come from the request or, failing
+    that, from the embed registry.
+    """
+    scratch_files = scratch.scope()
+    try:
+        admission.cpu.check()
+
+        if 'image' not in request.files:
+            return jsonify({"error": "No image file provided"}), 400
+
+        file = request.files['image']
+        if file.filename == '':
+            return jsonify({"error": "No selected image file"}), 400
+
+        key = int(request.form.get('key', DEFAULT_KEY))
+        max_origin = int(request.form.get('max_origin', 32))
+        threshold = 0.3
+        if request.form.get('delta'):
+            deltas = [float(request.form['delta'])]
+        else:
+            deltas = sweep_deltas()
+
+        if request.form.get('original_width') and request.form.get('original_height'):
+            dimensions = [(int(request.form['original_width']), int(request.form['original_height']))]
+        else:
+            dimensions = recorded_dimensions(key)
+        if not dimensions:
+            return jsonify({"error": "Original dimensions unknown; pass original_width and original_height"}), 400
+
+        temp_input = scratch_files.save_upload(file, '.png', request.content_length)
+        with admission.cpu.admit(admission.image_cost(temp_input, "resync")):
+            best = resync_upload(temp_input, key, deltas, dimensions, max_origin, threshold)
+        if best is None:
+            return jsonify({"error": "Image is larger than every candidate original"}), 400
+
+        return jsonify(best), 200
+    except ValueError as e:
+        return jsonify({"error": f"Invalid parameter: {str(e)}"}), 400
+    except ScratchQuotaExceeded as e:
+        return jsonify({"error": str(e)}), 507
+    except Overloaded as e:
+        return jsonify({"error": str(e)}), 429, {"Retry-After": str(e.retry_after)}
+    except Exception as e:
+        logger.exception("Error in /resync route")
+        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+    finally:
+        scratch_files.close()
+
+
+@watermark_bp.route('/triage', methods=['POST'])
+def triage():
+    """
+    Thumbnail-speed check for crawlers: reads the triage layer from a reduced
+    decode and runs the full extraction only for images that carry it.
+    """
+    scratch_files = scratch.scope()
+    try:
+        admission.cpu.check()
+
+        if 'image' not in request.files:
+            return jsonify({"error": "No image file provided"}), 400
+
+        file = request.files['image']
+        if file.filename == '':
+            return jsonify({"error": "No selected image file"}), 400
+
+        key = int(request.form.get('key', DEFAULT_KEY))
+        temp_input = scratch_files.save_upload(file, '.png', request.content_length)
+
+        with admission.cpu.admit(admission.image_cost(temp_input, "triage")):
+            result = triage_upload(temp_input, key)
+        if result["escalated"]:
+            with admission.cpu.admit(admission.image_cost(temp_input, "verify")):
+                result.update(escalate_upload(temp_input, key))
+        return jsonify(result), 200
+    except ValueError as e:
+        return jsonify({"error": f"Invalid parameter: {str(e)}"}), 400
+    except MemoryBudgetExceeded as e:
+        return jsonify({"error": str(e)}), 413
+    except ScratchQuotaExceeded as e:
+        return jsonify({"error": str(e)}), 507
+    except Overloaded as e:
+        return jsonify({"error": str(e)}), 429, {"Retry-After": str(e.retry_after)}
+    except Exception as e:
+        logger.exception("Error in /triage route")
+        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+    finally:
+        scratch_files.close()
+
+
+@watermark_bp.route('/embed_audio', methods=['POST'])
+def embed_audio_route():
+    """
+    Watermarks a PCM WAV upload (16, 24 or 32-bit) with the key's bits and
+    returns the watermarked WAV.
+    """
+    scratch_files = scratch.scope()
+    response = None
+    try:
+        admission.cpu.check()
+
+        if 'audio' not in request.files:
+            return jsonify({"error": "No audio file provided"}), 400
+
+        file = request.files['audio']
+        if file.filename == '':
+            return jsonify({"error": "No selected audio file"}), 400
+
+        key = int(request.form.get('key', DEFAULT_KEY))
+        delta = float(request.form['delta']) if request.form.get('delta') else None
+        input_path = scratch_files.save_upload(file, '.wav', request.content_length)
+        output_path = scratch_files.path('.wav', os.path.getsize(input_path))
+
+        with admission.cpu.admit(admission.audio_cost(input_path, "audio_embed")):
+            result = audio.embed_audio(input_path, output_path, key, delta)
+        scratch_files.written(output_path)
+
+        response = send_file(output_path, mimetype='audio/wav', as_attachment=True,
+                             download_name='watermarked.wav')
+        response.headers.update({
+            'X-Delta': str(result["delta"]),
+            'X-Key-Id': key_fingerprint(key),
+            'X-Audio-Frames': str(result["frames"]),
+            'Access-Control-Expose-Headers': 'X-Delta, X-Key-Id, X-Audio-Frames'
+        })
+        response.direct_passthrough = False
+        response.call_on_close(scratch_files.close)
         return response
+    except ValueError as e:
+        return jsonify({"error": f"Invalid parameter: {str(e)}"}), 400
+    except ScratchQuotaExceeded as e:
+        return jsonify({"error": str(e)}), 507
+    except Overloaded as e:
+        return jsonify({"error": str(e)}), 429, {"Retry-After": str(e.retry_after)}
     except Exception as e:
+        logger.exception("Error in /embed_audio route")
         return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+    finally:
+        if response is None:
+            scratch_files.close()
+
+
+@watermark_bp.route('/detect_audio', methods=['POST'])
+def detect_audio_route():
+    """
+    Reads the key's bits from a PCM WAV upload, stopping as soon as the BER
+    is decisive.
+    """
+    scratch_files = scratch.scope()
+    try:
+        admission.cpu.check()
+
+        if 'audio' not in request.files:
+            return jsonify({"error": "No audio file provided"}), 400
+
+        file = request.files['audio']
+        if file.filename == '':
+            return jsonify({"error": "No selected audio file"}), 400
+
+        key = int(request.form.get('key', DEFAULT_KEY))
+        delta = float(request.form['delta']) if request.form.get('delta') else None
+        temp_input = scratch_files.save_upload(file, '.wav', request.content_length)
+
+        with admission.cpu.admit(admission.audio_cost(temp_input, "audio_detect")):
+            result = audio.detect_audio(temp_input, key, delta)
+        return jsonify(result), 200
+    except ValueError as e:
+        return jsonify({"error": f"Invalid parameter: {str(e)}"}), 400
+    except ScratchQuotaExceeded as e:
+        return jsonify({"error": str(e)}), 507
+    except Overloaded as e:
+        return jsonify({"error": str(e)}), 429, {"Retry-After": str(e.retry_after)}
+    except Exception as e:
+        logger.exception("Error in /detect_audio route")
+        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+    finally:
+        scratch_files.close()
@@ -0,0 +1,286 @@
+"""
+Scratch storage for request uploads and outputs.
+
+Every temporary file is created through a ScratchStore. Files belong to a
+Scope (normally one request) and are deleted when the scope closes; files
+that outlive their scope because of a crash or a leak are removed by garbage
+collection once they are older than SCRATCH_MAX_AGE_S. Small files go to
+tmpfs when one is available.
+
+The byte quota covers everything in the scratch directories, so it is shared
+by all processes using the same SCRATCH_DIR (server threads, async CPU
+workers, batch workers): usage is read from the directories under a file
+lock when a file is reserved, and a reservation is the file itself, created
+with its expected size in the name so it counts before it is written.
+"""
+import fcntl
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+SCRATCH_DIR = os.getenv("SCRATCH_DIR", os.path.join(os.getcwd(), 'temp'))
+# Total bytes of scratch files, disk and tmpfs together, across all processes sharing SCRATCH_DIR
+SCRATCH_QUOTA_MB = float(os.getenv("SCRATCH_QUOTA_MB", "1024"))
+# Files older than this are garbage even if their scope never closed
+SCRATCH_MAX_AGE_S = float(os.getenv("SCRATCH_MAX_AGE_S", "3600"))
+# tmpfs directory for small files ("" disables); /dev/shm when present
+SCRATCH_TMPFS_DIR = os.getenv("SCRATCH_TMPFS_DIR", "/dev/shm" if os.path.isdir("/dev/shm") else "")
+SCRATCH_TMPFS_MAX_FILE_MB = float(os.getenv("SCRATCH_TMPFS_MAX_FILE_MB", "8"))
+SCRATCH_TMPFS_QUOTA_MB = float(os.getenv("SCRATCH_TMPFS_QUOTA_MB", "256"))
+
+# Expired files are looked for at most this often
+GC_INTERVAL_S = 30
+# Uploads are copied in chunks of this size, checking the quota as they grow
+COPY_CHUNK = 1024 * 1024
+
+
+class ScratchQuotaExceeded(OSError):
+    """Raised when a new scratch file would not fit in the quota even after garbage collection."""
+
+
+def _reserved_size(name):
+    """
+    Bytes reserved by a scratch file name, "<uuid hex>-<reserved bytes><suffix>".
+    """
+    reserved = name.split('.', 1)[0].partition('-')[2]
+    return int(reserved) if reserved.isdigit() else 0
+
+
+class ScratchStore:
+    """
+    Reserves, tracks and collects scratch files under one quota. Thread-safe;
+    processes sharing the directories coordinate through a lock file.
+    """
+
+    def __init__(self, root, quota_bytes, max_age, tmpfs_root=None, tmpfs_max_file=0, tmpfs_quota=0):
+        self.root = root
+        self.quota_bytes = quota_bytes
+        self.max_age = max_age
+        self.tmpfs_root = os.path.join(tmpfs_root, "triambaka-scratch") if tmpfs_root else None
+        self.tmpfs_max_file = tmpfs_max_file
+        self.tmpfs_quota = tmpfs_quota
+        self._lock = threading.Lock()
+        self._lock_path = os.path.join(root, ".lock")
+        self._files = set()  # paths this process created and has not released
+        self._last_gc = 0.0
+        self._counters = {"created": 0, "released": 0, "expired": 0, "rejected": 0,
+                          "gc_runs": 0, "peak_bytes": 0}
+
+        os.makedirs(self.root, exist_ok=True)
+        if self.tmpfs_root:
+            try:
+                os.makedirs(self.tmpfs_root, exist_ok=True)
+            except OSError:
+                logger.warning("Scratch tmpfs %s is not usable; using %s only", self.tmpfs_root, self.root)
+                self.tmpfs_root = None
+        with self._locked():
+            self._collect(force=True)
+
+    @contextmanager
+    def _locked(self):
+        """
+        Holds the thread lock and the directory lock. The lock file is opened
+        per use so that forked workers never share its open file description.
+        """
+        with self._lock, open(self._lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _entries(self, tmpfs=None):
+        roots = [] if tmpfs else [self.root]
+        if tmpfs is not False and self.tmpfs_root:
+            roots.append(self.tmpfs_root)
+        for directory in roots:
+            for entry in os.scandir(directory):
+                if not entry.name.startswith('.') and entry.is_file(follow_symlinks=False):
+                    yield entry
+
+    def _used(self, tmpfs=None):
+        """
+        Bytes counted against the quota (tmpfs=True: the tmpfs part only),
+        over every process's files. Caller holds the lock.
+        """
+        used = 0
+        for entry in self._entries(tmpfs):
+            try:
+                used += max(entry.stat().st_size, _reserved_size(entry.name))
+            except FileNotFoundError:
+                pass
+        return used
+
+    def _delete(self, path, counter):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            logger.exception("Could not remove scratch file %s", path)
+        if counter == "expired" or path in self._files:
+            self._counters[counter] += 1
+        self._files.discard(path)
+
+    def _collect(self, force=False):
+        """
+        Removes files older than max_age, whichever process left them. Runs
+        at most every GC_INTERVAL_S unless forced. Caller holds the lock.
+        """
+        now = time.monotonic()
+        if not force and now - self._last_gc < GC_INTERVAL_S:
+            return
+        self._last_gc = now
+        self._counters["gc_runs"] += 1
+        cutoff = time.time() - self.max_age
+        for entry in list(self._entries()):
+            try:
+                expired = entry.stat().st_mtime < cutoff
+            except FileNotFoundError:
+                continue
+            if expired:
+                self._delete(entry.path, "expired")
+
+    def _reject(self, needed, used):
+        self._counters["rejected"] += 1
+        raise ScratchQuotaExceeded(f"Scratch storage is full: {needed} more bytes do not fit "
+                                   f"({used} of {self.quota_bytes} bytes in use)")
+
+    def new_path(self, suffix='', size_hint=None):
+        """
+        Reserves a new scratch file and returns its path. The file is created
+        empty; size_hint (bytes), when known, is counted against the quota
+        until the file grows past it and lets small files go to tmpfs.
+        """
+        size = size_hint or 0
+        with self._locked():
+            self._collect()
+            used = self._used()
+            if used + size > self.quota_bytes:
+                self._collect(force=True)
+                used = self._used()
+            if used + size > self.quota_bytes:
+                self._reject(size, used)
+            tmpfs = (self.tmpfs_root is not None and size_hint is not None and size_hint <= self.tmpfs_max_file
+                     and self._used(tmpfs=True) + size <= self.tmpfs_quota)
+            path = os.path.join(self.tmpfs_root if tmpfs else self.root, f"{uuid.uuid4().hex}-{size}{suffix}")
+            open(path, 'xb').close()
+            self._files.add(path)
+            self._counters["created"] += 1
+            self._counters["peak_bytes"] = max(self._counters["peak_bytes"], used + size)
+        return path
+
+    def reserve(self, path, size):
+        """
+        Checks that a file being written may grow to `size` bytes; raises
+        ScratchQuotaExceeded when that would put the store over its quota.
+        """
+        with self._locked():
+            try:
+                counted = max(os.path.getsize(path), _reserved_size(os.path.basename(path)))
+            except OSError:
+                counted = 0
+            if size <= counted:
+                return
+            used = self._used()
+            if used + size - counted > self.quota_bytes:
+                self._collect(force=True)
+                used = self._used()
+                if used + size - counted > self.quota_bytes:
+                    self._reject(size - counted, used)
+
+    def update(self, path):
+        """
+        Records that a file has been written; its actual size now counts.
+        """
+        with self._locked():
+            if path in self._files:
+                self._counters["peak_bytes"] = max(self._counters["peak_bytes"], self._used())
+
+    def release(self, path):
+        """
+        Deletes a file when its scope is done with it.
+        """
+        with self._lock:
+            self._delete(path, "released")
+
+    def metrics(self):
+        with self._locked():
+            disk_free = shutil.disk_usage(self.root).free
+            return {
+                "files": len(self._files),
+                "bytes": self._used(),
+                "tmpfs_bytes": self._used(tmpfs=True) if self.tmpfs_root else 0,
+                "quota_bytes": self.quota_bytes,
+                "tmpfs_quota_bytes": self.tmpfs_quota if self.tmpfs_root else 0,
+                "disk_free_bytes": disk_free,
+                **self._counters,
+            }
+
+
+class Scope:
+    """
+    Scratch files with a common lifetime (usually one request). Closing the
+    scope deletes them; usable as a context manager.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.paths = []
+
+    def path(self, suffix='', size_hint=None):
+        path = self.store.new_path(suffix, size_hint)
+        self.paths.append(path)
+        return path
+
+    def save_upload(self, file, suffix='', size_hint=None):
+        """
+        Saves an uploaded file (werkzeug FileStorage or a readable file object)
+        to a new scratch file and returns its path. Raises ScratchQuotaExceeded
+        if the upload outgrows the quota while it is copied.
+        """
+        path = self.path(suffix, size_hint)
+        source = getattr(file, 'stream', file)
+        written = 0
+        with open(path, 'wb') as out:
+            # Past its size hint (or without one) the copy is checked against the quota as it grows
+            while chunk := source.read(COPY_CHUNK):
+                if size_hint is None or written + len(chunk) > size_hint:
+                    self.store.reserve(path, written + len(chunk))
+                out.write(chunk)
+                written += len(chunk)
+        self.store.update(path)
+        return path
+
+    def written(self, path):
+        self.store.update(path)
+
+    def close(self):
+        while self.paths:
+            self.store.release(self.paths.pop())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+store = ScratchStore(
+    SCRATCH_DIR,
+    int(SCRATCH_QUOTA_MB * 1024 * 1024),
+    SCRATCH_MAX_AGE_S,
+    tmpfs_root=SCRATCH_TMPFS_DIR or None,
+    tmpfs_max_file=int(SCRATCH_TMPFS_MAX_FILE_MB * 1024 * 1024),
+    tmpfs_quota=int(SCRATCH_TMPFS_QUOTA_MB * 1024 * 1024),
+)
+
+
+def scope():
+    """
+    A new Scope on the process-wide store.
+    """
+    return Scope(store)
@@ -0,0 +1,126 @@
+"""
+Single-flight coalescing of identical concurrent work.
+
+When the same image is checked many times within seconds (a viral post, a
+crawler and its users), every request would rerun the full extraction and
+chain lookup. A SingleFlight runs one call per key at a time: callers that
+arrive while the call with their key is running wait for it and get its
+result (or its exception) instead of running it again. Nothing is kept once
+the call finishes, so results are never stale; this is not a cache.
+
+Keys must capture everything the result depends on, e.g. the SHA-256 of an
+upload plus key, delta and mode. Every caller gets its own deep copy of the
+result, so handlers may add to it freely.
+"""
+import asyncio
+import copy
+import threading
+import time
+from concurrent.futures import Future
+
+
+class _Flight:
+    def __init__(self, future):
+        self.future = future
+        self.waiters = 0
+        self.task = None  # do_async: the shared call, run apart from the leader
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent calls: do() for threads (the Flask server),
+    do_async() for coroutines on one event loop (the asyncio server).
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._flights = {}  # key -> _Flight (threads)
+        self._async_flights = {}  # key -> _Flight (event loop)
+        self._counters = {"calls": 0, "executed": 0, "coalesced": 0, "errors": 0, "saved_seconds": 0.0}
+
+    def _finish(self, flights, key, flight, elapsed, failed):
+        with self._lock:
+            del flights[key]
+            self._counters["executed"] += 1
+            self._counters["errors"] += failed
+            # Each waiter would otherwise have spent about as long on its own call
+            self._counters["saved_seconds"] += elapsed * flight.waiters
+
+    def do(self, key, func, *args):
+        """
+        Returns func(*args), or the result of the identical call already running.
+        """
+        with self._lock:
+            self._counters["calls"] += 1
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight(Future())
+            else:
+                self._counters["coalesced"] += 1
+                flight.waiters += 1
+        if not leader:
+            return copy.deepcopy(flight.future.result())
+
+        start, failed = time.monotonic(), False
+        try:
+            flight.future.set_result(func(*args))
+        except BaseException as e:
+            failed = True
+            flight.future.set_exception(e)
+        finally:
+            self._finish(self._flights, key, flight, time.monotonic() - start, failed)
+        return copy.deepcopy(flight.future.result())
+
+    async def do_async(self, key, func, *args):
+        """
+        Returns await func(*args), or the result of the identical call already running.
+        """
+        with self._lock:
+            self._counters["calls"] += 1
+            flight = self._async_flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._async_flights[key] = _Flight(asyncio.get_running_loop().create_future())
+            else:
+                self._counters["coalesced"] += 1
+                flight.waiters += 1
+        if leader:
+            start = time.monotonic()
+
+            async def call():
+                return await func(*args)
+
+            def finish(task):
+                if task.cancelled():
+                    flight.future.cancel()
+                elif task.exception() is not None:
+                    flight.future.set_exception(task.exception())
+                else:
+                    flight.future.set_result(task.result())
+                self._finish(self._async_flights, key, flight, time.monotonic() - start,
+                             task.cancelled() or task.exception() is not None)
+
+            # The call runs in its own task, so a leader that is cancelled (its
+            # client went away) does not cancel it for the waiters
+            flight.task = asyncio.get_running_loop().create_task(call())
+            flight.task.add_done_callback(finish)
+        # Cancelling one caller must not cancel the call the others wait for
+        return copy.deepcopy(await asyncio.shield(flight.future))
+
+    def metrics(self):
+        with self._lock:
+            calls = self._counters["calls"]
+            return dict(self._counters, in_flight=len(self._flights) + len(self._async_flights),
+                        coalesced_rate=self._counters["coalesced"] / calls if calls else None)
+
+
+# /check_image and /verify, keyed by the upload's SHA-256 and the request's parameters
+uploads = SingleFlight("uploads")
+# Chain reads: hash lookups and getContent
+chain_reads = SingleFlight("chain_reads")
+
+
+def metrics():
+    return {flight.name: flight.metrics() for flight in (uploads, chain_reads)}
@@ -3,33 +3,7 @@ import numpy as np
 from scipy.fftpack import dct, idct
 import matplotlib.pyplot as plt
 
-# Helper functions (copied from your original code)
-def scramble_watermark(watermark, perm_key):
-    flat = watermark.flatten()
-    np.random.seed(perm_key)
-    perm = np.random.permutation(len(flat))
-    scrambled_flat = flat[perm]
-    scrambled = scrambled_flat.reshape(watermark.shape)
-    return scrambled, perm
-
-def generate_scrambled_watermark(shape, key, perm_offset=54321):
-    np.random.seed(key)
-    watermark = np.random.randint(0, 2, shape)
-    perm_key = key + perm_offset
-    scrambled, perm = scramble_watermark(watermark, perm_key)
-    return watermark, scrambled, perm
-
-def adaptive_delta(y_channel, factor=10, min_delta=2.0):
-    contrast = np.std(y_channel)
-    return max(contrast / factor, min_delta)
-
-def qim_embed(coefficient, bit, delta):
-    return np.round(coefficient / delta) * delta if bit == 0 else np.round((coefficient - delta/2) / delta) * delta + delta/2
-
-def qim_extract(coefficient, delta):
-    q0 = np.round(coefficient / delta) * delta
-    q1 = q0 + delta/2
-    return 0 if abs(coefficient - q0) < abs(coefficient - q1) else 1
+from watermark_engine import generate_scrambled_watermark, qim_embed
 
 # Load an image
 input_path = "input_image.png"  # Replace with your image path
@@ -0,0 +1,21 @@
+"""
+Every compute backend against the reference loop (see watermark_engine/conformance.py).
+"""
+import pytest
+
+from watermark_engine import backends, conformance, core
+
+FRAMES = conformance.synthetic_frames()
+KEY, DELTA = 12345, 7.25
+
+
+@pytest.mark.parametrize("name", sorted(FRAMES))
+def test_backends_match_reference(name):
+    assert conformance.check_frame(name, FRAMES[name], list(backends.BACKENDS), list(core.FORMAT_VERSIONS),
+                                   KEY, DELTA) == []
+
+
+@pytest.mark.parametrize("name", sorted(FRAMES))
+def test_bands_with_row_offset_match_reference(name):
+    assert conformance.check_band_offsets(name, FRAMES[name], list(backends.BACKENDS), list(core.FORMAT_VERSIONS),
+                                          KEY, DELTA) == []
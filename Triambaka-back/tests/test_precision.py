@@ -0,0 +1,22 @@
+"""
+The float32 compute path against float64 (see bench.py precision).
+"""
+import numpy as np
+import pytest
+
+from bench import FLOAT32_BER_TOLERANCE, precision_bers
+from watermark_engine import core
+
+
+def textured_frame(seed=0, size=(384, 512)):
+    """A gradient with noise, so blocks have AC energy like a photo."""
+    rng = np.random.RandomState(seed)
+    ramp = np.add.outer(np.linspace(30, 200, size[0]), np.linspace(0, 40, size[1]))
+    return np.clip(np.dstack([ramp] * 3) + rng.normal(0, 20, size + (3,)), 0, 255).astype(np.uint8)
+
+
+@pytest.mark.parametrize("dtype_embed", ['float64', 'float32'])
+@pytest.mark.parametrize("version", core.FORMAT_VERSIONS)
+def test_float32_ber_within_tolerance(dtype_embed, version):
+    bers, _ = precision_bers(textured_frame(), 12345, 7.25, dtype_embed, version)
+    assert abs(bers['float32'] - bers['float64']) <= FLOAT32_BER_TOLERANCE
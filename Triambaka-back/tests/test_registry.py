@@ -0,0 +1,38 @@
+"""
+ContentRegistry built from contracts/ on devchain's in-process chain (see
+devchain.py). Skipped when solc cannot be installed or run.
+"""
+import pytest
+
+devchain = pytest.importorskip("devchain")
+
+
+@pytest.fixture(scope="module")
+def chain():
+    try:
+        return devchain.deploy()
+    except Exception as e:
+        pytest.skip(f"ContentRegistry cannot be compiled here: {e}")
+
+
+def test_checked_in_abi_matches_build(chain):
+    assert devchain.abi_drift(chain[1].abi) == []
+
+
+def test_batches_prove_and_own_their_hashes(chain):
+    summary = devchain.run_batch_demo(*chain, contents=5, batch_size=64, samples=16)
+    assert summary["proof_failures"] == 0
+    assert summary["ownership_conflicts"] == 0
+
+
+def test_bulk_views_match_get_content(chain):
+    web3, contract = chain
+    summary = devchain.run_view_demo(web3, contract, records=600, page_size=500)
+    assert summary["view_mismatches"] == 0
+    assert summary["list_calls"] == -(-summary["records"] // 500)
+
+    total = contract.functions.contentCount().call()
+    assert contract.functions.getContentsRange(total + 1, 10).call() == []
+    assert len(contract.functions.getContentsRange(total, 10).call()) == 1
+    assert devchain._reverts(contract.functions.getContentsRange(0, 10))
+    assert devchain._reverts(contract.functions.getContents([total + 1]))
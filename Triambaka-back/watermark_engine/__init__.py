@@ -0,0 +1,50 @@
+"""
+DCT/QIM watermark engine shared by the Flask and aiohttp servers, batch.py and
+bench.py. The names below are its stable API; the submodules are:
+
+    core         formats, process_frame, multi-key detection, resynchronization
+    backends     interchangeable block loops (reference, numpy, parallel)
+    jpeg         embedding in the quantized coefficients of JPEG files
+    triage       downscale-robust layer read from reduced decodes
+    payload      error-corrected content ID payloads
+    audio        streaming watermarks for PCM WAV files
+    encoders     output profiles (format and encoder settings) for watermarked images
+    localize     tamper localization: per-region BER heatmaps and watermarked areas
+    conformance  checks that every backend gives identical results
+"""
+from .backends import BACKENDS, DEFAULT_BACKEND
+from .encoders import DEFAULT_PROFILE, PROFILES
+from .core import (
+    DETECT_VERSIONS,
+    FORMAT_VERSION,
+    FORMAT_VERSIONS,
+    MemoryBudgetExceeded,
+    adaptive_delta,
+    block_dct,
+    block_mismatches,
+    calculate_image_hash,
+    calculate_pixel_hash,
+    choose_strategy,
+    detect_key_coeffs,
+    detect_keys,
+    detect_keys_coeffs,
+    embed_encoded,
+    embed_watermark,
+    estimate_peak_bytes,
+    extract_watermark,
+    frame_ber,
+    frame_block_dct,
+    generate_scrambled_watermark,
+    key_tables,
+    keyed_bits,
+    keyed_positions,
+    process_frame,
+    qim_bits,
+    qim_embed,
+    qim_extract,
+    qim_targets,
+    qim_votes,
+    resync_block_dct,
+    resync_search,
+    scramble_watermark,
+)
@@ -0,0 +1,229 @@
+"""
+Compute backends for the block loop of process_frame. Every backend embeds
+into or extracts from the 8x8 blocks of a padded luma plane in place, with the
+same arguments, and must give identical results (see conformance.py):
+
+    reference  one block at a time with scalar DCT and QIM; the specification
+    numpy      whole chunks of block rows per vectorized step
+    parallel   the numpy backend on one band of block rows per worker process
+"""
+# core imports this module; its attributes are looked up at call time.
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+from scipy.fftpack import dct, idct
+
+from . import core
+
+# Backend used when process_frame is not given one
+DEFAULT_BACKEND = os.getenv("WATERMARK_BACKEND", "numpy")
+
+# Blocks handled per vectorized step of the numpy backend; small enough that
+# its temporaries stay within the per-pixel memory estimates in core
+KEYED_CHUNK_BLOCKS = 1024
+
+
+def _reference_positions(key, i, j, version, rng):
+    """
+    The 3 (row, col) AC positions of block (i, j), drawn the way each format specifies.
+    """
+    if version == 2:
+        return [divmod(int(p), 8) for p in core._AC_POSITIONS[core.keyed_positions(key, i, j)].ravel()]
+    embed_positions = [(a, b) for a in range(8) for b in range(8) if not (a == 0 and b == 0)]
+    rng.seed(key + 98765 + i * 1000 + j)
+    return [embed_positions[k] for k in rng.choice(len(embed_positions), 3, replace=False)]
+
+
+def process_blocks_reference(y_padded, expected_watermark, extracted_watermark, key, delta, mode, dtype,
+                             row_offset=0, version=1):
+    """
+    Embeds into or extracts from every 8x8 block of a padded luma plane in place.
+    row_offset is the block-row index of the first row of y_padded within the
+    whole image, so that bands of an image use the same per-block positions.
+    """
+    num_blocks_h, num_blocks_w = y_padded.shape[0] // 8, y_padded.shape[1] // 8
+    rng = np.random.RandomState()  # private, so concurrent requests do not share RNG state
+
+    for bi in range(num_blocks_h):
+        i = bi + row_offset
+        for j in range(num_blocks_w):
+            block = y_padded[bi*8:(bi+1)*8, j*8:(j+1)*8].astype(dtype)
+            # Apply 2D DCT to block
+            dct_block = dct(dct(block.T, norm='ortho').T, norm='ortho')
+
+            # Pseudorandom embedding positions for this block (same for embed/extract)
+            positions = _reference_positions(key, i, j, version, rng)
+
+            if mode == 'embed':
+                # Use the corresponding bit from the scrambled watermark.
+                bit = expected_watermark[i, j]
+                for pos in positions:
+                    dct_block[pos] = core.qim_embed(dct_block[pos], bit, delta)
+                # Inverse 2D DCT to reconstruct the block
+                idct_block = idct(idct(dct_block.T, norm='ortho').T, norm='ortho')
+                y_padded[bi*8:(bi+1)*8, j*8:(j+1)*8] = np.clip(idct_block, 0, 255)
+            elif mode == 'extract':
+                # Extract the bits from the selected positions.
+                bits = [core.qim_extract(dct_block[pos], delta) for pos in positions]
+                # Use majority voting
+                extracted_watermark[i, j] = int(round(np.mean(bits)))
+
+
+def process_blocks_numpy(y_padded, expected_watermark, extracted_watermark, key, delta, mode, dtype, row_offset=0,
+                         version=1, table=None):
+    """
+    Vectorized counterpart of the reference loop: DCT, QIM and inverse DCT on
+    whole chunks of block rows at once. table is the whole frame's v1
+    position table, for callers that already have it (shard workers).
+    """
+    num_blocks_h, num_blocks_w = y_padded.shape[0] // 8, y_padded.shape[1] // 8
+    chunk_rows = max(1, KEYED_CHUNK_BLOCKS // max(num_blocks_w, 1))
+    if version == 1 and table is None:
+        # v1 positions come from a per-block RNG; key_tables draws them once per key
+        table = core.key_tables(key, expected_watermark.shape, 1)[0]
+
+    for b0 in range(0, num_blocks_h, chunk_rows):
+        b1 = min(b0 + chunk_rows, num_blocks_h)
+        band = y_padded[b0 * 8:b1 * 8]
+        coeffs = core.block_dct(band, dtype)
+        i, j = np.divmod(np.arange(coeffs.shape[0]), num_blocks_w)
+        i += row_offset + b0
+        index = np.arange(coeffs.shape[0])[:, None]
+        if version == 2:
+            positions = core._AC_POSITIONS[core.keyed_positions(key, i, j)]
+        else:
+            positions = table[i * expected_watermark.shape[1] + j].astype(np.int64)
+
+        if mode == 'embed':
+            bits = expected_watermark[i, j][:, None]
+            coeffs[index, positions] = core.qim_targets(coeffs[index, positions], bits, delta)
+            blocks = coeffs.reshape(b1 - b0, num_blocks_w, 8, 8)
+            blocks = idct(idct(blocks, axis=2, norm='ortho'), axis=3, norm='ortho')
+            band[...] = np.clip(blocks, 0, 255).swapaxes(1, 2).reshape(band.shape)
+        elif mode == 'extract':
+            extracted_watermark[i, j] = core.qim_votes(coeffs[index, positions], delta)
+
+
+def _shared_array(shape, dtype, source=None):
+    """
+    Allocates a shared memory segment holding an array of the given shape and
+    dtype (optionally filled from source). Returns (segment, array view).
+    """
+    dtype = np.dtype(dtype)
+    shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+    array = np.ndarray(shape, dtype, buffer=shm.buf)
+    if source is not None:
+        array[...] = source
+    return shm, array
+
+
+def _process_shard(names, padded_shape, watermark_shape, watermark_dtype, rows, row_offset, key, delta, mode, dtype,
+                   version):
+    """
+    Worker side of process_blocks_parallel: attaches to the shared luma plane
+    and watermark arrays (and, for v1, position table) by name and processes
+    block rows [rows[0], rows[1]) of the plane in place. row_offset is the
+    block-row index of the plane's first row within the whole image.
+    """
+    segments = [shared_memory.SharedMemory(name=name) for name in names]
+    try:
+        y_padded = np.ndarray(padded_shape, np.uint8, buffer=segments[0].buf)
+        expected = np.ndarray(watermark_shape, watermark_dtype, buffer=segments[1].buf)
+        extracted = np.ndarray(watermark_shape, watermark_dtype, buffer=segments[2].buf)
+        table = None
+        if version == 1:
+            table = np.ndarray((watermark_shape[0] * watermark_shape[1], 3), np.uint8, buffer=segments[3].buf)
+        r0, r1 = rows
+        process_blocks_numpy(y_padded[r0 * 8:r1 * 8], expected, extracted, key, delta, mode, dtype,
+                             row_offset=row_offset + r0, version=version, table=table)
+        del y_padded, expected, extracted, table  # views must go before the segments close
+    finally:
+        for segment in segments:
+            segment.close()
+
+
+_shard_pool = None
+_shard_pool_workers = 0
+_shard_pool_lock = threading.Lock()
+
+
+def _submit_shards(workers, shards):
+    """
+    Submits (function, *args) shards to the process pool shared by all sharded
+    frames. The pool is replaced by a larger one when a caller asks for more
+    workers than it has; the old one finishes the shards it was given.
+    """
+    global _shard_pool, _shard_pool_workers
+    with _shard_pool_lock:
+        if _shard_pool is None or workers > _shard_pool_workers:
+            old_pool = _shard_pool
+            _shard_pool, _shard_pool_workers = ProcessPoolExecutor(max_workers=workers), workers
+            if old_pool is not None:
+                old_pool.shutdown(wait=False)
+        return [_shard_pool.submit(*shard) for shard in shards]
+
+
+def process_blocks_parallel(y_padded, expected_watermark, extracted_watermark, key, delta, mode, dtype, row_offset=0,
+                            version=1, workers=2):
+    """
+    The numpy backend with the block rows split into one band per worker
+    process. The luma plane, watermark arrays and v1 position table are placed
+    in shared memory, so workers only receive segment names and row ranges
+    and write their results in place; the output is the same as the serial
+    loop since every block is independent.
+    """
+    num_blocks_h = y_padded.shape[0] // 8
+    bounds = np.linspace(0, num_blocks_h, min(workers, num_blocks_h) + 1).astype(int)
+
+    segments = []
+    try:
+        y_shm, y_shared = _shared_array(y_padded.shape, np.uint8, y_padded)
+        segments.append(y_shm)
+        expected_shm, _ = _shared_array(expected_watermark.shape, expected_watermark.dtype, expected_watermark)
+        segments.append(expected_shm)
+        extracted_shm, extracted_shared = _shared_array(extracted_watermark.shape, extracted_watermark.dtype)
+        segments.append(extracted_shm)
+        if version == 1:
+            # Drawn once here (and cached) rather than by every worker for the whole frame
+            table = core.key_tables(key, expected_watermark.shape, 1)[0]
+            table_shm, _ = _shared_array(table.shape, table.dtype, table)
+            segments.append(table_shm)
+
+        names = [segment.name for segment in segments]
+        futures = _submit_shards(workers, [
+            (_process_shard, names, y_padded.shape, expected_watermark.shape, expected_watermark.dtype,
+             (int(r0), int(r1)), row_offset, key, delta, mode, dtype, version)
+            for r0, r1 in zip(bounds[:-1], bounds[1:]) if r1 > r0
+        ])
+        for future in futures:
+            future.result()
+
+        if mode == 'embed':
+            y_padded[...] = y_shared
+        else:
+            extracted_watermark[...] = extracted_shared
+        del y_shared, extracted_shared
+    finally:
+        for segment in segments:
+            segment.close()
+            segment.unlink()
+
+
+BACKENDS = {
+    "reference": process_blocks_reference,
+    "numpy": process_blocks_numpy,
+    "parallel": process_blocks_parallel,
+}
+
+
+def get_backend(name=None):
+    """
+    The block-loop function of a backend (default DEFAULT_BACKEND).
+    """
+    name = name or DEFAULT_BACKEND
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown watermark backend {name!r} (expected one of {', '.join(BACKENDS)})")
+    return BACKENDS[name]
@@ -0,0 +1,181 @@
+"""
+Conformance checks for the compute backends: every backend must give the same
+watermarked pixels, extracted bits and BER as the reference loop, for every
+format version, full-frame and banded, and on bands that start below the first
+block row (row_offset). tests/test_conformance.py runs them on the synthetic
+frames; to add your own images, run:
+
+    python -m watermark_engine.conformance img/ --backends reference numpy parallel
+
+Besides the given images (files or directories), the corpus has synthetic
+frames with sizes that are not multiples of 8. Exits with status 1 on any
+mismatch.
+"""
+import argparse
+import os
+import sys
+
+import cv2
+import numpy as np
+
+from . import backends, core, payload
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.webp')
+# Block rows per band in the banded cases
+BANDED_BLOCK_ROWS = 4
+# Content ID embedded in the payload cases
+PAYLOAD_CONTENT_ID = 4242
+
+
+def synthetic_frames(seed=0):
+    """
+    Noise, gradient and flat frames of odd sizes; flat blocks put many
+    coefficients on the QIM decision boundaries.
+    """
+    rng = np.random.RandomState(seed)
+    frames = {
+        "noise-37x53": rng.randint(0, 256, (37, 53, 3)).astype(np.uint8),
+        "noise-257x263": rng.randint(0, 256, (257, 263, 3)).astype(np.uint8),
+        "flat-64x81": np.full((64, 81, 3), 128, dtype=np.uint8),
+    }
+    ramp = np.linspace(0, 255, 301)
+    frames["gradient-270x301"] = np.dstack([np.tile(ramp, (270, 1))] * 3).astype(np.uint8)
+    return frames
+
+
+def load_corpus(paths, max_side):
+    """
+    (name, frame) pairs for the synthetic frames and every image under paths,
+    downscaled so that the longer side is at most max_side.
+    """
+    corpus = list(synthetic_frames().items())
+    for path in paths:
+        files = [path] if os.path.isfile(path) else sorted(
+            os.path.join(root, name) for root, _, names in os.walk(path) for name in names
+            if name.lower().endswith(IMAGE_EXTENSIONS))
+        for file in files:
+            img = cv2.imread(file)
+            if img is None:
+                continue
+            scale = max_side / max(img.shape[:2])
+            if scale < 1:
+                img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            corpus.append((file, img))
+    return corpus
+
+
+def run_case(img, reference, key, delta, version, backend, content_id=None, memory_budget=0):
+    """
+    Embeds into img with one backend and reads the reference-embedded frame
+    back with it. Returns (watermarked frame, extracted bits, BER).
+    """
+    embedded, _, _ = core.process_frame(img, key, delta, 'embed', version=version, content_id=content_id,
+                                        memory_budget=memory_budget, backend=backend)
+    _, expected, extracted = core.process_frame(reference, key, delta, 'extract', version=version,
+                                                content_id=content_id, memory_budget=memory_budget, backend=backend)
+    return embedded, extracted, float(np.mean(expected != extracted))
+
+
+def check_frame(name, img, backend_names, versions, key, delta):
+    """
+    Compares every backend against the reference on one frame. Returns the
+    list of mismatch descriptions.
+    """
+    failures = []
+    banded_budget = core.estimate_peak_bytes(img.shape, 'embed', BANDED_BLOCK_ROWS)
+    cases = [(version, None) for version in versions]
+    if 2 in versions and payload.capacity_ok(((img.shape[0] + 7) // 8, (img.shape[1] + 7) // 8)):
+        cases.append((2, PAYLOAD_CONTENT_ID))
+
+    for version, content_id in cases:
+        label = f"v{version}" + (f" payload {content_id}" if content_id is not None else "")
+        reference, _, _ = core.process_frame(img, key, delta, 'embed', version=version, content_id=content_id,
+                                             backend="reference")
+        expected_frame, expected_bits, expected_ber = run_case(img, reference, key, delta, version, "reference",
+                                                               content_id)
+        for backend in backend_names:
+            for strategy, budget in (("full", 0), ("banded", banded_budget)):
+                frame, bits, ber = run_case(img, reference, key, delta, version, backend, content_id, budget)
+                if not np.array_equal(frame, expected_frame):
+                    pixels = int(np.any(frame != expected_frame, axis=-1).sum())
+                    failures.append(f"{name} {label} {backend}/{strategy}: {pixels} embedded pixels differ")
+                if not np.array_equal(bits, expected_bits) or ber != expected_ber:
+                    failures.append(f"{name} {label} {backend}/{strategy}: BER {ber:.4f}, "
+                                    f"reference {expected_ber:.4f}, {int(np.sum(bits != expected_bits))} bits differ")
+
+        if content_id is None:
+            # Multi-key detection gathers from one block DCT instead of running a backend
+            coeffs, watermark_shape = core.frame_block_dct(expected_frame)
+            detected = core.detect_keys_coeffs(coeffs, watermark_shape, [key], [delta], (version,))[0]["ber"]
+            if detected != expected_ber:
+                failures.append(f"{name} {label} detect_keys: BER {detected:.4f}, reference {expected_ber:.4f}")
+    return failures
+
+
+def check_band_offsets(name, img, backend_names, versions, key, delta, block_rows=BANDED_BLOCK_ROWS):
+    """
+    Calls every backend directly on a band of block rows from the middle of the
+    frame, with its row_offset, and compares the band's pixels and extracted
+    bits with the reference. Banded process_frame only ever uses the numpy
+    backend, so this is what checks row_offset for the others. Returns the list
+    of mismatch descriptions.
+    """
+    y = cv2.cvtColor(img, cv2.COLOR_BGR2YCrCb)[:, :, 0]
+    h, w = y.shape
+    y_padded = cv2.copyMakeBorder(y, 0, (8 - h % 8) % 8, 0, (8 - w % 8) % 8, cv2.BORDER_REFLECT)
+    watermark_shape = (y_padded.shape[0] // 8, y_padded.shape[1] // 8)
+    row_offset = max(watermark_shape[0] // 3, 1)
+    rows = min(block_rows, watermark_shape[0] - row_offset)
+    if rows < 1:
+        return []
+    bits = np.random.RandomState(key).randint(0, 2, watermark_shape)
+
+    def run(backend, version):
+        band = y_padded[row_offset * 8:(row_offset + rows) * 8].copy()
+        backends.get_backend(backend)(band, bits, np.zeros_like(bits), key, delta, 'embed', np.float64,
+                                      row_offset=row_offset, version=version)
+        extracted = np.zeros_like(bits)
+        backends.get_backend(backend)(band.copy(), bits, extracted, key, delta, 'extract', np.float64,
+                                      row_offset=row_offset, version=version)
+        return band, extracted
+
+    failures = []
+    for version in versions:
+        expected_band, expected_bits = run("reference", version)
+        for backend in backend_names:
+            band, extracted = run(backend, version)
+            if not np.array_equal(band, expected_band):
+                failures.append(f"{name} v{version} {backend}/row_offset {row_offset}: "
+                                f"{int(np.sum(band != expected_band))} embedded pixels differ")
+            if not np.array_equal(extracted, expected_bits):
+                failures.append(f"{name} v{version} {backend}/row_offset {row_offset}: "
+                                f"{int(np.sum(extracted != expected_bits))} bits differ")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Watermark backend conformance checks")
+    parser.add_argument('images', nargs='*', help="Image files or directories added to the synthetic corpus")
+    parser.add_argument('--backends', nargs='+', default=list(backends.BACKENDS), choices=list(backends.BACKENDS))
+    parser.add_argument('--versions', type=int, nargs='+', default=list(core.FORMAT_VERSIONS),
+                        choices=list(core.FORMAT_VERSIONS))
+    parser.add_argument('--key', type=int, default=12345)
+    parser.add_argument('--delta', type=float, default=7.25)
+    parser.add_argument('--max-side', type=int, default=512, help="Downscale larger images to this size first")
+    args = parser.parse_args()
+
+    failures = []
+    for name, img in load_corpus(args.images, args.max_side):
+        frame_failures = check_frame(name, img, args.backends, args.versions, args.key, args.delta)
+        frame_failures += check_band_offsets(name, img, args.backends, args.versions, args.key, args.delta)
+        print(f"{'FAIL' if frame_failures else 'ok':<6}{name} ({img.shape[1]}x{img.shape[0]})")
+        failures.extend(frame_failures)
+
+    for failure in failures:
+        print(f"  {failure}")
+    print(f"{len(failures)} mismatches")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,697 @@
+"""
+The watermark engine: keyed DCT/QIM watermarks over the 8x8 luma blocks of a
+frame, in the formats listed in FORMAT_VERSIONS, plus multi-key detection and
+grid resynchronization. The per-block loop itself is in backends.py.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from functools import partial
+
+import cv2
+import numpy as np
+from scipy.fftpack import dct
+
+from . import backends, encoders, payload
+from . import triage as triage_layer
+
+# Precision of the DCT/QIM arithmetic ("float64" or "float32")
+COMPUTE_DTYPE = np.dtype(os.getenv("WATERMARK_DTYPE", "float64"))
+# Watermark format written by new embeds (see "Watermark formats" below)
+FORMAT_VERSION = int(os.getenv("WATERMARK_FORMAT_VERSION", "2"))
+# Per-request memory budget for process_frame in MB (0 disables the limit)
+MEMORY_BUDGET_MB = float(os.getenv("WATERMARK_MEMORY_BUDGET_MB", "0"))
+# Worker processes one frame's block rows are split across (1 = serial)
+PARALLEL_WORKERS = int(os.getenv("WATERMARK_WORKERS", "1"))
+# Frames smaller than this (megapixels) are not worth sharding
+PARALLEL_MIN_MP = float(os.getenv("WATERMARK_PARALLEL_MIN_MP", "2"))
+# Also embed the downscale-robust triage layer (see triage.py)
+TRIAGE_LAYER = os.getenv("WATERMARK_TRIAGE_LAYER", "0") == "1"
+
+
+def calculate_image_hash(image_path):
+    """
+    Calculates the SHA-256 hash of an image file.
+    """
+    hasher = hashlib.sha256()
+    with open(image_path, 'rb') as img_file:
+        while chunk := img_file.read(8192):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def calculate_pixel_hash(img):
+    """
+    Calculates the SHA-256 hash of decoded pixels (and their shape), which stays
+    the same when an image is losslessly re-encoded or its metadata is stripped.
+    """
+    hasher = hashlib.sha256(str(img.shape).encode())
+    hasher.update(np.ascontiguousarray(img).data)
+    return hasher.hexdigest()
+
+
+def scramble_watermark(watermark, perm_key):
+    """
+    Scrambles a 2D watermark using a permutation generated with perm_key.
+    Returns the scrambled watermark and the permutation vector.
+    """
+    flat = watermark.flatten()
+    perm = np.random.RandomState(perm_key).permutation(len(flat))
+    scrambled_flat = flat[perm]
+    scrambled = scrambled_flat.reshape(watermark.shape)
+    return scrambled, perm
+
+def generate_scrambled_watermark(shape, key, perm_offset=54321):
+    """
+    Generate an unsolved watermark using key, then scramble it using a permutation key derived from key.
+    """
+    watermark = np.random.RandomState(key).randint(0, 2, shape)
+    perm_key = key + perm_offset
+    scrambled, perm = scramble_watermark(watermark, perm_key)
+    return watermark, scrambled, perm
+
+def adaptive_delta(y_channel, factor=10, min_delta=2.0):
+    contrast = np.std(y_channel)
+    return max(contrast / factor, min_delta)
+
+def qim_embed(coefficient, bit, delta):
+    return np.round(coefficient / delta) * delta if bit == 0 else np.round((coefficient - delta/2) / delta) * delta + delta/2
+
+def qim_extract(coefficient, delta):
+    q0 = np.round(coefficient / delta) * delta
+    q1 = q0 + delta/2
+    return 0 if abs(coefficient - q0) < abs(coefficient - q1) else 1
+
+def qim_targets(values, bits, delta):
+    """
+    Vectorized qim_embed: nearest lattice point of the given bit for each value.
+    """
+    offset = bits * (delta / 2)
+    return np.round((values - offset) / delta) * delta + offset
+
+
+# --- Watermark formats ---
+# v1: watermark bits from np.random.randint(key), scrambled by a permutation
+#     seeded with key + 54321; each block's 3 AC positions drawn by reseeding
+#     an RNG with key + 98765 + i * 1000 + j. Needs one reseed per block.
+# v2: bits and positions are a keyed hash (splitmix64 mixing) of the block
+#     index (i, j), so any set of blocks is computed in one array expression
+#     with no RNG state at all.
+# Both are decoded; new embeds use FORMAT_VERSION.
+
+FORMAT_VERSIONS = (2, 1)  # decodable formats, newest first
+# Formats tried by multi-key detection. A cold v1 table costs about 0.1 s per
+# key and megapixel, so v1 is only tried for many keys when asked for.
+DETECT_VERSIONS = (2, 1) if os.getenv("WATERMARK_DETECT_V1", "0") == "1" else (2,)
+
+_GOLDEN64 = np.uint64(0x9E3779B97F4A7C15)
+_POSITION_DOMAIN = 0x706F736974696F6E  # "position"
+_BIT_DOMAIN = 0x6269747300000000  # "bits"
+
+
+def _mix64(x):
+    """
+    splitmix64 finalizer on a uint64 array (wrapping arithmetic).
+    """
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xBF58476D1CE4E5B9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def _keyed_hash(key, domain, i, j):
+    """
+    64-bit keyed hash of block indices (arrays i, j), one independent stream per domain.
+    """
+    seed = _mix64(np.array([(key ^ domain) & 0xFFFFFFFFFFFFFFFF], dtype=np.uint64))
+    counter = (np.asarray(i).astype(np.uint64) << np.uint64(32)) | np.asarray(j).astype(np.uint64)
+    return _mix64(_mix64(counter ^ seed) + _GOLDEN64)
+
+
+def keyed_positions(key, i, j):
+    """
+    v2 embedding positions: 3 distinct AC indices (0..62, into _AC_POSITIONS)
+    per block, shape i.shape + (3,).
+    """
+    h = _keyed_hash(key, _POSITION_DOMAIN, i, j)
+    a = (h % np.uint64(63)).astype(np.int64)
+    b = ((h // np.uint64(63)) % np.uint64(62)).astype(np.int64)
+    c = ((h // np.uint64(63 * 62)) % np.uint64(61)).astype(np.int64)
+    # Sampling without replacement: step each draw past the values already taken
+    b += b >= a
+    lo, hi = np.minimum(a, b), np.maximum(a, b)
+    c += c >= lo
+    c += c >= hi
+    return np.stack([a, b, c], axis=-1)
+
+
+def keyed_bits(key, i, j):
+    """
+    v2 watermark bits, one per block.
+    """
+    return (_keyed_hash(key, _BIT_DOMAIN, i, j) >> np.uint64(63)).astype(np.uint8)
+
+
+class MemoryBudgetExceeded(MemoryError):
+    """
+    Raised when an image cannot be processed within the configured memory budget.
+    """
+
+
+# Approximate bytes held per pixel while processing a whole frame at once:
+# the input frame, the YCrCb copy, the split planes, the padded luma and,
+# when embedding, the merged/converted output.
+FULL_FRAME_BYTES_PER_PIXEL = {'embed': 14, 'extract': 9}
+# Bytes per pixel that stay alive for the whole request in banded mode
+# (the input frame and, when embedding, the output frame).
+BANDED_FIXED_BYTES_PER_PIXEL = {'embed': 6, 'extract': 3}
+# Bytes per pixel of a band while it is being processed.
+BANDED_WORK_BYTES_PER_PIXEL = 14
+
+
+def estimate_peak_bytes(shape, mode='embed', band_block_rows=None):
+    """
+    Estimates the peak working-set size (in bytes) of process_frame for an image
+    of the given shape. band_block_rows=None estimates the full-frame strategy.
+    """
+    h, w = shape[:2]
+    padded_w = w + (8 - w % 8) % 8
+    if band_block_rows is None:
+        return FULL_FRAME_BYTES_PER_PIXEL[mode] * h * padded_w
+    band_h = min(band_block_rows * 8, h + (8 - h % 8) % 8)
+    return BANDED_FIXED_BYTES_PER_PIXEL[mode] * h * w + BANDED_WORK_BYTES_PER_PIXEL * band_h * padded_w
+
+
+def choose_strategy(shape, mode='embed', memory_budget=None):
+    """
+    Picks the processing strategy for an image under a memory budget (in bytes).
+    Returns ('full', None) when the whole frame fits, otherwise ('banded', rows)
+    with the number of 8-pixel block rows processed per band.
+    """
+    if not memory_budget or estimate_peak_bytes(shape, mode) <= memory_budget:
+        return 'full', None
+
+    h, w = shape[:2]
+    if h < 8 or w < 8:
+        raise MemoryBudgetExceeded("Image is too small to be processed in bands")
+    fixed = BANDED_FIXED_BYTES_PER_PIXEL[mode] * h * w
+    per_block_row = BANDED_WORK_BYTES_PER_PIXEL * 8 * (w + (8 - w % 8) % 8)
+    band_block_rows = int((memory_budget - fixed) // per_block_row)
+    if band_block_rows < 1:
+        raise MemoryBudgetExceeded(
+            f"Image of {h}x{w} needs at least {fixed + per_block_row} bytes, "
+            f"budget is {int(memory_budget)} bytes"
+        )
+    return 'banded', band_block_rows
+
+
+def _reflect_rows(r0, r1, h):
+    """
+    Row indices of the bottom-reflected (cv2.BORDER_REFLECT) image for rows [r0, r1).
+    """
+    rows = np.arange(r0, r1)
+    return np.where(rows < h, rows, 2 * h - 1 - rows)
+
+
+def process_frame(frame, key, delta=None, mode='embed', dtype=None, memory_budget=None, workers=None, version=None,
+                  content_id=None, backend=None):
+    """
+    Processes an image frame to either embed or extract a watermark.
+    The watermark bits are first scrambled using a secret permutation.
+    For each 8x8 block, pseudorandom embedding positions (key-dependent) are chosen.
+
+    dtype selects the precision of the DCT/QIM arithmetic (float64 or float32).
+    memory_budget (bytes) bounds the working set: frames that do not fit are
+    processed in horizontal bands of block rows instead of all at once.
+    workers > 1 splits the block rows of a full frame across that many processes
+    (frames under PARALLEL_MIN_MP megapixels stay serial); the result is identical.
+    version selects the watermark format (default FORMAT_VERSION).
+    content_id replaces the key's bits with a payload carrying that ID (v2 only,
+    see payload.py).
+    backend names the block loop (see backends.py); by default frames that are
+    sharded across workers use "parallel" and the rest DEFAULT_BACKEND.
+    In extract mode the returned frame is the input frame, untouched.
+    """
+    version = version or FORMAT_VERSION
+    dtype = np.dtype(dtype or COMPUTE_DTYPE)
+    if workers is None:
+        workers = PARALLEL_WORKERS
+    if memory_budget is None:
+        memory_budget = MEMORY_BUDGET_MB * 1024 * 1024
+    strategy, band_block_rows = choose_strategy(frame.shape, mode, memory_budget)
+
+    h, w = frame.shape[:2]
+    if backend is None:
+        backend = "parallel" if workers > 1 and h * w >= PARALLEL_MIN_MP * 1e6 else backends.DEFAULT_BACKEND
+    process_blocks = backends.get_backend(backend)
+    if backend == "parallel":
+        if strategy == 'banded':
+            # Sharding copies the plane into shared memory, which a tight budget has no room for
+            process_blocks = backends.get_backend("numpy")
+        else:
+            process_blocks = partial(process_blocks, workers=max(workers, 2))
+    pad_h, pad_w = (8 - h % 8) % 8, (8 - w % 8) % 8
+    num_blocks_h, num_blocks_w = (h + pad_h) // 8, (w + pad_w) // 8
+
+    if delta is None and strategy == 'banded':
+        # Accumulate the luma statistics band by band.
+        total, total_sq = 0.0, 0.0
+        for r0 in range(0, h, band_block_rows * 8):
+            y_band = cv2.cvtColor(frame[r0:r0 + band_block_rows * 8], cv2.COLOR_BGR2YCrCb)[:, :, 0].astype(np.float64)
+            total += y_band.sum()
+            total_sq += np.square(y_band).sum()
+        mean = total / (h * w)
+        delta = max(np.sqrt(max(total_sq / (h * w) - mean * mean, 0.0)) / 10, 2.0)
+
+    # --- Generate (and scramble) watermark ---
+    # Generate the original (unscrambled) watermark using key
+    watermark_shape = (num_blocks_h, num_blocks_w)
+    if content_id is not None:
+        if version != 2:
+            raise ValueError("Payload watermarks need format version 2")
+        expected_watermark = payload.payload_bits(key, watermark_shape, content_id).reshape(
+            watermark_shape).astype(int)
+    elif version == 1:
+        orig_watermark, scrambled_watermark, perm = generate_scrambled_watermark(watermark_shape, key)
+        # For embedding, we will embed the scrambled watermark bits.
+        # In extraction, we will generate the expected scrambled watermark in the same way.
+        expected_watermark = scrambled_watermark.copy() # This is the secret watermark to be embedded/extracted
+    else:
+        expected_watermark = key_tables(key, watermark_shape, version)[1].reshape(watermark_shape).astype(int)
+
+    # Prepare an empty array to hold the extracted scrambled watermark bits.
+    extracted_scrambled_watermark = np.zeros_like(expected_watermark)
+
+    if strategy == 'full':
+        # Convert image to YCrCb color space and split channels
+        ycrcb = cv2.cvtColor(frame, cv2.COLOR_BGR2YCrCb)
+        y, cr, cb = cv2.split(ycrcb)
+        del ycrcb
+        if delta is None:
+            delta = adaptive_delta(y)
+        y_padded = cv2.copyMakeBorder(y, 0, pad_h, 0, pad_w, cv2.BORDER_REFLECT)
+        process_blocks(y_padded, expected_watermark, extracted_scrambled_watermark, key, delta, mode, dtype,
+                       version=version)
+
+        if mode == 'embed':
+            # Reconstruct the Y channel and convert back to BGR color space.
+            y_processed = y_padded[:h, :w].astype(np.uint8)
+            final_frame = cv2.cvtColor(cv2.merge([y_processed, cr, cb]), cv2.COLOR_YCrCb2BGR)
+        else:
+            final_frame = frame
+    else:
+        final_frame = np.empty_like(frame) if mode == 'embed' else frame
+        band_h = band_block_rows * 8
+        for r0 in range(0, h + pad_h, band_h):
+            r1 = min(r0 + band_h, h + pad_h)
+            # Color conversion is per pixel, so converting a band (with the
+            # bottom border reflected in) matches converting the whole frame.
+            ycrcb = cv2.cvtColor(frame[_reflect_rows(r0, r1, h)], cv2.COLOR_BGR2YCrCb)
+            y, cr, cb = cv2.split(ycrcb)
+            del ycrcb
+            y_padded = cv2.copyMakeBorder(y, 0, 0, 0, pad_w, cv2.BORDER_REFLECT)
+            process_blocks(y_padded, expected_watermark, extracted_scrambled_watermark, key, delta, mode, dtype,
+                           row_offset=r0 // 8, version=version)
+
+            if mode == 'embed':
+                rows = min(r1, h) - r0
+                y_processed = y_padded[:rows, :w].astype(np.uint8)
+                final_frame[r0:r0 + rows] = cv2.cvtColor(
+                    cv2.merge([y_processed, cr[:rows], cb[:rows]]), cv2.COLOR_YCrCb2BGR
+                )
+
+    # For extraction mode, we return the expected scrambled watermark (which you can compare with)
+    return (final_frame, expected_watermark, None) if mode == 'embed' else (final_frame, expected_watermark, extracted_scrambled_watermark)
+
+# --- High-level functions ---
+def embed_watermark(input_path, output_path, key, delta=None, version=None, triage=None, content_id=None,
+                    profile=None):
+    img = cv2.imread(input_path)
+    if TRIAGE_LAYER if triage is None else triage:
+        # Goes first: the 8x8 layer keeps the block means the triage layer is read from
+        img = triage_layer.embed_triage(img, key)
+    watermarked_img, expected_wm, _ = process_frame(img, key, delta, mode='embed', version=version,
+                                                    content_id=content_id)
+    # output_path should carry the profile's suffix (see encoders.py)
+    encoders.write(output_path, watermarked_img, profile)
+    # For debugging or record-keeping, you might want to store expected_wm securely.
+    return expected_wm
+
+def embed_encoded(img, key, delta=None, version=None, triage=None, content_id=None, profile=None):
+    """
+    Watermarks a decoded frame and encodes it with an output profile, in memory.
+    Returns (encoded bytes, encode seconds, BER of the watermark as stored):
+    lossless profiles are measured on the frame itself, lossy ones on a decode
+    of the bytes.
+    """
+    if TRIAGE_LAYER if triage is None else triage:
+        img = triage_layer.embed_triage(img, key)
+    watermarked_img, _, _ = process_frame(img, key, delta, mode='embed', version=version, content_id=content_id)
+    data, seconds = encoders.encode_timed(watermarked_img, profile)
+    stored = watermarked_img if encoders.get_profile(profile)[3] else encoders.decode(data)
+    return data, seconds, frame_ber(stored, key, delta, version, content_id)
+
+def frame_ber(img, key, delta=None, version=None, content_id=None):
+    _, expected_wm, extracted_wm = process_frame(img, key, delta, mode='extract', version=version,
+                                                 content_id=content_id)
+    # Calculate BER between expected scrambled watermark and extracted scrambled watermark.
+    return np.mean(expected_wm != extracted_wm)
+
+def extract_watermark(input_path, key, delta=None, version=None, content_id=None):
+    return frame_ber(cv2.imread(input_path), key, delta, version, content_id)
+
+# --- Multi-key detection ---
+# The block DCT of an image is computed once; each candidate key then only
+# costs a gather of its 3 coefficients per block and a vectorized QIM decision.
+
+# Upper bound on keys * blocks gathered in one vectorized step, which bounds the
+# size of the gathered coefficient array.
+DETECT_CHUNK_BLOCKS = 4_000_000
+
+# Flat (row * 8 + col) indices of the 63 AC coefficients of an 8x8 block, in the
+# order process_frame draws them from.
+_AC_POSITIONS = np.array([a * 8 + b for a in range(8) for b in range(8) if not (a == 0 and b == 0)])
+
+
+def block_dct(y_padded, dtype=None):
+    """
+    Returns the orthonormal 2D DCT of every 8x8 block of a padded luma plane as an
+    array of shape (num_blocks_h * num_blocks_w, 64), blocks in row-major order.
+    """
+    dtype = np.dtype(dtype or COMPUTE_DTYPE)
+    num_blocks_h, num_blocks_w = y_padded.shape[0] // 8, y_padded.shape[1] // 8
+    blocks = y_padded.reshape(num_blocks_h, 8, num_blocks_w, 8).swapaxes(1, 2).astype(dtype)
+    coeffs = dct(dct(blocks, axis=2, norm='ortho'), axis=3, norm='ortho')
+    return coeffs.reshape(num_blocks_h * num_blocks_w, 64)
+
+
+def frame_block_dct(frame, dtype=None):
+    """
+    Converts a BGR frame to padded luma exactly as process_frame does and returns
+    its block DCT coefficients together with the block grid shape.
+    """
+    y = cv2.cvtColor(frame, cv2.COLOR_BGR2YCrCb)[:, :, 0]
+    h, w = y.shape
+    y_padded = cv2.copyMakeBorder(y, 0, (8 - h % 8) % 8, 0, (8 - w % 8) % 8, cv2.BORDER_REFLECT)
+    return block_dct(y_padded, dtype), (y_padded.shape[0] // 8, y_padded.shape[1] // 8)
+
+
+# Total size of cached key tables in MB (about 4 bytes per block, 1.5 MB per
+# key at 24 MP); least recently used tables are dropped past it
+KEY_TABLE_CACHE_MB = float(os.getenv("WATERMARK_KEY_TABLE_CACHE_MB", "256"))
+
+_key_table_lock = threading.Lock()
+_key_table_cache = OrderedDict()  # (key, watermark_shape, version) -> (positions, expected)
+_key_table_bytes = 0
+
+
+def key_tables(key, watermark_shape, version):
+    """
+    Returns the per-block embedding positions (flat indices, shape (blocks, 3))
+    and the expected scrambled watermark bits (shape (blocks,)) for a key in
+    the given watermark format. Identical to what process_frame uses; cached
+    per key up to KEY_TABLE_CACHE_MB.
+    """
+    global _key_table_bytes
+    cache_key = (key, tuple(watermark_shape), version)
+    with _key_table_lock:
+        tables = _key_table_cache.get(cache_key)
+        if tables is not None:
+            _key_table_cache.move_to_end(cache_key)
+            return tables
+
+    tables = _build_key_tables(key, tuple(watermark_shape), version)
+    size = tables[0].nbytes + tables[1].nbytes
+    with _key_table_lock:
+        if cache_key not in _key_table_cache and size <= KEY_TABLE_CACHE_MB * 1024 * 1024:
+            _key_table_cache[cache_key] = tables
+            _key_table_bytes += size
+            while _key_table_bytes > KEY_TABLE_CACHE_MB * 1024 * 1024:
+                _, (positions, expected) = _key_table_cache.popitem(last=False)
+                _key_table_bytes -= positions.nbytes + expected.nbytes
+    return tables
+
+
+def _build_key_tables(key, watermark_shape, version):
+    num_blocks_h, num_blocks_w = watermark_shape
+    if version == 2:
+        i, j = np.divmod(np.arange(num_blocks_h * num_blocks_w), num_blocks_w)
+        positions = _AC_POSITIONS[keyed_positions(key, i, j)].astype(np.uint8)
+        expected = keyed_bits(key, i, j)
+        positions.flags.writeable = False
+        expected.flags.writeable = False
+        return positions, expected
+
+    watermark = np.random.RandomState(key).randint(0, 2, watermark_shape)
+    perm = np.random.RandomState(key + 54321).permutation(watermark.size)
+    expected = watermark.flatten()[perm].astype(np.uint8)
+
+    # Reseeding one private generator is much cheaper than constructing one per
+    # block; choice(n, 3, replace=False) is permutation(n)[:3] in the legacy API.
+    pos_key = key + 98765
+    rng = np.random.RandomState()
+    positions = np.empty((num_blocks_h * num_blocks_w, 3), dtype=np.uint8)
+    for i in range(num_blocks_h):
+        for j in range(num_blocks_w):
+            rng.seed(pos_key + i * 1000 + j)
+            positions[i * num_blocks_w + j] = _AC_POSITIONS[rng.permutation(len(_AC_POSITIONS))[:3]]
+    positions.flags.writeable = False
+    expected.flags.writeable = False
+    return positions, expected
+
+
+def qim_bits(coefficients, delta):
+    """
+    Vectorized qim_extract: a boolean bit for every coefficient.
+    """
+    q0 = np.round(coefficients / delta) * delta
+    return np.abs(coefficients - q0) >= np.abs(coefficients - (q0 + delta / 2))
+
+
+def qim_votes(gathered, delta):
+    """
+    Vectorized qim_extract followed by the 3-position majority vote.
+    gathered has shape (..., 3); returns a boolean array of shape (...).
+    """
+    return qim_bits(gathered, delta).sum(axis=-1) >= 2
+
+
+def detect_keys(frame, keys, deltas, dtype=None, versions=DETECT_VERSIONS):
+    """
+    Tests every (key, delta, format version) candidate against one block DCT of
+    the frame. Returns a list of {"key", "delta", "version", "ber"} sorted by
+    BER, best first.
+    """
+    return detect_keys_coeffs(*frame_block_dct(frame, dtype), keys, deltas, versions)
+
+
+def detect_keys_coeffs(coeffs, watermark_shape, keys, deltas, versions=DETECT_VERSIONS):
+    """
+    detect_keys on precomputed block DCT coefficients (from frame_block_dct or
+    upload_block_dct).
+    """
+    num_blocks = coeffs.shape[0]
+    block_index = np.arange(num_blocks)[:, None]
+    chunk = max(1, DETECT_CHUNK_BLOCKS // num_blocks)
+
+    results = []
+    for version in versions:
+        for start in range(0, len(keys), chunk):
+            batch = list(keys[start:start + chunk])
+            tables = [key_tables(key, watermark_shape, version) for key in batch]
+            positions = np.stack([t[0] for t in tables])     # (keys, blocks, 3)
+            expected = np.stack([t[1] for t in tables])      # (keys, blocks)
+            gathered = coeffs[block_index, positions]         # (keys, blocks, 3)
+            for delta in deltas:
+                bers = np.mean(qim_votes(gathered, delta) != expected, axis=1)
+                results.extend({"key": key, "delta": float(delta), "version": version, "ber": float(ber)}
+                               for key, ber in zip(batch, bers))
+    return sorted(results, key=lambda r: r["ber"])
+
+
+def detect_key_coeffs(coeffs, watermark_shape, key, deltas, versions=FORMAT_VERSIONS, threshold=0.3):
+    """
+    Best detection of one key over deltas, as detect_keys_coeffs, that also
+    reads payload watermarks (see payload.py) when the key's own bits
+    are not found. content_id is the payload's ID when it names a record of
+    this registry deployment, else None.
+    """
+    best = dict(detect_keys_coeffs(coeffs, watermark_shape, [key], deltas, versions)[0], content_id=None)
+    if best["ber"] >= threshold and 2 in versions:
+        decoded = payload.decode_payload(coeffs, watermark_shape, key, deltas)
+        if decoded is not None and decoded["ber"] < best["ber"]:
+            best = dict(decoded, key=key)
+            # IDs from another registry deployment are of no use for lookups
+            if decoded["registry_version"] != payload.REGISTRY_VERSION:
+                best["content_id"] = None
+    return best
+
+
+def block_mismatches(coeffs, watermark_shape, key, delta, version=None, content_id=None):
+    """
+    Per-block mismatch map (boolean, shape watermark_shape) of one detection
+    candidate: True where a block's majority vote differs from the expected bit.
+    Its mean is the candidate's BER; see localize.py for where it is low.
+    """
+    version = version or FORMAT_VERSION
+    positions, expected = key_tables(key, tuple(watermark_shape), version)
+    if content_id is not None:
+        expected = payload.payload_bits(key, tuple(watermark_shape), content_id)
+    votes = qim_votes(coeffs[np.arange(coeffs.shape[0])[:, None], positions], delta)
+    return (votes != expected).reshape(watermark_shape)
+
+
+# --- Grid resynchronization for cropped images ---
+# A crop moves the 8x8 grid by a pixel offset (dy, dx) in 0..7 and the block
+# index origin by (i0, j0). Candidates are scored coarse-to-fine: a small
+# sample of blocks for every offset/origin/delta, a larger sample for the
+# survivors and a full-grid extraction only for the last few. QIM decisions for
+# all deltas are packed into one integer per coefficient, so the 3-position
+# majority vote and the comparison run as bitwise operations for every delta
+# at once.
+
+RESYNC_STAGES = ((64, 256), (512, 4))  # (sampled blocks, candidates kept)
+
+
+def _shifted_block_dct(y, dy, dx, rows, cols, dtype):
+    """
+    Block DCT of the blocks at (dy + 8 * rows, dx + 8 * cols) of a luma plane.
+    """
+    r = dy + 8 * rows[:, None, None] + np.arange(8)[None, :, None]
+    c = dx + 8 * cols[:, None, None] + np.arange(8)[None, None, :]
+    blocks = y[r, c].astype(dtype)
+    return dct(dct(blocks, axis=1, norm='ortho'), axis=2, norm='ortho').reshape(len(rows), 64)
+
+
+def _qim_bitplanes(coeffs, deltas):
+    """
+    Bit d of each result is qim_extract(coefficient, deltas[d]).
+    """
+    planes = np.zeros(coeffs.shape, dtype=np.uint64)
+    for d, delta in enumerate(deltas):
+        planes |= qim_bits(coeffs, delta).astype(np.uint64) << np.uint64(d)
+    return planes
+
+
+def _mismatch_counts(planes, positions, expected, num_deltas):
+    """
+    Counts majority-vote mismatches per delta. planes has shape (blocks, 64);
+    positions (..., blocks, 3) and expected (..., blocks) index into it.
+    Returns counts of shape (..., num_deltas).
+    """
+    g = planes[np.arange(planes.shape[0])[:, None], positions]
+    votes = (g[..., 0] & g[..., 1]) | (g[..., 0] & g[..., 2]) | (g[..., 1] & g[..., 2])
+    mismatch = votes ^ (expected.astype(np.uint64) * np.uint64(2 ** num_deltas - 1))
+    return np.stack([((mismatch >> np.uint64(d)) & np.uint64(1)).sum(axis=-1) for d in range(num_deltas)], axis=-1)
+
+
+def resync_search(frame, key, deltas, watermark_shape, max_origin=32, dtype=None, version=None):
+    """
+    Finds the grid offset and block-index origin at which a (possibly cropped)
+    frame best matches the watermark of an original with the given block grid
+    shape. Returns {"ber", "delta", "offset", "origin", "crop"} where crop is
+    the estimated top-left corner of the frame within the original, in pixels.
+    """
+    version = version or FORMAT_VERSION
+    dtype = np.dtype(dtype or COMPUTE_DTYPE)
+    if len(deltas) > 64:
+        raise ValueError("At most 64 candidate deltas are supported")
+    y = cv2.cvtColor(frame, cv2.COLOR_BGR2YCrCb)[:, :, 0]
+    h, w = y.shape
+    # Block grid that is complete for every one of the 64 offsets
+    grid_h, grid_w = (h - 7) // 8, (w - 7) // 8
+    if grid_h < 1 or grid_w < 1:
+        raise ValueError("Image is too small to resynchronize")
+
+    positions, expected = key_tables(key, tuple(watermark_shape), version)
+    positions = positions.reshape(*watermark_shape, 3)
+    expected = expected.reshape(watermark_shape)
+    origins = np.array([(i0, j0)
+                        for i0 in range(min(max_origin, watermark_shape[0] - grid_h) + 1)
+                        for j0 in range(min(max_origin, watermark_shape[1] - grid_w) + 1)]).reshape(-1, 2)
+    if len(origins) == 0:
+        raise ValueError("Image is larger than the original watermark grid")
+    offsets = [(dy, dx) for dy in range(8) for dx in range(8)]
+
+    # Candidates are (offset index, origin index, delta index); all start alive.
+    candidates = np.array([(o, k, d) for o in range(len(offsets))
+                           for k in range(len(origins)) for d in range(len(deltas))])
+    sampler = np.random.RandomState(0)
+    for sample_size, keep in RESYNC_STAGES:
+        sample = sampler.choice(grid_h * grid_w, min(sample_size, grid_h * grid_w), replace=False)
+        rows, cols = sample // grid_w, sample % grid_w
+        scores = np.empty(len(candidates))
+        for o in np.unique(candidates[:, 0]):
+            planes = _qim_bitplanes(_shifted_block_dct(y, *offsets[o], rows, cols, dtype), deltas)
+            sel = np.flatnonzero(candidates[:, 0] == o)
+            ks, k_index = np.unique(candidates[sel, 1], return_inverse=True)
+            r = rows[None, :] + origins[ks, 0:1]
+            c = cols[None, :] + origins[ks, 1:2]
+            counts = _mismatch_counts(planes, positions[r, c], expected[r, c], len(deltas))
+            scores[sel] = counts[k_index, candidates[sel, 2]] / len(sample)
+        candidates = candidates[np.argsort(scores, kind='stable')[:keep]]
+
+    # Full-grid extraction for the surviving candidates
+    best = None
+    for o, k, d in candidates:
+        (dy, dx), (i0, j0) = offsets[o], origins[k]
+        nbh = min((h - dy) // 8, watermark_shape[0] - i0)
+        nbw = min((w - dx) // 8, watermark_shape[1] - j0)
+        rows, cols = np.divmod(np.arange(nbh * nbw), nbw)
+        coeffs = _shifted_block_dct(y, dy, dx, rows, cols, dtype)
+        table = positions[i0:i0 + nbh, j0:j0 + nbw].reshape(-1, 3)
+        votes = qim_votes(coeffs[np.arange(len(rows))[:, None], table], deltas[d])
+        ber = float(np.mean(votes != expected[i0:i0 + nbh, j0:j0 + nbw].ravel()))
+        if best is None or ber < best["ber"]:
+            best = {"ber": ber, "delta": float(deltas[d]), "offset": [int(dy), int(dx)],
+                    "origin": [int(i0), int(j0)], "crop": [int(8 * i0 - dy), int(8 * j0 - dx)], "version": version}
+    return best
+
+
+def resync_block_dct(coeffs, grid_shape, key, deltas, watermark_shape, max_origin=32, version=None):
+    """
+    resync_search for crops that kept the 8x8 grid (offset (0, 0)), such as
+    lossless JPEG crops, on precomputed block DCT coefficients (from
+    upload_block_dct), so JPEG-native embeds are read from their stored
+    coefficients. Only block-index origins are searched; same result format.
+    """
+    version = version or FORMAT_VERSION
+    if len(deltas) > 64:
+        raise ValueError("At most 64 candidate deltas are supported")
+    grid_h, grid_w = grid_shape
+    positions, expected = key_tables(key, tuple(watermark_shape), version)
+    positions = positions.reshape(*watermark_shape, 3)
+    expected = expected.reshape(watermark_shape)
+    origins = np.array([(i0, j0)
+                        for i0 in range(min(max_origin, watermark_shape[0] - grid_h) + 1)
+                        for j0 in range(min(max_origin, watermark_shape[1] - grid_w) + 1)]).reshape(-1, 2)
+    if len(origins) == 0:
+        raise ValueError("Image is larger than the original watermark grid")
+
+    # Candidates are (origin index, delta index), scored on growing samples as in resync_search
+    candidates = np.array([(k, d) for k in range(len(origins)) for d in range(len(deltas))])
+    sampler = np.random.RandomState(0)
+    for sample_size, keep in RESYNC_STAGES:
+        sample = sampler.choice(grid_h * grid_w, min(sample_size, grid_h * grid_w), replace=False)
+        rows, cols = sample // grid_w, sample % grid_w
+        planes = _qim_bitplanes(coeffs[sample], deltas)
+        ks, k_index = np.unique(candidates[:, 0], return_inverse=True)
+        r = rows[None, :] + origins[ks, 0:1]
+        c = cols[None, :] + origins[ks, 1:2]
+        counts = _mismatch_counts(planes, positions[r, c], expected[r, c], len(deltas))
+        scores = counts[k_index, candidates[:, 1]] / len(sample)
+        candidates = candidates[np.argsort(scores, kind='stable')[:keep]]
+
+    best = None
+    block_index = np.arange(grid_h * grid_w)[:, None]
+    for k, d in candidates:
+        i0, j0 = origins[k]
+        table = positions[i0:i0 + grid_h, j0:j0 + grid_w].reshape(-1, 3)
+        votes = qim_votes(coeffs[block_index, table], deltas[d])
+        ber = float(np.mean(votes != expected[i0:i0 + grid_h, j0:j0 + grid_w].ravel()))
+        if best is None or ber < best["ber"]:
+            best = {"ber": ber, "delta": float(deltas[d]), "offset": [0, 0], "origin": [int(i0), int(j0)],
+                    "crop": [int(8 * i0), int(8 * j0)], "version": version}
+    return best
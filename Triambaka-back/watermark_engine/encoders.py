@@ -0,0 +1,120 @@
+"""
+Output profiles for watermarked images: which format and encoder settings
+a frame is written with. Frames are encoded in memory. Encode time and bytes
+per profile are counted for /api/metrics (the async server counts the final
+encode of each embed its workers make); `python bench.py encode` measures the
+trade-offs on your own images.
+
+    png            OpenCV's default PNG settings (the historical output)
+    png-fast       zlib level 1, no row filter: a little faster than png and,
+                   on watermarked photos, about 10% smaller
+    png-max        zlib level 9, no row filter: about 40% smaller than png,
+                   but some 40x its encode time (level 3 already gets half of
+                   that saving at 1.5x)
+    webp-lossless  lossless WebP: about half the size of png, some 20x the
+                   encode time
+    jpeg-hq        JPEG quality 95: smallest by far, lossy, so the BER is
+                   measured on the decoded output and delta starts higher
+"""
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+# Profile of pixel-domain outputs when a request does not name one
+DEFAULT_PROFILE = os.getenv("WATERMARK_OUTPUT_PROFILE", "png")
+
+# name: (suffix, mimetype, cv2.imencode params, lossless)
+PROFILES = {
+    "png": ('.png', 'image/png', [], True),
+    "png-fast": ('.png', 'image/png',
+                 [cv2.IMWRITE_PNG_COMPRESSION, 1, cv2.IMWRITE_PNG_FILTER, cv2.IMWRITE_PNG_FILTER_NONE], True),
+    "png-max": ('.png', 'image/png',
+                [cv2.IMWRITE_PNG_COMPRESSION, 9, cv2.IMWRITE_PNG_FILTER, cv2.IMWRITE_PNG_FILTER_NONE], True),
+    "webp-lossless": ('.webp', 'image/webp', [cv2.IMWRITE_WEBP_QUALITY, 101], True),
+    "jpeg-hq": ('.jpg', 'image/jpeg', [cv2.IMWRITE_JPEG_QUALITY, 95], False),
+}
+
+# Starting delta of lossy profiles, instead of climbing there in steps of 0.25:
+# where the BER after the encode bottoms out on typical photos, well clear of
+# the 0.3 threshold (jpeg-hq: 0.35 at 12, 0.27 at 16, 0.23 at 24, 0.27 at 32).
+# Checks sweep the deltas embeds can end on from here (see sweep_deltas in
+# routes/watermark.py).
+LOSSY_START_DELTA = {"jpeg-hq": 24.0}
+
+_lock = threading.Lock()
+_counters = {}
+
+
+def get_profile(name=None):
+    """
+    (suffix, mimetype, params, lossless) of a profile (default DEFAULT_PROFILE).
+    """
+    name = name or DEFAULT_PROFILE
+    if name not in PROFILES:
+        raise ValueError(f"Unknown output profile {name!r} (expected one of {', '.join(PROFILES)})")
+    return PROFILES[name]
+
+
+def record(profile, seconds, nbytes, megapixels):
+    """
+    Counts one encode towards the metrics of a profile.
+    """
+    with _lock:
+        stats = _counters.setdefault(profile, {"encodes": 0, "seconds": 0.0, "bytes": 0, "megapixels": 0.0})
+        stats["encodes"] += 1
+        stats["seconds"] += seconds
+        stats["bytes"] += nbytes
+        stats["megapixels"] += megapixels
+
+
+def encode_timed(img, profile=None):
+    """
+    Encodes a BGR frame with an output profile. Returns (bytes, seconds taken).
+    """
+    profile = profile or DEFAULT_PROFILE
+    suffix, _, params, _ = get_profile(profile)
+    start = time.perf_counter()
+    ok, buffer = cv2.imencode(suffix, img, params)
+    elapsed = time.perf_counter() - start
+    if not ok:
+        raise ValueError(f"Could not encode image as {profile}")
+    data = buffer.tobytes()
+    record(profile, elapsed, len(data), img.shape[0] * img.shape[1] / 1e6)
+    return data, elapsed
+
+
+def encode(img, profile=None):
+    return encode_timed(img, profile)[0]
+
+
+def decode(data):
+    """
+    Decodes encoded bytes back to a BGR frame.
+    """
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+
+
+def write(path, img, profile=None):
+    """
+    Encodes a frame and writes it to path; returns the bytes written.
+    """
+    data = encode(img, profile)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return data
+
+
+def metrics():
+    """
+    Encodes, seconds and bytes per profile since the process started.
+    """
+    with _lock:
+        result = {}
+        for name, stats in _counters.items():
+            megapixels = stats["megapixels"] or None
+            result[name] = dict(stats, seconds_per_megapixel=megapixels and stats["seconds"] / megapixels,
+                                bytes_per_megapixel=megapixels and stats["bytes"] / megapixels)
+        return result
@@ -0,0 +1,249 @@
+"""
+JPEG-native watermarking: QIM is applied to the quantized luma DCT coefficients
+stored in the file, so JPEG inputs skip the pixel decode, color conversion and
+block DCT, and the output is written with the input's own quantization and
+Huffman tables instead of being re-encoded losslessly to PNG. Optimized tables
+only have codes for the symbols the input used; when the watermarked
+coefficients need others, jpeg_embed raises HuffmanTablesIncomplete (jpegio
+cannot rebuild the tables, and libjpeg would exit the process).
+
+A JPEG's luma coefficients use the same 8x8 grid and orthonormal DCT as
+process_frame, but the QIM decisions of embeds made here sit close to their
+boundaries, and the decode to pixels moves them past: JPEG-native embeds have
+to be read from the coefficients too (upload_block_dct in routes/watermark.py).
+"""
+# core imports this module; its attributes are looked up at call time.
+import numpy as np
+
+from . import core, payload
+from . import triage as triage_layer
+
+try:
+    import jpegio
+except ImportError:  # JPEG-native path is optional; callers fall back to pixels
+    jpegio = None
+
+JPEG_MAGIC = b"\xff\xd8\xff"
+# Start-of-frame markers (SOF0-SOF15 except DHT, JPG and DAC)
+_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# Natural (row-major) index of each coefficient in zigzag order
+_ZIGZAG = np.array(sorted(range(64), key=lambda k: (k // 8 + k % 8, k // 8 if (k // 8 + k % 8) % 2 else k % 8)))
+
+
+class HuffmanTablesIncomplete(ValueError):
+    """Raised when a JPEG's Huffman tables have no codes for its watermarked coefficients."""
+
+
+def _header_segments(path):
+    """
+    Yields (marker, segment) for the JPEG header segments up to the start of
+    scan, without decoding anything. Yields nothing when the file is not a JPEG.
+    """
+    with open(path, 'rb') as f:
+        if f.read(2) != JPEG_MAGIC[:2]:
+            return
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xFF or marker[1] == 0xDA:
+                return
+            length = int.from_bytes(f.read(2), 'big')
+            yield marker[1], f.read(length - 2)
+
+
+def frame_header(path):
+    """
+    Walks the JPEG header segments up to the start of frame. Returns (height,
+    width, components, Adobe APP14 color transform or None), or None when the
+    file is not a JPEG.
+    """
+    adobe_transform = None
+    for marker, segment in _header_segments(path):
+        if marker == 0xEE and segment.startswith(b"Adobe") and len(segment) >= 12:
+            adobe_transform = segment[11]
+        elif marker in _SOF_MARKERS:
+            height, width = int.from_bytes(segment[1:3], 'big'), int.from_bytes(segment[3:5], 'big')
+            return height, width, segment[5], adobe_transform
+    return None
+
+
+def restarts_present(path):
+    """True when the JPEG defines a nonzero restart interval (DRI) before its scan."""
+    return any(marker == 0xDD and int.from_bytes(segment[:2], 'big') > 0
+               for marker, segment in _header_segments(path))
+
+
+def _size(values):
+    """JPEG magnitude category (bit length) of each value."""
+    return np.frexp(np.abs(values).astype(np.float64))[1]
+
+
+def _ac_symbols(coef):
+    """
+    The AC Huffman symbols (run << 4 | size, ZRL 0xF0, EOB 0x00) needed to code
+    a component's coefficient array.
+    """
+    blocks = coef.reshape(coef.shape[0] // 8, 8, coef.shape[1] // 8, 8).swapaxes(1, 2).reshape(-1, 64)
+    zigzag = blocks[:, _ZIGZAG[1:]]
+    rows, cols = np.nonzero(zigzag)
+    first = np.r_[True, rows[1:] != rows[:-1]]
+    previous = np.where(first, -1, np.r_[-1, cols[:-1]])
+    runs = cols - previous - 1
+    symbols = set(np.unique((runs % 16) << 4 | _size(zigzag[rows, cols])).tolist())
+    if (runs >= 16).any():
+        symbols.add(0xF0)
+    last = np.r_[rows[1:] != rows[:-1], True]
+    if len(np.unique(rows)) < blocks.shape[0] or (cols[last] < 62).any():
+        symbols.add(0x00)
+    return symbols
+
+
+def _dc_symbols(jpeg, restarts):
+    """
+    The DC Huffman symbols (size of the difference to the previous block's DC
+    in scan order) needed to code the luma component. With restarts the
+    predictor is reset at unknown blocks, so the sizes of the DC values
+    themselves are added too.
+    """
+    info = jpeg.comp_info[0]
+    dc = jpeg.coef_arrays[0][::8, ::8].astype(np.float64)
+    if jpeg.num_components > 1:
+        # Interleaved scan: blocks in MCU order; edge MCUs are padded with dummy
+        # blocks that repeat the previous DC (a difference of 0)
+        v, h = info.v_samp_factor, info.h_samp_factor
+        padded = np.pad(dc, ((0, -dc.shape[0] % v), (0, -dc.shape[1] % h)), constant_values=np.nan)
+        order = padded.reshape(padded.shape[0] // v, v, padded.shape[1] // h, h).swapaxes(1, 2).ravel()
+        dc = order[~np.isnan(order)]
+        dummies = order.size > dc.size
+    else:
+        dc, dummies = dc.ravel(), False
+    symbols = set(np.unique(_size(np.diff(dc, prepend=0))).tolist())
+    if restarts:
+        symbols |= set(np.unique(_size(dc)).tolist())
+    if dummies:
+        symbols.add(0)
+    return symbols
+
+
+def _table_symbols(table):
+    return set(np.asarray(table["symbols"])[:int(np.sum(table["counts"]))].tolist())
+
+
+def _check_huffman_tables(jpeg, restarts):
+    """
+    Raises HuffmanTablesIncomplete when the luma Huffman tables jpegio will
+    write lack a symbol the luma coefficients need. Progressive files are
+    always written with optimized tables (libjpeg assumes stored ones are no
+    good for its own scan script), so they never are.
+    """
+    if jpeg.progressive_mode:
+        return
+    info = jpeg.comp_info[0]
+    missing_ac = _ac_symbols(jpeg.coef_arrays[0]) - _table_symbols(jpeg.ac_huff_tables[info.ac_tbl_no])
+    missing_dc = _dc_symbols(jpeg, restarts) - _table_symbols(jpeg.dc_huff_tables[info.dc_tbl_no])
+    if missing_ac or missing_dc:
+        raise HuffmanTablesIncomplete(f"JPEG Huffman tables lack {len(missing_ac)} AC and {len(missing_dc)} DC "
+                                      f"symbols the watermarked coefficients need")
+
+
+def is_luma_jpeg(path):
+    """
+    True when the file is a JPEG whose first component is luma: grayscale, or
+    3-component YCbCr that is not flagged as RGB by an Adobe APP14 marker.
+    """
+    header = frame_header(path)
+    if header is None:
+        return False
+    components, adobe_transform = header[2:]
+    return components == 1 or (components == 3 and adobe_transform != 0)
+
+
+def supports_jpeg_native(path):
+    """
+    True when jpegio is installed and the file is a JPEG whose first component is luma.
+    """
+    return jpegio is not None and is_luma_jpeg(path)
+
+
+def _luma_grid(jpeg):
+    """
+    Returns the quantized luma coefficients as (blocks_h, blocks_w, 8, 8) int32
+    (a view into the jpegio object, trimmed to the image's own block grid), the
+    luma quantization table and the watermark grid shape.
+    """
+    blocks_h, blocks_w = (jpeg.image_height + 7) // 8, (jpeg.image_width + 7) // 8
+    coef = jpeg.coef_arrays[0][:blocks_h * 8, :blocks_w * 8]
+    grid = coef.reshape(blocks_h, 8, blocks_w, 8).swapaxes(1, 2)
+    quant = jpeg.quant_tables[jpeg.comp_info[0].quant_tbl_no].astype(np.float64)
+    return grid, quant, (blocks_h, blocks_w)
+
+
+def jpeg_block_dct(path):
+    """
+    Reads dequantized luma DCT coefficients straight from a JPEG. Same layout as
+    block_dct: shape (blocks, 64) plus the block grid shape.
+    """
+    # coef_arrays are views into memory owned by the jpegio object, so it has
+    # to stay referenced until the coefficients have been copied out.
+    jpeg = jpegio.read(path)
+    grid, quant, watermark_shape = _luma_grid(jpeg)
+    coeffs = grid.astype(np.float64) * quant
+    del jpeg
+    return coeffs.reshape(-1, 64), watermark_shape
+
+
+def jpeg_embed(input_path, output_path, key, delta, version, triage=False, content_id=None):
+    """
+    Embeds the watermark into a JPEG's luma coefficients and writes a JPEG with
+    the same quantization tables. Returns (expected watermark, width, height).
+    triage also embeds the triage layer in the DC coefficients; content_id
+    embeds a payload carrying that ID instead of the key's bits.
+
+    Each chosen coefficient is set to the integer quantization level closest to
+    its QIM lattice point whose dequantized value still decodes to the right
+    bit; with coarse quantization steps that may not exist, which shows up as
+    a higher BER.
+    """
+    jpeg = jpegio.read(input_path)
+    grid, quant, watermark_shape = _luma_grid(jpeg)
+    positions, expected = core.key_tables(key, watermark_shape, version)
+    if content_id is not None:
+        expected = payload.payload_bits(key, watermark_shape, content_id)
+
+    flat = grid.reshape(-1, 64)  # copy of the trimmed, block-ordered coefficients
+    rows = np.arange(flat.shape[0])[:, None]
+    steps = quant.reshape(64)[positions]
+    bits = np.broadcast_to(expected[:, None].astype(bool), positions.shape)
+
+    targets = core.qim_targets(flat[rows, positions] * steps, bits, delta)
+    levels = np.round(targets / steps)
+    best, best_error = levels, np.full(levels.shape, np.inf)
+    for candidate in (levels, levels - 1, levels + 1):
+        values = candidate * steps
+        error = np.where(core.qim_bits(values, delta) == bits, np.abs(values - targets), np.inf)
+        better = error < best_error
+        best, best_error = np.where(better, candidate, best), np.where(better, error, best_error)
+    flat[rows, positions] = best.astype(flat.dtype)
+
+    blocks_h, blocks_w = watermark_shape
+    if triage:
+        dc_levels = flat[:, 0].reshape(watermark_shape)
+        triage_layer.embed_triage_dc(dc_levels, quant[0, 0], jpeg.image_height, jpeg.image_width, key)
+        flat[:, 0] = dc_levels.ravel()
+    jpeg.coef_arrays[0][:blocks_h * 8, :blocks_w * 8] = flat.reshape(blocks_h, blocks_w, 8, 8).swapaxes(1, 2).reshape(
+        blocks_h * 8, blocks_w * 8)
+    _check_huffman_tables(jpeg, restarts_present(input_path))
+    jpeg.write(output_path)
+    return expected.reshape(watermark_shape), jpeg.image_width, jpeg.image_height
+
+
+def jpeg_extract(path, key, delta, version, content_id=None):
+    """
+    BER of the watermark (or of the payload carrying content_id) read from a
+    JPEG's luma coefficients.
+    """
+    coeffs, watermark_shape = jpeg_block_dct(path)
+    positions, expected = core.key_tables(key, watermark_shape, version)
+    if content_id is not None:
+        expected = payload.payload_bits(key, watermark_shape, content_id)
+    votes = core.qim_votes(coeffs[np.arange(coeffs.shape[0])[:, None], positions], delta)
+    return float(np.mean(votes != expected))
@@ -0,0 +1,180 @@
+"""
+Payload watermarks: instead of the key's own bit pattern, the 8x8 layer
+carries a content ID, so a detected image names its ContentRegistry record
+directly (one getContent call) even after its bytes have changed.
+
+The payload (registry version, content ID, CRC-16) is convolutionally encoded
+(rate 1/2, constraint length 7) into CODED_BITS bits. Every block carries one
+of them, picked by a keyed hash of the block index, XORed with the block's v2
+keyed bit, so each coded bit is repeated across blocks all over the image and
+the embedded pattern still looks like a plain v2 watermark. Decoding sums the
+blocks' soft votes per coded bit for every candidate delta at once and runs a
+Viterbi decoder over all of them together; a payload counts only if its
+checksum matches.
+"""
+# core imports this module; its attributes are looked up at call time.
+import binascii
+import os
+from functools import lru_cache
+
+import numpy as np
+
+from . import core
+
+# Written into new payloads; bump it when ContentRegistry is redeployed and IDs start over
+REGISTRY_VERSION = int(os.getenv("WATERMARK_PAYLOAD_REGISTRY_VERSION", "1"))
+
+VERSION_BITS = 8
+ID_BITS = 32
+CRC_BITS = 16
+PAYLOAD_BITS = VERSION_BITS + ID_BITS + CRC_BITS
+# Convolutional code: the industry-standard K=7 pair of generators (octal 171, 133)
+GENERATORS = (0o171, 0o133)
+CONSTRAINT = 7
+CODED_BITS = (PAYLOAD_BITS + CONSTRAINT - 1) * len(GENERATORS)
+# Fewest blocks per coded bit an image needs to carry a payload
+MIN_COPIES = 8
+
+_PAYLOAD_DOMAIN = 0x7061796C6F616400  # "payload"
+_STATES = 1 << (CONSTRAINT - 1)
+
+# Encoder register (input bit << 6 | state) -> output bits
+_OUTPUTS = np.array([[bin(reg & g).count('1') & 1 for g in GENERATORS] for reg in range(1 << CONSTRAINT)],
+                    dtype=np.uint8)
+# Trellis: the two predecessors of each state and the outputs of the step from them
+_NEXT = np.arange(_STATES)
+_PREV = ((_NEXT[:, None] << 1) & (_STATES - 1)) | np.arange(2)
+_SIGNS = 2.0 * _OUTPUTS[((_NEXT[:, None] >> (CONSTRAINT - 2)) << (CONSTRAINT - 1)) | _PREV] - 1
+
+
+def _bits(value, width):
+    return np.unpackbits(np.frombuffer(value.to_bytes(width // 8, 'big'), dtype=np.uint8))
+
+
+def _int(bits):
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def _crc(bits):
+    return binascii.crc_hqx(np.packbits(bits).tobytes(), 0xFFFF)
+
+
+def pack_payload(content_id, registry_version=None):
+    """
+    Payload bits (MSB first): registry version, content ID, CRC-16 of both.
+    """
+    registry_version = REGISTRY_VERSION if registry_version is None else registry_version
+    if not 0 < content_id < 1 << ID_BITS:
+        raise ValueError(f"Content ID must be between 1 and {(1 << ID_BITS) - 1}")
+    if not 0 <= registry_version < 1 << VERSION_BITS:
+        raise ValueError(f"Registry version must be between 0 and {(1 << VERSION_BITS) - 1}")
+    data = np.concatenate([_bits(registry_version, VERSION_BITS), _bits(content_id, ID_BITS)])
+    return np.concatenate([data, _bits(_crc(data), CRC_BITS)])
+
+
+def unpack_payload(bits):
+    """
+    (registry version, content ID) of payload bits, or None if the checksum does not match.
+    """
+    data, crc = bits[:VERSION_BITS + ID_BITS], bits[VERSION_BITS + ID_BITS:]
+    if _crc(data) != _int(crc):
+        return None
+    return _int(data[:VERSION_BITS]), _int(data[VERSION_BITS:])
+
+
+def conv_encode(bits):
+    """
+    Convolutional encoding, terminated with CONSTRAINT - 1 zero bits.
+    """
+    state, coded = 0, []
+    for bit in np.concatenate([bits, np.zeros(CONSTRAINT - 1, dtype=np.uint8)]):
+        reg = (int(bit) << (CONSTRAINT - 1)) | state
+        coded.append(_OUTPUTS[reg])
+        state = reg >> 1
+    return np.concatenate(coded)
+
+
+def viterbi_decode(soft):
+    """
+    Maximum-likelihood decoding of terminated conv_encode output from soft
+    values (positive means 1), shape (..., coded bits). Any leading axes are
+    decoded together. Returns the input bits, shape (..., payload bits).
+    """
+    soft = np.asarray(soft, dtype=np.float64)
+    batch = soft.shape[:-1]
+    steps = soft.shape[-1] // len(GENERATORS)
+    soft = soft.reshape(batch + (steps, len(GENERATORS)))
+
+    metrics = np.full(batch + (_STATES,), -np.inf)
+    metrics[..., 0] = 0
+    choices = np.empty((steps,) + batch + (_STATES,), dtype=np.int64)
+    for t in range(steps):
+        candidates = metrics[..., _PREV] + np.einsum('spo,...o->...sp', _SIGNS, soft[..., t, :])
+        choices[t] = np.argmax(candidates, axis=-1)
+        metrics = np.take_along_axis(candidates, choices[t][..., None], axis=-1)[..., 0]
+
+    # Trace back from the all-zero state the tail bits end in
+    state = np.zeros(batch + (1,), dtype=np.int64)
+    bits = np.empty(batch + (steps,), dtype=np.uint8)
+    for t in range(steps - 1, -1, -1):
+        bits[..., t] = (state[..., 0] >> (CONSTRAINT - 2)) & 1
+        state = ((state << 1) & (_STATES - 1)) | np.take_along_axis(choices[t], state, axis=-1)
+    return bits[..., :steps - (CONSTRAINT - 1)]
+
+
+@lru_cache(maxsize=256)
+def payload_slots(key, watermark_shape):
+    """
+    Coded bit carried by every block, shape (blocks,). Read-only; cached per key.
+    """
+    num_blocks_h, num_blocks_w = watermark_shape
+    i, j = np.divmod(np.arange(num_blocks_h * num_blocks_w), num_blocks_w)
+    slots = (core._keyed_hash(key, _PAYLOAD_DOMAIN, i, j) % np.uint64(CODED_BITS)).astype(np.int64)
+    slots.flags.writeable = False
+    return slots
+
+
+def capacity_ok(watermark_shape):
+    return watermark_shape[0] * watermark_shape[1] >= MIN_COPIES * CODED_BITS
+
+
+def payload_bits(key, watermark_shape, content_id, registry_version=None):
+    """
+    Block bits (shape (blocks,), same layout as key_tables) that carry a
+    content ID, for format v2 positions.
+    """
+    if not capacity_ok(watermark_shape):
+        raise ValueError(f"Image is too small to carry a payload (needs {MIN_COPIES * CODED_BITS} 8x8 blocks)")
+    coded = conv_encode(pack_payload(content_id, registry_version))
+    return coded[payload_slots(key, watermark_shape)] ^ core.key_tables(key, watermark_shape, 2)[1]
+
+
+def decode_payload(coeffs, watermark_shape, key, deltas):
+    """
+    Reads a payload from block DCT coefficients (from frame_block_dct or
+    upload_block_dct), trying every delta. Returns the {"content_id",
+    "registry_version", "delta", "ber", "version"} of the delta with the lowest
+    BER whose payload checksum matches, or None.
+    """
+    if not capacity_ok(watermark_shape):
+        return None
+    positions, scramble = core.key_tables(key, watermark_shape, 2)
+    slots = payload_slots(key, watermark_shape)
+    gathered = coeffs[np.arange(coeffs.shape[0])[:, None], positions]
+
+    # Votes of the 3 positions of every block, one delta at a time: (deltas, blocks)
+    votes = np.stack([core.qim_bits(gathered, delta).sum(axis=-1, dtype=np.uint8) for delta in deltas])
+    signs = 1 - 2 * scramble.astype(np.float64)
+    sums = np.stack([np.bincount(slots, (row - 1.5) * signs, minlength=CODED_BITS) for row in votes])
+
+    best = None
+    for delta, block_votes, bits in zip(deltas, votes, viterbi_decode(sums)):
+        fields = unpack_payload(bits)
+        if fields is None:
+            continue
+        expected = conv_encode(bits)[slots] ^ scramble
+        ber = float(np.mean((block_votes >= 2) != expected))
+        if best is None or ber < best["ber"]:
+            best = {"content_id": fields[1], "registry_version": fields[0], "delta": float(delta), "ber": ber,
+                    "version": 2}
+    return best
@@ -0,0 +1,216 @@
+"""
+Triage watermark layer: an optional second watermark, embedded alongside the
+8x8 QIM layer, that survives downscaling and is read from a reduced decode
+(cv2.IMREAD_REDUCED_GRAYSCALE_8), so a triage check touches a small fraction of
+the pixels and only positives need a full extraction.
+
+The layer lives in the means of the 8x8 luma blocks, which is exactly what a
+1/8 JPEG decode produces (the DC coefficients, without any IDCT) and what the
+8x8 layer never changes. The block means are split into a TRIAGE_GRID x
+TRIAGE_GRID grid of cells in relative coordinates, and each cell carries one
+keyed bit by QIM on its mean, weighted by a half-sine bump that vanishes at
+the cell border. The embedder adds that same bump, so there are no cell edges
+to see, and a downscaled copy, whose blocks straddle the original ones, barely
+changes the weighted means. JPEG-native embeds move the DC coefficients instead.
+"""
+# core imports this module; its attributes are looked up at call time.
+import os
+from functools import lru_cache
+
+import cv2
+import numpy as np
+
+from . import core, jpeg
+
+# Cells per side of the triage grid (one bit per cell)
+TRIAGE_GRID = int(os.getenv("WATERMARK_TRIAGE_GRID", "8"))
+# QIM step on the weighted cell means, in gray levels
+TRIAGE_DELTA = float(os.getenv("WATERMARK_TRIAGE_DELTA", "4"))
+# Triage BER below which an image is escalated to a full extraction
+TRIAGE_THRESHOLD = float(os.getenv("WATERMARK_TRIAGE_THRESHOLD", "0.25"))
+
+# Cells narrower than this many blocks are not embedded
+MIN_CELL_BLOCKS = 2
+# Cells narrower than this many samples (blocks, or pixels of a small image) are not read
+MIN_CELL_SAMPLES = 4
+# Images whose block means would give fewer samples per cell than this are
+# read pixel by pixel instead (thumbnails, mostly)
+BLOCK_CELL_SAMPLES = 8
+# Lattice offsets tried when reading (see triage_ber)
+OFFSET_STEPS = 8
+# Corrections applied to the cell means after rounding and clipping
+EMBED_PASSES = 3
+
+_TRIAGE_DOMAIN = 0x7472696167650000  # "triage"
+
+
+def triage_bits(key, grid=None):
+    """
+    Keyed triage bits, one per cell, shape (grid, grid).
+    """
+    grid = grid or TRIAGE_GRID
+    i, j = np.divmod(np.arange(grid * grid), grid)
+    return (core._keyed_hash(key, _TRIAGE_DOMAIN, i, j) >> np.uint64(63)).astype(bool).reshape(grid, grid)
+
+
+@lru_cache(maxsize=64)
+def _bumps(length, grid, block=1):
+    """
+    (grid, samples) matrix whose row c is a half-sine over cell c and 0
+    elsewhere, for an axis of length pixels. Cells are grid equal parts of the
+    axis in continuous coordinates, so a resized copy has the same bumps at its
+    own resolution. With block=8 each sample is one 8-pixel block and gets the
+    bump averaged over its pixels. Read-only; cached.
+    """
+    u = (np.arange(length) + 0.5) * grid / length
+    cell = np.minimum(u.astype(np.int64), grid - 1)
+    bumps = np.zeros((grid, -(-length // block) * block))
+    bumps[cell, np.arange(length)] = np.sin(np.pi * (u - cell))
+    counts = np.diff(np.minimum(np.arange(0, bumps.shape[1] + 1, block), length))
+    bumps = bumps.reshape(grid, -1, block).sum(axis=2) / counts
+    bumps.flags.writeable = False
+    return bumps
+
+
+def block_means(gray):
+    """
+    Means of the 8x8 blocks of a 2D image, the last row and column of blocks
+    padded by edge replication as a JPEG encoder does.
+    """
+    h, w = gray.shape
+    padded = np.pad(gray.astype(np.float64), ((0, -h % 8), (0, -w % 8)), mode='edge')
+    return padded.reshape(padded.shape[0] // 8, 8, padded.shape[1] // 8, 8).mean(axis=(1, 3))
+
+
+def embeddable(height, width, grid=None):
+    return min(height, width) >= (grid or TRIAGE_GRID) * MIN_CELL_BLOCKS * 8
+
+
+def cell_means(samples, shape=None, grid=None):
+    """
+    Bump-weighted mean of every grid cell, shape (grid, grid), of the block
+    means of an image of the given (height, width) in pixels, or of plain
+    pixels when shape is None.
+    """
+    grid = grid or TRIAGE_GRID
+    block = 1 if shape is None else 8
+    height, width = samples.shape if shape is None else shape
+    rows, cols = _bumps(height, grid, block), _bumps(width, grid, block)
+    return (rows @ samples @ cols.T) / np.outer(rows.sum(axis=1), cols.sum(axis=1))
+
+
+def _gains(height, width, grid):
+    """
+    Amplitude of each cell's bump that moves the weighted mean of its block means by 1.
+    """
+    rows, cols = _bumps(height, grid, 8), _bumps(width, grid, 8)
+    return np.outer(rows.sum(axis=1) / np.square(rows).sum(axis=1), cols.sum(axis=1) / np.square(cols).sum(axis=1))
+
+
+def embed_triage(frame, key, delta=None, grid=None):
+    """
+    Embeds the triage layer into a BGR frame and returns the new frame (the
+    input frame itself when it is too small to carry the layer). The same luma
+    shift is added to all three channels.
+    """
+    delta = delta or TRIAGE_DELTA
+    grid = grid or TRIAGE_GRID
+    h, w = frame.shape[:2]
+    if not embeddable(h, w, grid):
+        return frame
+
+    rows, cols = _bumps(h, grid), _bumps(w, grid)
+    gains = _gains(h, w, grid)
+    means = cell_means(block_means(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)), (h, w), grid)
+    targets = core.qim_targets(means, triage_bits(key, grid), delta)
+
+    marked = frame
+    for _ in range(EMBED_PASSES):
+        shift = targets - means
+        if np.abs(shift).max() < delta / 16:
+            break
+        field = (rows.T @ (shift * gains) @ cols).astype(np.float32)
+        marked = np.stack([np.clip(np.rint(marked[:, :, c] + field), 0, 255).astype(np.uint8) for c in range(3)],
+                          axis=2)
+        # Clipped and rounded pixels fall short; the next pass makes up for them
+        means = cell_means(block_means(cv2.cvtColor(marked, cv2.COLOR_BGR2GRAY)), (h, w), grid)
+    return marked
+
+
+def embed_triage_dc(dc_levels, dc_step, height, width, key, delta=None, grid=None):
+    """
+    Embeds the triage layer into the quantized luma DC coefficients of a
+    height x width JPEG, shape (blocks_h, blocks_w) with quantization step
+    dc_step, in place. A block's mean is 128 + level * dc_step / 8, so each
+    block moves by its bump rounded to whole levels.
+    """
+    delta = delta or TRIAGE_DELTA
+    grid = grid or TRIAGE_GRID
+    if not embeddable(height, width, grid):
+        return dc_levels
+
+    rows, cols = _bumps(height, grid, 8), _bumps(width, grid, 8)
+    gains = _gains(height, width, grid)
+    levels = dc_levels.astype(np.float64)
+    means = cell_means(128 + levels * dc_step / 8, (height, width), grid)
+    targets = core.qim_targets(means, triage_bits(key, grid), delta)
+    for _ in range(EMBED_PASSES):
+        shift = targets - means
+        if np.abs(shift).max() < delta / 16:
+            break
+        levels += np.round((rows.T @ (shift * gains) @ cols) * 8 / dc_step)
+        means = cell_means(128 + levels * dc_step / 8, (height, width), grid)
+    dc_levels[...] = levels.astype(dc_levels.dtype)
+    return dc_levels
+
+
+def qim_decode(values, delta):
+    """
+    Bit of the nearest point of either QIM lattice (multiples of delta / 2, odd ones carry 1).
+    """
+    return np.round(values * 2 / delta).astype(np.int64) % 2 == 1
+
+
+def read_luma(path, grid=None):
+    """
+    Luma samples to read the triage layer from: (block means, (height, width))
+    or, for images too small for BLOCK_CELL_SAMPLES blocks per cell, (pixels,
+    None). JPEGs are decoded at 1/8 size, which reads only their DC
+    coefficients; other formats are decoded in full (OpenCV subsamples them at
+    reduced sizes rather than averaging) and averaged per block.
+    """
+    grid = grid or TRIAGE_GRID
+    header = jpeg.frame_header(path)
+    if header is not None and min(header[:2]) >= grid * BLOCK_CELL_SAMPLES * 8:
+        blocks = cv2.imread(path, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+        if blocks is not None:
+            return blocks.astype(np.float64), header[:2]
+    gray = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        raise ValueError("Could not decode image")
+    if min(gray.shape) >= grid * BLOCK_CELL_SAMPLES * 8:
+        return block_means(gray), gray.shape
+    return gray.astype(np.float64), None
+
+
+def triage_ber(samples, key, shape=None, delta=None, grid=None):
+    """
+    BER of the triage layer read from luma samples (see read_luma). Decoders
+    and the 8x8 layer's rounding move every cell mean by about the same
+    fraction of a gray level, so the lowest BER over OFFSET_STEPS lattice
+    offsets is taken. Images too small to carry the layer read as 0.5.
+    """
+    delta = delta or TRIAGE_DELTA
+    if min(samples.shape) < (grid or TRIAGE_GRID) * MIN_CELL_SAMPLES:
+        return 0.5
+    means, bits = cell_means(samples, shape, grid), triage_bits(key, grid)
+    return float(min(np.mean(qim_decode(means + delta * k / OFFSET_STEPS, delta) != bits)
+                     for k in range(OFFSET_STEPS)))
+
+
+def triage_watermark(path, key, delta=None):
+    """
+    BER of the triage layer of an image file (or a downscaled copy of one).
+    """
+    samples, shape = read_luma(path)
+    return triage_ber(samples, key, shape, delta)